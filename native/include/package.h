@@ -33,6 +33,9 @@ public:
 
     void scan(int fd);
 
+    // Read only control.tar; data.tar is skipped, but still hashed
+    bool control_only = false;
+
     std::string control;
     std::time_t mtime;
     std::vector<file_entry> files;
@@ -0,0 +1,15 @@
+#ifndef P_VECTOR_PACKAGE_BINARY_H
+#define P_VECTOR_PACKAGE_BINARY_H
+
+#include <cstdint>
+#include <string>
+
+#include "package.h"
+
+std::string package_to_binary(const Package &pkg);
+
+std::string error_to_binary(std::int32_t status);
+
+std::string scan_to_binary(const std::string &path, bool control_only = false);
+
+#endif //P_VECTOR_PACKAGE_BINARY_H
@@ -1,6 +1,7 @@
 #include <elf.h>
 #include <iostream>
 #include <cassert>
+#include <cstring>
 #include <vector>
 
 #include "elf_dependency.h"
@@ -9,43 +10,53 @@ ElfDependency::ElfDependency(std::function<size_t(void *, size_t)> read) {
     this->read = std::move(read);
 }
 
-const size_t DISCARD_BLOCK_SIZE = 1024;
-char discard_buf[DISCARD_BLOCK_SIZE];
-
-void ElfDependency::must_seek(size_t target) {
-    if (target < buffer.size()) {
-        current = target;
-        return;
+const size_t WINDOW_SIZE = 32 * 1024 * 1024;
+const size_t READ_BLOCK_SIZE = 64 * 1024;
+const size_t DISCARD_BLOCK_SIZE = 16 * 1024;
+
+void ElfDependency::fill(size_t target) {
+    // Once something has been skipped, the window can't grow any more
+    if (current != window.size()) return;
+    target = std::min(target, WINDOW_SIZE);
+    while (window.size() < target) {
+        auto old_size = window.size();
+        auto size = std::min(target - old_size, READ_BLOCK_SIZE);
+        window.resize(old_size + size);
+        auto size_read = this->read(&window[old_size], size);
+        window.resize(old_size + size_read);
+        current += size_read;
+        if (size_read != size) return;
     }
-    current = buffer.size();
-    size_t distance = target - current;
-    size_t blocks = distance / DISCARD_BLOCK_SIZE;
-    size_t tail = distance % DISCARD_BLOCK_SIZE;
-    for (unsigned i = 0; i < blocks; ++i) {
-        must_read(discard_buf, DISCARD_BLOCK_SIZE);
+}
+
+void ElfDependency::must_skip(size_t target) {
+    char discard_buf[DISCARD_BLOCK_SIZE];
+    if (target < current) throw elf_corrupted();
+    while (current < target) {
+        must_read(discard_buf, std::min(target - current, DISCARD_BLOCK_SIZE));
     }
-    if (tail) must_read(discard_buf, tail);
 }
 
 void ElfDependency::must_read(void *buf, size_t size) {
-    if (current == buffer.size()) {
-        size_t size_read = this->read(buf, size);
-        buffer.append((char *) buf, size_read);
-        current += size_read;
-        if (size_read != size) throw elf_corrupted();
-    } else if (current + size <= buffer.size()) {
-        buffer.copy((char *) buf, size, current);
-        current += size;
-    } else if (current < buffer.size()) {
-        auto cached_size = buffer.size() - current;
-        must_read(buf, cached_size);
-        must_read((char *) buf + cached_size, size - cached_size);
-    } else {
+    size_t size_read = this->read(buf, size);
+    current += size_read;
+    if (size_read != size) throw elf_corrupted();
+}
+
+void ElfDependency::fetch(size_t offset, size_t size, void *buf) {
+    if (offset + size < offset) throw elf_corrupted();
+    fill(offset + size);
+    if (offset + size <= window.size()) {
+        window.copy((char *) buf, size, offset);
         return;
     }
+    // Beyond the window, only what is still ahead in the stream
+    if (offset < current) throw elf_corrupted();
+    must_skip(offset);
+    must_read(buf, size);
 }
 
-std::string ElfDependency::lookup_table(size_t ptr) {
+std::string ElfDependency::lookup_table(const std::string &dyn_str_table, size_t ptr) {
     if (ptr >= dyn_str_table.size()) throw elf_corrupted();
     auto end = dyn_str_table.find((char) '\0', ptr);
     if (end == std::string::npos) {
@@ -56,76 +67,95 @@ std::string ElfDependency::lookup_table(size_t ptr) {
 
 void ElfDependency::scan() {
     unsigned char e_ident[EI_NIDENT];
-    must_read(e_ident, sizeof(e_ident));
-    if (std::string((char *) e_ident, SELFMAG) != ELFMAG) throw elf_corrupted();
+    // Most entries aren't ELF, give up on them before keeping anything
+    must_read(e_ident, SELFMAG);
+    if (memcmp(e_ident, ELFMAG, SELFMAG) != 0) throw elf_corrupted();
+    must_read(e_ident + SELFMAG, EI_NIDENT - SELFMAG);
+    window.assign((char *) e_ident, EI_NIDENT);
 
     endian = e_ident[EI_DATA];
 
     if (e_ident[EI_CLASS] == ELFCLASS32)
-        scan<Elf32_Ehdr, Elf32_Shdr, Elf32_Dyn>();
+        scan<Elf32_Ehdr, Elf32_Phdr, Elf32_Dyn>();
     else if (e_ident[EI_CLASS] == ELFCLASS64)
-        scan<Elf64_Ehdr, Elf64_Shdr, Elf64_Dyn>();
+        scan<Elf64_Ehdr, Elf64_Phdr, Elf64_Dyn>();
     else throw elf_corrupted();
 }
 
-template<typename _Ehdr, typename _Shdr, typename _Dyn>
+template<typename _Ehdr, typename _Phdr, typename _Dyn>
 void ElfDependency::scan() {
     // Get Ehdr
     _Ehdr ehdr{};
-    must_read((char *) &ehdr + EI_NIDENT, sizeof(ehdr) - EI_NIDENT);
+    fetch(0, sizeof(ehdr), &ehdr);
     is_dyn = H(ehdr.e_type) == ET_DYN;
 
-    // Get Shdr
-    must_seek(H(ehdr.e_shoff));
-    std::vector<_Shdr> shdr_array;
-    int dyn_idx = -1, dyn_str_idx = -1;
-    for (int i = 0; i < H(ehdr.e_shnum); ++i) {
-        _Shdr shdr{};
-        must_read(&shdr, sizeof(shdr));
-        shdr_array.push_back(shdr);
-        // Find dynamic section
-        if (H(shdr.sh_type) == SHT_DYNAMIC) {
-            dyn_idx = i;
-            dyn_str_idx = H(shdr.sh_link);
-            if (dyn_str_idx > H(ehdr.e_shnum) - 1) throw elf_corrupted();
-        }
-    }
+    // Get Phdr
+    if (H(ehdr.e_phoff) == 0 || H(ehdr.e_phnum) == 0) return;
+    if (H(ehdr.e_phentsize) != sizeof(_Phdr) || H(ehdr.e_phnum) == PN_XNUM)
+        throw elf_corrupted();
+    std::vector<_Phdr> phdr_array(H(ehdr.e_phnum));
+    fetch(H(ehdr.e_phoff), phdr_array.size() * sizeof(_Phdr), phdr_array.data());
 
-    if (dyn_idx == -1) return;
+    const _Phdr *dyn_phdr = nullptr;
+    for (auto &phdr : phdr_array) {
+        if (H(phdr.p_type) == PT_DYNAMIC) dyn_phdr = &phdr;
+    }
+    // Separate debug info keeps the headers, but not the contents
+    if (dyn_phdr == nullptr || H(dyn_phdr->p_filesz) == 0) return;
 
     std::vector<_Dyn> dyn_array;
-    { // Read dynamic section entries
-        auto table_offset = H(shdr_array[dyn_idx].sh_offset);
-        auto table_size = H(shdr_array[dyn_idx].sh_size);
-        must_seek(table_offset);
-        while (current < table_offset + table_size) {
-            _Dyn dyn{};
-            must_read(&dyn, sizeof(dyn));
-            dyn_array.push_back(dyn);
-        }
+    { // Read dynamic segment entries
+        size_t table_size = H(dyn_phdr->p_filesz);
+        if (table_size > WINDOW_SIZE) throw elf_corrupted();
+        dyn_array.resize(table_size / sizeof(_Dyn));
+        fetch(H(dyn_phdr->p_offset), dyn_array.size() * sizeof(_Dyn), dyn_array.data());
     }
 
-    { // Read string table section
-        auto table_offset = H(shdr_array[dyn_str_idx].sh_offset);
-        auto table_size = H(shdr_array[dyn_str_idx].sh_size);
-        must_seek(table_offset);
-        auto *str_table = new char[table_size];
-        try {
-            must_read(str_table, table_size);
-        } catch (...) {
-            delete[] str_table;
-            throw;
+    std::vector<size_t> needed;
+    bool has_so_name = false, has_str_table = false;
+    size_t so_name_ptr = 0, str_table_addr = 0, str_table_size = 0;
+    for (auto &dyn : dyn_array) {
+        auto tag = H(dyn.d_tag);
+        if (tag == DT_NULL) {
+            break;
+        } else if (tag == DT_NEEDED) {
+            needed.push_back(H(dyn.d_un.d_val));
+        } else if (tag == DT_SONAME) {
+            has_so_name = true;
+            so_name_ptr = H(dyn.d_un.d_val);
+        } else if (tag == DT_STRTAB) {
+            has_str_table = true;
+            str_table_addr = H(dyn.d_un.d_ptr);
+        } else if (tag == DT_STRSZ) {
+            str_table_size = H(dyn.d_un.d_val);
         }
-        dyn_str_table = std::string(str_table, table_size);
-        delete[] str_table;
     }
-
-    for (auto &dyn : dyn_array) {
-        if (H(dyn.d_tag) == DT_NEEDED) {
-            so_depends.insert({lookup_table(H(dyn.d_un.d_val))});
-        } else if (H(dyn.d_tag) == DT_SONAME) {
-            so_name = lookup_table(H(dyn.d_un.d_val));
+    if (needed.empty() && !has_so_name) return;
+    if (!has_str_table) throw elf_corrupted();
+
+    std::string dyn_str_table;
+    { // Read string table, DT_STRTAB is an address mapped by a PT_LOAD
+        const _Phdr *load_phdr = nullptr;
+        for (auto &phdr : phdr_array) {
+            if (H(phdr.p_type) == PT_LOAD && H(phdr.p_vaddr) <= str_table_addr &&
+                str_table_addr - H(phdr.p_vaddr) < H(phdr.p_filesz)) {
+                load_phdr = &phdr;
+                break;
+            }
         }
+        if (load_phdr == nullptr) throw elf_corrupted();
+        size_t start = str_table_addr - H(load_phdr->p_vaddr);
+        size_t table_size = std::min(str_table_size, (size_t) H(load_phdr->p_filesz) - start);
+        if (table_size > WINDOW_SIZE) throw elf_corrupted();
+        dyn_str_table.resize(table_size);
+        fetch(H(load_phdr->p_offset) + start, table_size, &dyn_str_table[0]);
+    }
+
+    for (auto ptr : needed) {
+        so_depends.insert({lookup_table(dyn_str_table, ptr)});
+    }
+    if (has_so_name) {
+        so_name = lookup_table(dyn_str_table, so_name_ptr);
     }
 }
 
@@ -11,33 +11,46 @@ public:
     explicit elf_corrupted() : runtime_error("elf corrupted") {};
 };
 
+/*
+ * Finds DT_NEEDED and DT_SONAME of an ELF read as a forward-only stream.
+ *
+ * The dynamic segment is located through the program headers. Only a
+ * prefix of the file (at most 32 MiB) is kept, which holds the
+ * headers and, in every layout we know of, the dynamic string table. The
+ * rest is skipped without being kept, so memory does not grow with the
+ * size of the file.
+ */
 class ElfDependency {
 public:
     explicit ElfDependency(std::function<size_t(void *, size_t)>);
 
     void scan();
 
-    bool is_dyn;
+    bool is_dyn = false;
     std::string so_name;
     std::set<std::string> so_depends;
 
 private:
-    template<typename _Ehdr, typename _Shdr, typename _Dyn>
+    template<typename _Ehdr, typename _Phdr, typename _Dyn>
     void scan();
 
     template<typename T>
     T H(T v) noexcept;
 
+    void fill(size_t);
+
+    void must_skip(size_t);
+
     void must_read(void *, size_t);
 
-    void must_seek(size_t);
+    void fetch(size_t, size_t, void *);
 
-    std::string lookup_table(size_t);
+    std::string lookup_table(const std::string &, size_t);
 
     std::function<size_t(void *, size_t)> read;
+    // Bytes consumed from the stream, window holds the first of them
     size_t current = 0;
-    std::string buffer;
-    std::string dyn_str_table;
+    std::string window;
     unsigned char endian;
 };
 
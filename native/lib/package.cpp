@@ -35,7 +35,7 @@ void Package::scan(int fd) {
         if (entry_is(e, "control.tar"))
             this->control_tar();
 
-        else if (entry_is(e, "data.tar"))
+        else if (!this->control_only && entry_is(e, "data.tar"))
             this->data_tar();
 
     }
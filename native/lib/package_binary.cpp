@@ -0,0 +1,98 @@
+#include <cstring>
+#include <unordered_map>
+#include <fcntl.h>
+#include <unistd.h>
+
+#include "package_binary.h"
+
+template<typename T>
+static void put(std::string &buf, T value) {
+    buf.append(reinterpret_cast<const char *>(&value), sizeof(value));
+}
+
+static void put_strings(std::string &buf, const std::set<std::string> &strings) {
+    for (auto &i : strings) {
+        buf += i;
+        buf += '\0';
+    }
+}
+
+// Binary format, in native byte order:
+//   u32 length of the rest of the record
+//   i32 status, 0 or the exit status of the single-file mode;
+//       nothing else follows if not 0
+//   u32 control length, owner count, so_provides count, so_depends count,
+//       file count
+//   i64 size, i64 time, u8[32] sha256
+//   control, then NUL-terminated owner names, so_provides and so_depends
+//   per file: i64 size, uid, gid, u32 type, perm, uname index, gname index
+//   NUL-terminated path of each file
+// User and group names are interned in the owner table.
+std::string package_to_binary(const Package &pkg) {
+    std::unordered_map<std::string, std::uint32_t> owner_idx;
+    std::string owners, entries, paths;
+    auto owner = [&](const std::string &name) {
+        auto it = owner_idx.emplace(name, owner_idx.size());
+        if (it.second) {
+            owners += name;
+            owners += '\0';
+        }
+        return it.first->second;
+    };
+    for (auto &i : pkg.files) {
+        put<std::int64_t>(entries, i.size);
+        put<std::int64_t>(entries, i.uid);
+        put<std::int64_t>(entries, i.gid);
+        put<std::uint32_t>(entries, i.type);
+        put<std::uint32_t>(entries, i.perm);
+        put<std::uint32_t>(entries, owner(i.uname));
+        put<std::uint32_t>(entries, owner(i.gname));
+        paths += i.path;
+        paths += '\0';
+    }
+    std::string buf;
+    put<std::uint32_t>(buf, 0);
+    put<std::int32_t>(buf, 0);
+    put<std::uint32_t>(buf, pkg.control.size());
+    put<std::uint32_t>(buf, owner_idx.size());
+    put<std::uint32_t>(buf, pkg.so_provides.size());
+    put<std::uint32_t>(buf, pkg.so_depends.size());
+    put<std::uint32_t>(buf, pkg.files.size());
+    put<std::int64_t>(buf, pkg.size);
+    put<std::int64_t>(buf, pkg.mtime);
+    buf.append(reinterpret_cast<const char *>(pkg.sha256), sizeof(pkg.sha256));
+    buf += pkg.control;
+    buf += owners;
+    put_strings(buf, pkg.so_provides);
+    put_strings(buf, pkg.so_depends);
+    buf += entries;
+    buf += paths;
+    std::uint32_t length = buf.size() - sizeof(length);
+    std::memcpy(&buf[0], &length, sizeof(length));
+    return buf;
+}
+
+std::string error_to_binary(std::int32_t status) {
+    std::string buf;
+    put<std::uint32_t>(buf, sizeof(status));
+    put<std::int32_t>(buf, status);
+    return buf;
+}
+
+// Scan path and return its record, with the same status codes as the
+// single-file mode of pkgscan_cli. With control_only, the record has no
+// files, so_provides or so_depends.
+std::string scan_to_binary(const std::string &path, bool control_only) {
+    Package pkg{};
+    pkg.control_only = control_only;
+    int fd = open(path.c_str(), O_CLOEXEC | O_RDONLY);
+    if (fd < 0) return error_to_binary(1);
+    try {
+        pkg.scan(fd);
+    } catch (archive_corrupted &except) {
+        close(fd);
+        return error_to_binary(2);
+    }
+    close(fd);
+    return package_to_binary(pkg);
+}
@@ -1,24 +1,15 @@
 #include <iostream>
+#include <string>
+#include <cstring>
+#include <cstdint>
 #include <fcntl.h>
 #include "package.h"
+#include "package_binary.h"
 #include "json.hpp"
 
-int main(int argc, const char *argv[]) {
-    int fd = 0;
-    if (argc == 2) {
-        fd = open(argv[1], O_CLOEXEC | O_RDONLY);
-        if (fd < 0) return 1;
-    }
-    Package pkg{};
-    try {
-        pkg.scan(fd); // BOOM!
-    } catch (archive_corrupted &except) {
-        std::cerr << "archive is corrupted." << std::endl;
-        return 2;
-    }
-    if (fd != 0) close(fd);
+using json = nlohmann::json;
 
-    using json = nlohmann::json;
+static json package_to_json(const Package &pkg) {
     json j = {
             {"size",        pkg.size},
             {"hash_alg",    "SHA256"},
@@ -44,6 +35,51 @@ int main(int argc, const char *argv[]) {
         j_files.push_back(j_file);
     }
     j["files"] = j_files;
-    std::cout << j.dump(-1, ' ', true) << std::endl;
+    return j;
+}
+
+// Batch mode: read NUL-terminated paths from stdin, write the binary
+// record of each to stdout. Failures are reported in-band, using the same
+// status codes as the single-file mode. --control-only skips data.tar.
+static int batch_main(bool control_only) {
+    std::string path;
+    while (std::getline(std::cin, path, '\0')) {
+        std::cout << scan_to_binary(path, control_only);
+        std::cout.flush();
+    }
+    return 0;
+}
+
+int main(int argc, const char *argv[]) {
+    if (argc >= 2 && std::strcmp(argv[1], "--batch") == 0) {
+        bool binary = false, control_only = false;
+        for (int i = 2; i < argc; ++i) {
+            if (std::strcmp(argv[i], "--binary") == 0)
+                binary = true;
+            else if (std::strcmp(argv[i], "--control-only") == 0)
+                control_only = true;
+            else
+                return 1;
+        }
+        // Only binary records are written in batches
+        if (!binary) return 1;
+        return batch_main(control_only);
+    }
+
+    int fd = 0;
+    if (argc == 2) {
+        fd = open(argv[1], O_CLOEXEC | O_RDONLY);
+        if (fd < 0) return 1;
+    }
+    Package pkg{};
+    try {
+        pkg.scan(fd); // BOOM!
+    } catch (archive_corrupted &except) {
+        std::cerr << "archive is corrupted." << std::endl;
+        return 2;
+    }
+    if (fd != 0) close(fd);
+
+    std::cout << package_to_json(pkg).dump(-1, ' ', true) << std::endl;
     return 0;
 }
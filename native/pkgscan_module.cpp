@@ -0,0 +1,49 @@
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <exception>
+#include <string>
+
+#include "package_binary.h"
+
+// scan(path, control_only=False) -> bytes
+// The record `pkgscan_cli --batch --binary` writes for path, without the
+// length. The GIL is released while the package is read.
+static PyObject *pkgscan_scan(PyObject *, PyObject *args) {
+    PyObject *path_bytes;
+    int control_only = 0;
+    if (!PyArg_ParseTuple(args, "O&|p", PyUnicode_FSConverter, &path_bytes, &control_only))
+        return nullptr;
+    std::string path(PyBytes_AS_STRING(path_bytes), PyBytes_GET_SIZE(path_bytes));
+    Py_DECREF(path_bytes);
+
+    std::string buf;
+    std::string error;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        buf = scan_to_binary(path, control_only);
+    } catch (std::exception &except) {
+        error = except.what();
+    }
+    Py_END_ALLOW_THREADS
+
+    if (!error.empty()) {
+        PyErr_SetString(PyExc_RuntimeError, error.c_str());
+        return nullptr;
+    }
+    return PyBytes_FromStringAndSize(buf.data() + sizeof(std::uint32_t),
+                                     buf.size() - sizeof(std::uint32_t));
+}
+
+static PyMethodDef pkgscan_methods[] = {
+        {"scan", pkgscan_scan, METH_VARARGS, "Scan a .deb, return its binary record."},
+        {nullptr, nullptr, 0, nullptr},
+};
+
+static struct PyModuleDef pkgscan_module = {
+        PyModuleDef_HEAD_INIT, "_pkgscan", nullptr, -1, pkgscan_methods,
+        nullptr, nullptr, nullptr, nullptr,
+};
+
+PyMODINIT_FUNC PyInit__pkgscan() {
+    return PyModule_Create(&pkgscan_module);
+}
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Scan throughput benchmark.
+
+Generates a pool of synthetic .deb packages and scans it with module_scan
+into a throwaway PostgreSQL cluster (or an existing, empty database given
+by --pgconn), then reports packages/s, MB/s and the time spent in each
+stage; rescans of the unchanged pool only report their wall time. Run
+from this directory, after building pkgscan_cli or _pkgscan:
+
+    python3 bench_scan.py --packages 500 --files 200
+"""
+
+import io
+import os
+import time
+import random
+import shutil
+import struct
+import tarfile
+import logging
+import argparse
+import tempfile
+import subprocess
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+
+import internal_pkgscan
+import internal_stats
+import module_ipc
+import module_scan
+
+logger_bench = logging.getLogger('BENCH')
+
+ARCH = 'amd64'
+
+
+def elf_so(soname, needed, payload=0):
+    """ A minimal little-endian ELF64 shared object: a PT_LOAD segment
+        mapping the whole file at address 0, a PT_DYNAMIC segment and
+        .dynstr/.dynamic section headers, with DT_NEEDED, DT_SONAME,
+        DT_STRTAB and DT_STRSZ. payload bytes of filler precede .dynstr.
+    """
+    dynstr = b'\0'
+    offsets = []
+    for name in list(needed) + ([soname] if soname else []):
+        offsets.append(len(dynstr))
+        dynstr += name.encode() + b'\0'
+    shstrtab = b'\0.dynstr\0.dynamic\0.shstrtab\0'
+    ehdr_size, phdr_size, shdr_size, dyn_size = 64, 56, 64, 16
+
+    def align(n):
+        return (n + 7) & ~7
+
+    dynstr_off = ehdr_size + 2 * phdr_size + payload
+    dynamic_off = align(dynstr_off + len(dynstr))
+    dyn = []
+    for off in offsets[:len(needed)]:
+        dyn.append((1, off))                    # DT_NEEDED
+    if soname:
+        dyn.append((14, offsets[-1]))           # DT_SONAME
+    dyn.append((5, dynstr_off))                 # DT_STRTAB
+    dyn.append((10, len(dynstr)))               # DT_STRSZ
+    dyn.append((0, 0))                          # DT_NULL
+    dynamic = b''.join(struct.pack('<qQ', *d) for d in dyn)
+    shstrtab_off = dynamic_off + len(dynamic)
+    shoff = align(shstrtab_off + len(shstrtab))
+    size = shoff + 4 * shdr_size
+
+    ident = b'\x7fELF' + bytes((2, 1, 1, 0)) + bytes(8)
+    ehdr = ident + struct.pack(
+        '<HHIQQQIHHHHHH', 3, 62, 1, 0, ehdr_size, shoff, 0, ehdr_size,
+        phdr_size, 2, shdr_size, 4, 3)
+    phdrs = struct.pack('<IIQQQQQQ', 1, 5, 0, 0, 0, size, size, 0x1000)
+    phdrs += struct.pack('<IIQQQQQQ', 2, 6, dynamic_off, dynamic_off,
+                         dynamic_off, len(dynamic), len(dynamic), 8)
+    shdrs = bytes(shdr_size)
+    shdrs += struct.pack('<IIQQQQIIQQ', 1, 3, 2, dynstr_off, dynstr_off,
+                         len(dynstr), 0, 0, 1, 0)
+    shdrs += struct.pack('<IIQQQQIIQQ', 9, 6, 3, dynamic_off, dynamic_off,
+                         len(dynamic), 1, 0, 8, dyn_size)
+    shdrs += struct.pack('<IIQQQQIIQQ', 18, 3, 0, 0, shstrtab_off,
+                         len(shstrtab), 0, 0, 1, 0)
+    buf = io.BytesIO()
+    buf.write(ehdr)
+    buf.write(phdrs)
+    buf.write(bytes(payload))
+    buf.write(dynstr)
+    buf.write(bytes(dynamic_off - buf.tell()))
+    buf.write(dynamic)
+    buf.write(shstrtab)
+    buf.write(bytes(shoff - buf.tell()))
+    buf.write(shdrs)
+    return buf.getvalue()
+
+
+def tar_bytes(members, compression):
+    """ Build a tar of (path, data or None for a directory, mode). """
+    buf = io.BytesIO()
+    mode = {'gz': 'w:gz', 'xz': 'w:xz'}.get(compression, 'w')
+    with tarfile.open(fileobj=buf, mode=mode, format=tarfile.GNU_FORMAT) as tar:
+        for path, data, perm in members:
+            info = tarfile.TarInfo(path)
+            info.mtime = 1700000000
+            info.uname = info.gname = 'root'
+            info.mode = perm
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    data = buf.getvalue()
+    if compression == 'zst':
+        data = subprocess.run(['zstd', '-q', '-c'], input=data,
+                              stdout=subprocess.PIPE, check=True).stdout
+    return data
+
+
+def ar_bytes(members):
+    out = [b'!<arch>\n']
+    for name, data in members:
+        out.append(b'%-16s%-12d%-6d%-6d%-8o%-10d`\n' % (
+            name.encode(), 1700000000, 0, 0, 0o100644, len(data)))
+        out.append(data)
+        if len(data) % 2:
+            out.append(b'\n')
+    return b''.join(out)
+
+
+def make_deb(path, package, depends, members, compression, version='1.0-1'):
+    control = ('Package: %s\nVersion: %s\nArchitecture: %s\n'
+               'Maintainer: Bench <bench@example.org>\nInstalled-Size: %d\n'
+               'Section: bench\n' % (package, version, ARCH, max(1, sum(
+                   len(m[1] or b'') for m in members) // 1024)))
+    if depends:
+        control += 'Depends: %s\n' % ', '.join(depends)
+    control += 'Description: synthetic package %s\n' % package
+    control_tar = tar_bytes(
+        [('./', None, 0o755), ('./control', control.encode(), 0o644)], 'gz')
+    data_tar = tar_bytes(members, compression)
+    ext = {'gz': '.gz', 'xz': '.xz', 'zst': '.zst'}.get(compression, '')
+    with open(path, 'wb') as f:
+        f.write(ar_bytes([('debian-binary', b'2.0\n'),
+                          ('control.tar.gz', control_tar),
+                          ('data.tar' + ext, data_tar)]))
+
+
+def generate_pool(base_dir, args):
+    """ Write args.packages packages to pool/bench/main, return their
+        total size. Every package ships a shared library needed by the
+        binaries of the following ones.
+    """
+    rnd = random.Random(args.seed)
+    compressions = args.compression.split(',')
+    if 'zst' in compressions and not shutil.which('zstd'):
+        logger_bench.warning('zstd not found, skipping zst packages')
+        compressions.remove('zst')
+    total = 0
+    for i in range(args.packages):
+        package = 'bench%d' % i
+        soname = 'libbench%d.so.1' % i
+        deps = rnd.sample(range(i), min(i, args.libs))
+        needed = ['libbench%d.so.1' % j for j in deps] + ['libc.so.6']
+        members = [('./', None, 0o755)]
+        dirs = set()
+        for n in range(args.files):
+            d = './usr/share/%s/d%d' % (package, n % max(1, args.files // 50))
+            for k in range(3, d.count('/') + 1):
+                parent = '/'.join(d.split('/')[:k + 1]) + '/'
+                if parent not in dirs:
+                    dirs.add(parent)
+                    members.append((parent, None, 0o755))
+            data = rnd.getrandbits(8 * args.file_size).to_bytes(
+                args.file_size, 'little') if args.file_size else b''
+            members.append(('%s/file%d' % (d, n), data, 0o644))
+        members += [('./usr/', None, 0o755), ('./usr/lib/', None, 0o755),
+                    ('./usr/bin/', None, 0o755)]
+        members.append(('./usr/lib/' + soname,
+                        elf_so(soname, needed, args.elf_size), 0o755))
+        members.append(('./usr/lib/libbench%d.so' % i,
+                        elf_so(None, [], 0), 0o644))
+        members.append(('./usr/bin/' + package,
+                        elf_so(None, needed, args.elf_size), 0o755))
+        path = os.path.join(base_dir, 'pool', 'bench', 'main',
+                            package[:6], '%s_1.0-1_%s.deb' % (package, ARCH))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        make_deb(path, package, ['bench%d' % j for j in deps],
+                 members, compressions[i % len(compressions)])
+        total += os.path.getsize(path)
+    return total
+
+
+class PostgresCluster(object):
+    """A throwaway cluster, listening on a Unix socket only."""
+
+    def __init__(self, tmpdir, pgbin=None):
+        self.datadir = os.path.join(tmpdir, 'pgdata')
+        self.sockdir = tmpdir
+        self.pgbin = pgbin
+
+    def _cmd(self, name):
+        if self.pgbin:
+            return os.path.join(self.pgbin, name)
+        return name
+
+    def start(self):
+        subprocess.run([self._cmd('initdb'), '-D', self.datadir, '-A', 'trust',
+                        '-U', 'postgres'], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([self._cmd('pg_ctl'), '-D', self.datadir, '-w', '-l',
+                        os.path.join(self.sockdir, 'pg.log'), '-o',
+                        "-k %s -c listen_addresses='' -c fsync=off" %
+                        self.sockdir, 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        return 'host=%s user=postgres dbname=postgres' % self.sockdir
+
+    def stop(self):
+        subprocess.run([self._cmd('pg_ctl'), '-D', self.datadir, '-m', 'fast',
+                        'stop'], stdout=subprocess.DEVNULL)
+
+
+# Stages of a scan as timed by internal_stats, in the order they run
+STAGES = ('walk', 'check', 'verify', 'scan', 'extract', 'decode', 'write',
+          'index')
+
+
+def report_stages():
+    """Print the internal_stats timers, summed over their labels."""
+    totals = internal_stats.stage_totals()
+    # extract is the time taken by whichever scanner ran
+    names = {'extract': 'extract (%s)' % (
+        'pkgscan_cli' if internal_pkgscan._pkgscan is None else '_pkgscan')}
+    for stage in STAGES + tuple(sorted(set(totals) - set(STAGES))):
+        if stage in totals:
+            calls, seconds = totals[stage]
+            print('  %-24s %8d calls %10.3f s' % (
+                names.get(stage, stage), calls, seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--packages', type=int, default=200)
+    parser.add_argument('--files', type=int, default=100,
+                        help='regular files per package')
+    parser.add_argument('--file-size', type=int, default=512)
+    parser.add_argument('--libs', type=int, default=3,
+                        help='libraries each package needs')
+    parser.add_argument('--elf-size', type=int, default=64 * 1024,
+                        help='filler bytes in each ELF file')
+    parser.add_argument('--compression', default='xz,gz,zst',
+                        help='comma-separated data.tar compressions to cycle')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pgconn', help='an existing empty database to use '
+                        'instead of a throwaway cluster')
+    parser.add_argument('--pgbin', help='directory of initdb and pg_ctl')
+    parser.add_argument('--pool', help='generate (or reuse) the pool here')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='components scanned at the same time')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='see module_scan.processes')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s %(levelname).1s [%(name)5.5s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S', level=logging.WARNING)
+    logger_bench.setLevel(logging.INFO)
+
+    tmpdir = tempfile.mkdtemp(prefix='pv-bench-')
+    cluster = None
+    try:
+        base_dir = args.pool or os.path.join(tmpdir, 'repo')
+        start = time.perf_counter()
+        if os.path.isdir(os.path.join(base_dir, 'pool')):
+            size = sum(os.path.getsize(os.path.join(d, f))
+                       for d, _, files in os.walk(base_dir) for f in files
+                       if f.endswith('.deb'))
+            logger_bench.info('Reusing pool at %s', base_dir)
+        else:
+            size = generate_pool(base_dir, args)
+            logger_bench.info('Generated %d packages, %.1f MB in %.1f s',
+                              args.packages, size / 1e6,
+                              time.perf_counter() - start)
+        npackages = sum(1 for _, _, files in os.walk(base_dir)
+                        for f in files if f.endswith('.deb'))
+
+        pgconn = args.pgconn
+        if pgconn is None:
+            cluster = PostgresCluster(tmpdir, args.pgbin)
+            pgconn = cluster.start()
+        db = psycopg2.connect(pgconn, cursor_factory=psycopg2.extras.DictCursor)
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'abbsdb.sql')) as f:
+            db.cursor().execute(f.read())
+        db.commit()
+        module_ipc.zmq_change = 'ipc://' + os.path.join(tmpdir, 'changes')
+        module_ipc.init()
+        module_scan.processes = args.processes
+        dbpool = None
+        if args.jobs:
+            dbpool = psycopg2.pool.ThreadedConnectionPool(
+                1, args.jobs, pgconn, cursor_factory=psycopg2.extras.DictCursor)
+
+        for name, full_walk in (('cold scan', False), ('no-op rescan', False),
+                                ('full-walk rescan', True)):
+            internal_stats.reset()
+            start = time.perf_counter()
+            module_scan.scan(db, base_dir, ['bench'], full_walk, None, dbpool)
+            elapsed = time.perf_counter() - start
+            if name == 'cold scan':
+                print('%s: %.3f s, %.1f packages/s, %.1f MB/s' % (
+                    name, elapsed, npackages / elapsed, size / 1e6 / elapsed))
+            else:
+                # Nothing is scanned again, so a rate would be meaningless
+                print('%s: %.3f s' % (name, elapsed))
+            report_stages()
+        if dbpool is not None:
+            dbpool.closeall()
+        db.close()
+    finally:
+        if cluster is not None:
+            cluster.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Version comparison benchmark.
+
+Generates random Debian versions and checks that comparable_ver() agrees
+with comparable_dpkgver() of vercomp.sql in a throwaway PostgreSQL cluster
+(or an existing database given by --pgconn), and that sort_versions()
+orders them as the database does. Then reports the time taken to compute
+the keys, sort the versions and take the newest, with version_key() and
+with cmp_to_key(dpkg_version_compare). Run from this directory:
+
+    python3 bench_vercomp.py --versions 100000
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import functools
+from unittest import mock
+
+import psycopg2
+
+import internal_dpkg_version
+from bench_scan import PostgresCluster
+
+SUFFIXES = ('', '', '', '~rc1', '~beta2', '+dfsg', 'a', '+git20230101.1a2b3c',
+            '+b1', 'final')
+
+def random_version(rng, long_numbers):
+    parts = [str(rng.randint(0, 20)) for _ in range(rng.randint(1, 4))]
+    if rng.random() < long_numbers:
+        parts.append(str(rng.randint(10 ** 29, 10 ** 30)))
+    ver = '.'.join(parts) + rng.choice(SUFFIXES)
+    if rng.random() < 0.1:
+        ver = '%d:%s' % (rng.randint(0, 3), ver)
+    if rng.random() < 0.7:
+        ver += '-%d%s' % (rng.randint(0, 5), rng.choice(('', '.1', 'ubuntu1')))
+    return ver
+
+def timed(name, count, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    print('  %-32s %8.3f s %12.0f versions/s' % (
+        name, elapsed, count / elapsed))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--versions', type=int, default=100000)
+    parser.add_argument('--distinct', type=float, default=0.3,
+                        help='share of distinct versions among them')
+    parser.add_argument('--long-numbers', type=float, default=0.01,
+                        help='share of versions with a 30-digit number')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pgconn', help='an existing database to use '
+                        'instead of a throwaway cluster')
+    parser.add_argument('--pgbin', help='directory of initdb and pg_ctl')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    distinct = [random_version(rng, args.long_numbers)
+                for _ in range(max(1, int(args.versions * args.distinct)))]
+    versions = [rng.choice(distinct) for _ in range(args.versions)]
+
+    tmpdir = tempfile.mkdtemp(prefix='pv-bench-')
+    cluster = None
+    try:
+        pgconn = args.pgconn
+        if pgconn is None:
+            cluster = PostgresCluster(tmpdir, args.pgbin)
+            pgconn = cluster.start()
+        db = psycopg2.connect(pgconn)
+        cur = db.cursor()
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'vercomp.sql')) as f:
+            cur.execute(f.read())
+
+        print('SQL comparable_dpkgver:')
+        cur.execute('SELECT v, comparable_dpkgver(v) '
+                    'FROM unnest(%s::text[]) v', (distinct,))
+        sql_keys = timed('keys', len(distinct), cur.fetchall)
+        mismatches = [(ver, key) for ver, key in sql_keys
+                      if internal_dpkg_version.comparable_ver(ver) != key]
+        for ver, key in mismatches[:10]:
+            print('  %s: %s in SQL, %s in Python' % (
+                ver, key, internal_dpkg_version.comparable_ver(ver)))
+        cur.execute('SELECT v FROM unnest(%s::text[]) v ORDER BY '
+                    'comparable_dpkgver(v) COLLATE "C", v COLLATE "C"',
+                    (distinct,))
+        sql_order = [row[0] for row in cur]
+        same_order = (sql_order ==
+                      internal_dpkg_version.sort_versions(distinct))
+        print('  %d of %d keys differ, order %s' % (
+            len(mismatches), len(distinct),
+            'agrees' if same_order else 'differs'))
+        db.close()
+
+        print('version_key, %d versions, %d distinct:' % (
+            len(versions), len(distinct)))
+        # Without the cache, duplicates are computed again as well
+        with mock.patch.object(internal_dpkg_version, 'comparable_ver',
+                               internal_dpkg_version.comparable_ver.__wrapped__):
+            timed('keys, not memoized', len(versions), list,
+                  map(internal_dpkg_version.version_key, versions))
+            timed('sort_versions, not memoized', len(versions),
+                  internal_dpkg_version.sort_versions, versions)
+        internal_dpkg_version.comparable_ver.cache_clear()
+        timed('keys, memoized, cold', len(versions), list,
+              map(internal_dpkg_version.version_key, versions))
+        timed('keys, memoized', len(versions), list,
+              map(internal_dpkg_version.version_key, versions))
+        timed('sort_versions, memoized', len(versions),
+              internal_dpkg_version.sort_versions, versions)
+        timed('max_version, memoized', len(versions),
+              internal_dpkg_version.max_version, versions)
+
+        print('cmp_to_key(dpkg_version_compare):')
+        cmp_key = functools.cmp_to_key(
+            internal_dpkg_version.dpkg_version_compare)
+        timed('sorted', len(versions), lambda: sorted(versions, key=cmp_key))
+        timed('max', len(versions), lambda: max(versions, key=cmp_key))
+    finally:
+        if cluster is not None:
+            cluster.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    if mismatches or not same_order:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,21 @@
 
 import os
 import logging
+import binascii
 import psycopg2
 
+import internal_stats
+
 logger_db = logging.getLogger('DB')
 
+PACKAGE_COLUMNS = ('package', 'version', 'repo', 'architecture', 'filename',
+    'size', 'sha256', 'mtime', 'debtime', 'section', 'installed_size',
+    'maintainer', 'description', '_vercomp', 'scantime', 'branch')
+
+# Tables of package data, partitioned by branch, referenced tables first
+PARTITIONED_TABLES = ('pv_packages', 'pv_package_duplicate',
+    'pv_dependencies', 'pv_dpkg_dependencies', 'pv_sodep', 'pv_files')
+
 def make_insert(d):
     keys, values = zip(*d.items())
     return ', '.join(keys), ', '.join(('%s',) * len(values)), values
@@ -17,60 +28,215 @@ def make_where(d):
     keys, values = zip(*d.items())
     return ' AND '.join(k + '=%s' for k in keys), values
 
-SQL_v_dpkg_dependencies = '''
-CREATE MATERIALIZED VIEW IF NOT EXISTS v_dpkg_dependencies AS
-SELECT package, version, repo, relationship, nr,
+def escape_val(x):
+    if isinstance(x, str):
+        return x.replace('\\', '\\\\').replace('\r', '\\r').replace(
+            '\n', '\\n').replace('\t', '\\t')
+    elif isinstance(x, bytes):
+        return '\\x' + binascii.b2a_hex(x).decode('ascii')
+    elif x is None:
+        return '\\N'
+    else:
+        return str(x)
+
+# The tables of package data keyed by pkg_id, with their package, for
+# reading
+SQL_PACKAGE_VIEWS = '''
+CREATE OR REPLACE VIEW pv_package_dependencies AS
+SELECT p.package, p.version, p.repo, d.relationship, d.value, d.branch
+FROM pv_dependencies d
+INNER JOIN pv_packages p ON p.pkg_id=d.pkg_id AND p.branch=d.branch;
+CREATE OR REPLACE VIEW pv_package_sodep AS
+SELECT p.package, p.version, p.repo, s.depends, s.name, s.ver, s.branch
+FROM pv_sodep s
+INNER JOIN pv_packages p ON p.pkg_id=s.pkg_id AND p.branch=s.branch;
+CREATE OR REPLACE VIEW pv_package_files AS
+SELECT pk.package, pk.version, pk.repo, p.path, f.name, f.size, f.ftype,
+  f.perm, f.uid, f.gid, u.name uname, g.name gname, f.branch
+FROM pv_files f
+INNER JOIN pv_packages pk ON pk.pkg_id=f.pkg_id AND pk.branch=f.branch
+LEFT JOIN pv_paths p ON p.id=f.path_id
+LEFT JOIN pv_owners u ON u.id=f.uname_id
+LEFT JOIN pv_owners g ON g.id=f.gname_id;
+'''
+
+# Rows of the tables renamed to *_old, which were keyed by (package,
+# version, repo)
+SQL_CONVERT_DEPENDENCIES = '''
+INSERT INTO pv_dependencies
+SELECT p.pkg_id, o.relationship, o.value, p.branch
+FROM pv_package_dependencies_old o
+INNER JOIN pv_packages p USING (package, version, repo)
+'''
+
+SQL_CONVERT_SODEP = '''
+INSERT INTO pv_sodep
+SELECT p.pkg_id, o.depends, o.name, o.ver, p.branch
+FROM pv_package_sodep_old o
+INNER JOIN pv_packages p USING (package, version, repo)
+'''
+
+SQL_CONVERT_FILES = '''
+INSERT INTO pv_files
+SELECT p.pkg_id, o.path_id, o.name, o.size, o.ftype, o.perm, o.uid, o.gid,
+  o.uname_id, o.gname_id, p.branch
+FROM pv_files_old o
+INNER JOIN pv_packages p USING (package, version, repo)
+'''
+
+# Files from pv_package_files, as they were stored before pv_files
+SQL_CONVERT_PACKAGE_FILES = '''
+INSERT INTO pv_paths (path)
+SELECT DISTINCT path FROM pv_package_files_old WHERE path IS NOT NULL
+ON CONFLICT DO NOTHING;
+INSERT INTO pv_owners (name)
+SELECT uname FROM pv_package_files_old WHERE uname IS NOT NULL
+UNION SELECT gname FROM pv_package_files_old WHERE gname IS NOT NULL
+ON CONFLICT DO NOTHING;
+INSERT INTO pv_files
+SELECT pk.pkg_id, p.id, f.name, f.size, f.ftype,
+  f.perm, f.uid, f.gid, u.id, g.id, pk.branch
+FROM pv_package_files_old f
+INNER JOIN pv_packages pk USING (package, version, repo)
+LEFT JOIN pv_paths p ON p.path=f.path
+LEFT JOIN pv_owners u ON u.name=f.uname
+LEFT JOIN pv_owners g ON g.name=f.gname;
+'''
+
+# Dependencies of the packages scanned before they were parsed by scan
+SQL_CONVERT_DPKG_DEPENDENCIES = '''
+INSERT INTO pv_dpkg_dependencies
+SELECT pkg_id, relationship, nr,
   depspl[1] deppkg, depspl[2] deparch, depspl[3] relop, depspl[4] depver,
-  comparable_dpkgver(depspl[4]) depvercomp
+  comparable_dpkgver(depspl[4]) depvercomp, branch
 FROM (
-  SELECT package, version, repo, relationship, nr, regexp_match(dep,
+  SELECT pkg_id, relationship, nr, branch, regexp_match(dep,
     '^\s*([a-zA-Z0-9.+-]{2,})(?::([a-zA-Z0-9][a-zA-Z0-9-]*))?' ||
     '(?:\s*\(\s*([>=<]+)\s*([0-9a-zA-Z:+~.-]+)\s*\))?(?:\s*\[[\s!\w-]+\])?' ||
     '\s*(?:<.+>)?\s*$') depspl
   FROM (
-    SELECT package, version, repo, relationship, nr,
-      unnest(string_to_array(dep, '|')) dep
-    FROM (
-      SELECT d.package, d.version, d.repo, d.relationship, v.nr, v.val dep
-      FROM pv_package_dependencies d
-      INNER JOIN v_packages_new n USING (package, version, repo)
-      INNER JOIN LATERAL unnest(string_to_array(d.value, ','))
-        WITH ORDINALITY AS v(val, nr) ON TRUE
-    ) q1
-  ) q2
-) q3
+    SELECT d.pkg_id, d.relationship, v.nr, d.branch,
+      unnest(string_to_array(v.val, '|')) dep
+    FROM pv_dependencies d
+    INNER JOIN LATERAL unnest(string_to_array(d.value, ','))
+      WITH ORDINALITY AS v(val, nr) ON TRUE
+  ) q1
+) q2
+'''
+
+SQL_v_packages_new = '''
+SELECT DISTINCT ON (repo, package) package, version, repo,
+  architecture, filename, size, sha256, mtime, debtime,
+  section, installed_size, maintainer, description, _vercomp, pkg_id
+FROM pv_packages p
+WHERE debtime IS NOT NULL AND {cond}
+ORDER BY repo, package, _vercomp DESC
 '''
 
+SQL_v_dpkg_dependencies = '''
+SELECT n.package, n.version, n.repo, d.relationship, d.nr,
+  d.deppkg, d.deparch, d.relop, d.depver, d.depvercomp
+FROM pv_dpkg_dependencies d
+INNER JOIN v_packages_new n USING (pkg_id)
+WHERE {cond}
+'''
+
+# The providers vp of sonames, with the packages using them: either vd,
+# or pi which has a 431 issue for a library no longer provided
 SQL_v_so_breaks = '''
-CREATE MATERIALIZED VIEW IF NOT EXISTS v_so_breaks AS
-SELECT sp.package, sp.repo, sp.name soname, sp.ver sover, sd.ver sodepver,
-  sd.package dep_package, sd.repo dep_repo, sd.version dep_version
-FROM pv_package_sodep sp
-INNER JOIN v_packages_new vp USING (package, version, repo)
-INNER JOIN pv_repos rp ON rp.name=sp.repo
+SELECT vp.package, vp.repo, sp.name soname, sp.ver sover, sd.ver sodepver,
+  vd.package dep_package, vd.repo dep_repo, vd.version dep_version
+FROM pv_sodep sp
+INNER JOIN v_packages_new vp USING (pkg_id)
+INNER JOIN pv_repos rp ON rp.name=vp.repo
 INNER JOIN pv_repos rd ON rd.architecture IN (rp.architecture, 'all')
 AND rp.testing<=rd.testing AND rp.component IN (rd.component, 'main')
-INNER JOIN pv_package_sodep sd ON sd.depends=1
-AND sd.repo=rd.name AND sd.name=sp.name AND sd.package!=sp.package
+INNER JOIN pv_sodep sd ON sd.depends=1 AND sd.name=sp.name
 AND (sp.ver=sd.ver OR sp.ver LIKE sd.ver || '.%')
-INNER JOIN v_packages_new vp2
-ON vp2.package=sd.package AND vp2.version=sd.version AND vp2.repo=sd.repo
-WHERE sp.depends=0
+INNER JOIN v_packages_new vd ON vd.pkg_id=sd.pkg_id
+AND vd.repo=rd.name AND vd.package!=vp.package
+WHERE sp.depends=0 AND {cond_sd}
 UNION ALL
-SELECT sp.package, sp.repo, sp.name soname, sp.ver sover,
+SELECT vp.package, vp.repo, sp.name soname, sp.ver sover,
   substring(pi.filename from position('.so' in pi.filename)+3) sodepver,
   pi.package dep_package, pi.repo dep_repo, pi.version dep_version
-FROM pv_package_sodep sp
-INNER JOIN v_packages_new vp USING (package, version, repo)
-INNER JOIN pv_repos rp ON rp.name=sp.repo
+FROM pv_sodep sp
+INNER JOIN v_packages_new vp USING (pkg_id)
+INNER JOIN pv_repos rp ON rp.name=vp.repo
 INNER JOIN pv_repos rd ON rd.architecture IN (rp.architecture, 'all')
 AND rp.testing<=rd.testing AND rp.component IN (rd.component, 'main')
 INNER JOIN pv_package_issues pi
-ON pi.repo=rd.name AND pi.package!=sp.package
+ON pi.repo=rd.name AND pi.package!=vp.package
 AND substring(pi.filename from 1 for position('.so' in pi.filename)+2)=sp.name
 AND (sp.ver || '.') LIKE (detail->>'sover_provide') || '.%'
 AND pi.errno=431 AND pi.detail IS NOT NULL
-WHERE sp.depends=0
+WHERE sp.depends=0 AND {cond_pi}
+'''
+
+def changed_cond(alias, changed=True):
+    return '(%s.package, %s.repo) %sIN (SELECT package, repo FROM t_changed)' % (
+        alias, alias, '' if changed else 'NOT ')
+
+# Rows are recomputed for the keys changed. v_so_breaks rows involve two
+# packages, those of changed providers are added first, then those of
+# changed users with an unchanged provider.
+SQL_UPDATE_DERIVED = '''
+DELETE FROM v_packages_new p WHERE {changed_p};
+INSERT INTO v_packages_new {v_packages_new};
+DELETE FROM v_dpkg_dependencies d WHERE {changed_d};
+INSERT INTO v_dpkg_dependencies {v_dpkg_dependencies};
+DELETE FROM v_so_breaks s
+WHERE (s.package, s.repo) IN (SELECT package, repo FROM t_changed);
+DELETE FROM v_so_breaks s
+WHERE (s.dep_package, s.dep_repo) IN (SELECT package, repo FROM t_changed);
+INSERT INTO v_so_breaks {v_so_breaks_sp};
+INSERT INTO v_so_breaks {v_so_breaks_sd};
+DROP TABLE t_changed;
+'''.format(
+    changed_p=changed_cond('p'), changed_d=changed_cond('d'),
+    v_packages_new=SQL_v_packages_new.format(cond=changed_cond('p')),
+    v_dpkg_dependencies=SQL_v_dpkg_dependencies.format(
+        cond=changed_cond('n')),
+    v_so_breaks_sp=SQL_v_so_breaks.format(
+        cond_sd=changed_cond('vp'), cond_pi=changed_cond('vp')),
+    v_so_breaks_sd=SQL_v_so_breaks.format(
+        cond_sd=changed_cond('vd') + ' AND ' + changed_cond('vp', False),
+        cond_pi=changed_cond('pi') + ' AND ' + changed_cond('vp', False)))
+
+# Records the keys of pv_packages changed, and of packages whose 431
+# issues used by v_so_breaks changed. The dependencies and shared objects
+# of a package are only replaced along with its pv_packages row.
+SQL_CHANGED_FUNCTIONS = '''
+CREATE OR REPLACE FUNCTION pv_packages_changed() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    INSERT INTO pv_changed_packages
+    SELECT DISTINCT package, repo FROM old_rows;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO pv_changed_packages
+    SELECT DISTINCT package, repo FROM new_rows;
+  END IF;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION pv_package_issues_changed() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+    INSERT INTO pv_changed_packages
+    SELECT DISTINCT n.package, n.repo FROM new_rows n
+    INNER JOIN old_rows o USING (id)
+    WHERE n.errno=431 AND n.detail IS DISTINCT FROM o.detail;
+  ELSIF TG_OP = 'INSERT' THEN
+    INSERT INTO pv_changed_packages
+    SELECT DISTINCT package, repo FROM new_rows
+    WHERE errno=431 AND detail IS NOT NULL;
+  ELSE
+    INSERT INTO pv_changed_packages
+    SELECT DISTINCT package, repo FROM old_rows
+    WHERE errno=431 AND detail IS NOT NULL;
+  END IF;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
 '''
 
 SQL_v_so_breaks_dep = '''
@@ -95,8 +261,31 @@ LEFT JOIN (
 ) q USING (package, dep_package);
 '''
 
+# Materialized views, with the columns of the unique index that refreshing
+# them concurrently needs
+MATERIALIZED_VIEWS = {
+    'v_so_breaks_dep': ('package', 'dep_package'),
+}
+# Views refreshed without blocking readers, at the cost of a slower refresh
+refresh_concurrently = ()
+
+def refresh_view(cur, name):
+    if name in refresh_concurrently:
+        cur.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY %s' % name)
+    else:
+        cur.execute('REFRESH MATERIALIZED VIEW %s' % name)
+
 def init_db(db):
     cur = db.cursor()
+    # Also used to convert tables below
+    try:
+        cur.execute("SELECT 'comparable_dpkgver'::regproc")
+    except psycopg2.ProgrammingError:
+        db.rollback()
+        sqlfile = os.path.join(os.path.dirname(__file__), 'vercomp.sql')
+        with open(sqlfile, 'r', encoding='utf-8') as f:
+            cur.execute(f.read())
+            db.commit()
     cur.execute('CREATE TABLE IF NOT EXISTS pv_repos ('
                 'name TEXT PRIMARY KEY,' # key: bsp-sunxi-armel/testing
                 'realname TEXT,'     # group key: amd64, bsp-sunxi-armel
@@ -109,7 +298,62 @@ def init_db(db):
                 ')')
     cur.execute('ALTER TABLE pv_repos ADD COLUMN IF NOT EXISTS '
                 'mtime TIMESTAMP WITH TIME ZONE')
+    cur.execute('CREATE TABLE IF NOT EXISTS pv_scan_dirs ('
+                'path TEXT PRIMARY KEY,' # pool/testing/main/a
+                'component TEXT,'    # testing/main, same as pv_repos.path
+                'mtime BIGINT'       # st_mtime_ns when last scanned
+                ')')
+    cur.execute('CREATE TABLE IF NOT EXISTS pv_partitions ('
+                'id SERIAL PRIMARY KEY,'  # pv_packages_1, ...
+                'branch TEXT UNIQUE'
+                ')')
+    # v_packages_new and the tables derived from it were materialized
+    # views of the package tables, which are moved out of the way below
+    cur.execute("SELECT 1 FROM pg_class WHERE relkind='m' "
+                "AND oid=to_regclass('v_packages_new')")
+    if cur.fetchone() is not None:
+        cur.execute('DROP MATERIALIZED VIEW v_packages_new CASCADE')
+    # Package tables were not partitioned or keyed by pkg_id, move them
+    # and their partitions out of the way
+    cur.execute("SELECT c.relkind, a.attname FROM pg_class c "
+                "LEFT JOIN pg_attribute a "
+                "ON a.attrelid=c.oid AND a.attname='pkg_id' "
+                "WHERE c.oid=to_regclass('pv_packages')")
+    row = cur.fetchone()
+    old_tables = []
+    # Dependencies were parsed each time v_dpkg_dependencies was updated
+    cur.execute("SELECT to_regclass('pv_dpkg_dependencies')")
+    parse_dependencies = row is not None and cur.fetchone()[0] is None
+    if row is not None and (row[0] == 'r' or row[1] is None):
+        logger_db.info('Converting package tables...')
+        for table in ('pv_packages', 'pv_package_duplicate'):
+            cur.execute('ALTER TABLE %s ADD COLUMN IF NOT EXISTS '
+                        'scantime INTEGER DEFAULT 0' % table)
+        cur.execute("SELECT relname FROM pg_class WHERE relkind='v' "
+                    "AND relname IN ('pv_package_dependencies', "
+                    "'pv_package_sodep', 'pv_package_files')")
+        for view, in cur.fetchall():
+            cur.execute('DROP VIEW %s' % view)
+        cur.execute("SELECT c.relname FROM pg_class c WHERE c.relkind IN "
+                    "('r', 'p') AND c.relname IN (%s)" % ', '.join(
+                        "'%s'" % table for table in ('pv_packages',
+                        'pv_package_duplicate', 'pv_package_dependencies',
+                        'pv_package_sodep', 'pv_files', 'pv_package_files')))
+        old_tables = [row[0] for row in cur.fetchall()]
+        cur.execute("WITH RECURSIVE t(oid) AS ("
+            "SELECT oid FROM pg_class WHERE relname = ANY(%s) "
+            "UNION SELECT i.inhrelid FROM pg_inherits i "
+            "INNER JOIN t ON t.oid=i.inhparent) "
+            "SELECT 'TABLE', c.relname FROM t "
+            "INNER JOIN pg_class c ON c.oid=t.oid "
+            "UNION ALL SELECT 'INDEX', c.relname FROM t "
+            "INNER JOIN pg_index x ON x.indrelid=t.oid "
+            "INNER JOIN pg_class c ON c.oid=x.indexrelid", (old_tables,))
+        for kind, name in cur.fetchall():
+            cur.execute('ALTER %s %s RENAME TO %s_old' % (kind, name, name))
+        cur.execute('DELETE FROM pv_partitions')
     cur.execute('CREATE TABLE IF NOT EXISTS pv_packages ('
+                'pkg_id BIGSERIAL,'
                 'package TEXT,'
                 'version TEXT,'
                 'repo TEXT,'
@@ -124,13 +368,17 @@ def init_db(db):
                 'maintainer TEXT,'
                 'description TEXT,'
                 '_vercomp TEXT,'
-                'PRIMARY KEY (package, version, repo),'
+                'scantime INTEGER DEFAULT 0,'  # NULL: files not scanned yet
+                'branch TEXT,'
+                'PRIMARY KEY (package, version, repo, branch),'
+                'UNIQUE (pkg_id, branch),'
                 'CONSTRAINT fkey_repo FOREIGN KEY (repo)'
                 'REFERENCES pv_repos (name) ON DELETE CASCADE INITIALLY DEFERRED'
-                ')')
+                ') PARTITION BY LIST (branch)')
     cur.execute('UPDATE pv_repos r SET mtime=(SELECT to_timestamp(max(mtime)) '
                 'FROM pv_packages p WHERE p.repo=r.name) WHERE mtime IS NULL')
     cur.execute('CREATE TABLE IF NOT EXISTS pv_package_duplicate ('
+                'pkg_id BIGINT,'  # of the package in pv_packages
                 'package TEXT,'
                 'version TEXT,'
                 'repo TEXT,'
@@ -145,48 +393,131 @@ def init_db(db):
                 'maintainer TEXT,'
                 'description TEXT,'
                 '_vercomp TEXT,'
-                'PRIMARY KEY (filename),'
-                'CONSTRAINT fkey_package FOREIGN KEY (package, version, repo)'
-                'REFERENCES pv_packages (package, version, repo) ON DELETE CASCADE INITIALLY DEFERRED'
-                ')')
-    cur.execute('CREATE TABLE IF NOT EXISTS pv_package_dependencies ('
-                'package TEXT,'
-                'version TEXT,'
-                'repo TEXT,'
+                'scantime INTEGER DEFAULT 0,'
+                'branch TEXT,'
+                'PRIMARY KEY (filename, branch),'
+                'CONSTRAINT fkey_package FOREIGN KEY (pkg_id, branch)'
+                'REFERENCES pv_packages (pkg_id, branch) ON DELETE CASCADE INITIALLY DEFERRED'
+                ') PARTITION BY LIST (branch)')
+    cur.execute('CREATE TABLE IF NOT EXISTS pv_dependencies ('
+                'pkg_id BIGINT,'
                 'relationship TEXT,'
                 'value TEXT,'
-                'PRIMARY KEY (package, version, repo, relationship),'
-                'CONSTRAINT fkey_package FOREIGN KEY (package, version, repo)'
-                'REFERENCES pv_packages (package, version, repo) ON DELETE CASCADE INITIALLY DEFERRED'
-                ')')
-    cur.execute('CREATE TABLE IF NOT EXISTS pv_package_sodep ('
-                'package TEXT,'
-                'version TEXT,'
-                'repo TEXT,'
+                'branch TEXT,'
+                'PRIMARY KEY (pkg_id, relationship, branch),'
+                'CONSTRAINT fkey_package FOREIGN KEY (pkg_id, branch)'
+                'REFERENCES pv_packages (pkg_id, branch) ON DELETE CASCADE INITIALLY DEFERRED'
+                ') PARTITION BY LIST (branch)')
+    # Dependencies split into their alternatives, one row each
+    cur.execute('CREATE TABLE IF NOT EXISTS pv_dpkg_dependencies ('
+                'pkg_id BIGINT,'
+                'relationship TEXT,'
+                'nr BIGINT,'        # position of the item, from 1
+                'deppkg TEXT,'
+                'deparch TEXT,'
+                'relop TEXT,'       # <<, <=, =, >=, >>
+                'depver TEXT,'
+                'depvercomp TEXT,'  # comparable_dpkgver(depver)
+                'branch TEXT,'
+                'CONSTRAINT fkey_package FOREIGN KEY (pkg_id, branch)'
+                'REFERENCES pv_packages (pkg_id, branch) ON DELETE CASCADE INITIALLY DEFERRED'
+                ') PARTITION BY LIST (branch)')
+    cur.execute('CREATE TABLE IF NOT EXISTS pv_sodep ('
+                'pkg_id BIGINT,'
                 'depends INTEGER,' # 0 provides, 1 depends
                 'name TEXT,'
                 'ver TEXT,'
-                'CONSTRAINT fkey_package FOREIGN KEY (package, version, repo)'
-                'REFERENCES pv_packages (package, version, repo) ON DELETE CASCADE INITIALLY DEFERRED' 
-                # 'PRIMARY KEY (package, version, repo, depends, name)'
+                'branch TEXT,'
+                'CONSTRAINT fkey_package FOREIGN KEY (pkg_id, branch)'
+                'REFERENCES pv_packages (pkg_id, branch) ON DELETE CASCADE INITIALLY DEFERRED'
+                # 'PRIMARY KEY (pkg_id, depends, name)'
+                ') PARTITION BY LIST (branch)')
+    # Directories and owner names of files, each stored once
+    cur.execute('CREATE TABLE IF NOT EXISTS pv_paths ('
+                'id SERIAL PRIMARY KEY,'
+                'path TEXT UNIQUE'   # usr/share/doc
                 ')')
-    cur.execute('CREATE TABLE IF NOT EXISTS pv_package_files ('
-                'package TEXT,'
-                'version TEXT,'
-                'repo TEXT,'
-                'path TEXT,'
+    cur.execute('CREATE TABLE IF NOT EXISTS pv_owners ('
+                'id SERIAL PRIMARY KEY,'
+                'name TEXT UNIQUE'   # root
+                ')')
+    cur.execute('CREATE TABLE IF NOT EXISTS pv_files ('
+                'pkg_id BIGINT,'
+                'path_id INTEGER,'  # pv_paths
                 'name TEXT,'
                 'size BIGINT,'
                 'ftype TEXT,'
                 'perm INTEGER,'
                 'uid BIGINT,'
                 'gid BIGINT,'
-                'uname TEXT,'
-                'gname TEXT,'
-                'CONSTRAINT fkey_package FOREIGN KEY (package, version, repo)'
-                'REFERENCES pv_packages (package, version, repo) ON DELETE CASCADE INITIALLY DEFERRED'
-                # 'PRIMARY KEY (package, version, repo, path, name)'
-                ')')
+                'uname_id INTEGER,' # pv_owners
+                'gname_id INTEGER,' # pv_owners
+                'branch TEXT,'
+                'CONSTRAINT fkey_package FOREIGN KEY (pkg_id, branch)'
+                'REFERENCES pv_packages (pkg_id, branch) ON DELETE CASCADE INITIALLY DEFERRED'
+                # 'PRIMARY KEY (pkg_id, path_id, name)'
+                ') PARTITION BY LIST (branch)')
+    # For branches without partitions, see init_branches()
+    for table in PARTITIONED_TABLES:
+        cur.execute('CREATE TABLE IF NOT EXISTS %s_default '
+                    'PARTITION OF %s DEFAULT' % (table, table))
+    # Tables added since a branch was partitioned
+    cur.execute('SELECT id, branch FROM pv_partitions')
+    for part_id, branch in cur.fetchall():
+        for table in PARTITIONED_TABLES:
+            cur.execute('CREATE TABLE IF NOT EXISTS %s_%d PARTITION OF %s '
+                        'FOR VALUES IN (%%s)' % (table, part_id, table),
+                        (branch,))
+    if old_tables:
+        cur.execute('SELECT DISTINCT branch FROM pv_repos')
+        init_branches(cur, [row[0] for row in cur.fetchall()])
+        columns = ', '.join(PACKAGE_COLUMNS[:-1])
+        cur.execute('INSERT INTO pv_packages (%s, branch) '
+                    'SELECT %s, r.branch FROM pv_packages_old o '
+                    'INNER JOIN pv_repos r ON r.name=o.repo' % (
+                        columns, ', '.join(
+                            'o.' + k for k in PACKAGE_COLUMNS[:-1])))
+        cur.execute('INSERT INTO pv_package_duplicate (pkg_id, %s, branch) '
+                    'SELECT p.pkg_id, %s, p.branch '
+                    'FROM pv_package_duplicate_old o INNER JOIN pv_packages p '
+                    'USING (package, version, repo)' % (columns, ', '.join(
+                        k if k in ('package', 'version', 'repo') else 'o.' + k
+                        for k in PACKAGE_COLUMNS[:-1])))
+        cur.execute(SQL_CONVERT_DEPENDENCIES)
+        cur.execute(SQL_CONVERT_SODEP)
+        if 'pv_files' in old_tables:
+            cur.execute(SQL_CONVERT_FILES)
+        else:
+            logger_db.info('Moving pv_package_files to pv_files...')
+            cur.execute(SQL_CONVERT_PACKAGE_FILES)
+    if parse_dependencies:
+        logger_db.info('Parsing package dependencies...')
+        cur.execute(SQL_CONVERT_DPKG_DEPENDENCIES)
+    if old_tables or parse_dependencies:
+        # Check the copied rows now, indexes can't be added with checks due
+        cur.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    if old_tables:
+        cur.execute('DROP TABLE %s' % ', '.join(
+            table + '_old' for table in old_tables))
+    # Directories and owner names were not referenced with foreign keys, so
+    # gc could remove them while a scan was adding files in them
+    cur.execute("SELECT conname FROM pg_constraint "
+                "WHERE conrelid='pv_files'::regclass")
+    constraints = set(row[0] for row in cur)
+    for column, table in (('path_id', 'pv_paths'), ('uname_id', 'pv_owners'),
+                          ('gname_id', 'pv_owners')):
+        name = 'fkey_' + column[:-3]
+        if name in constraints:
+            continue
+        cur.execute('UPDATE pv_files f SET {0}=NULL WHERE {0} IS NOT NULL '
+                    'AND NOT EXISTS (SELECT 1 FROM {1} t WHERE t.id=f.{0})'
+                    .format(column, table))
+        if cur.rowcount:
+            logger_db.warning('%d files referred to missing rows of %s',
+                              cur.rowcount, table)
+        cur.execute('ALTER TABLE pv_files ADD CONSTRAINT %s FOREIGN KEY (%s) '
+                    'REFERENCES %s (id)' % (name, column, table))
+    cur.execute(SQL_PACKAGE_VIEWS)
     cur.execute('CREATE TABLE IF NOT EXISTS pv_package_issues ('
                 'id SERIAL PRIMARY KEY,'
                 'package TEXT,'
@@ -208,21 +539,48 @@ def init_db(db):
                 'total INTEGER,'
                 'updated TIMESTAMP WITH TIME ZONE DEFAULT (now())'
                 ')')
-    cur.execute('CREATE MATERIALIZED VIEW IF NOT EXISTS v_packages_new AS '
-                'SELECT DISTINCT ON (repo, package) package, version, repo, '
-                '  architecture, filename, size, sha256, mtime, debtime, '
-                '  section, installed_size, maintainer, description, _vercomp '
-                'FROM pv_packages '
-                'WHERE debtime IS NOT NULL '
-                'ORDER BY repo, package, _vercomp DESC')
+    cur.execute('CREATE TABLE IF NOT EXISTS pv_changed_packages ('
+                'package TEXT,'
+                'repo TEXT'
+                ')')
+    cur.execute(SQL_CHANGED_FUNCTIONS)
+    cur.execute("SELECT tgname FROM pg_trigger WHERE tgrelid IN "
+                "('pv_packages'::regclass, 'pv_package_issues'::regclass)")
+    triggers = set(row[0] for row in cur)
+    for table in ('pv_packages', 'pv_package_issues'):
+        for event, tables in (
+            ('INSERT', 'NEW TABLE AS new_rows'),
+            ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+            ('DELETE', 'OLD TABLE AS old_rows')):
+            name = '%s_changed_%s' % (table, event.lower())
+            if name in triggers:
+                continue
+            cur.execute('CREATE TRIGGER %s AFTER %s ON %s REFERENCING %s '
+                        'FOR EACH STATEMENT EXECUTE PROCEDURE %s_changed()'
+                        % (name, event, table, tables, table))
+    # v_packages_new had no pkg_id
+    cur.execute("SELECT c.relkind, a.attname FROM pg_class c "
+                "LEFT JOIN pg_attribute a "
+                "ON a.attrelid=c.oid AND a.attname='pkg_id' "
+                "WHERE c.oid=to_regclass('v_packages_new')")
+    row = cur.fetchone()
+    if row is None or row[1] is None:
+        if row is not None:
+            cur.execute('DROP TABLE v_packages_new')
+        cur.execute('CREATE TABLE v_packages_new AS %s WITH NO DATA'
+                    % SQL_v_packages_new.format(cond='TRUE'))
+        cur.execute('INSERT INTO pv_changed_packages '
+                    'SELECT DISTINCT package, repo FROM pv_packages')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_repos_path'
                 ' ON pv_repos (path, architecture)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_repos_architecture'
                 ' ON pv_repos (architecture, testing)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_scan_dirs_component'
+                ' ON pv_scan_dirs (component)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_packages_repo'
                 ' ON pv_packages (repo)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_package_duplicate_package'
-                ' ON pv_package_duplicate (package, version, repo)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_package_duplicate_pkg_id'
+                ' ON pv_package_duplicate (pkg_id)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_package_issues_errno'
                 ' ON pv_package_issues (errno)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_package_issues_mtime'
@@ -232,44 +590,107 @@ def init_db(db):
     cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_pv_issues_stats_pkey'
                 ' ON pv_issues_stats (repo, errno, updated DESC)')
     db.commit()
-    try:
-        cur.execute("SELECT 'comparable_dpkgver'::regproc")
-    except psycopg2.ProgrammingError:
-        db.rollback()
-        sqlfile = os.path.join(os.path.dirname(__file__), 'vercomp.sql')
-        with open(sqlfile, 'r', encoding='utf-8') as f:
-            cur.execute(f.read())
-            db.commit()
     cur.close()
 
+def init_branches(cur, branches):
+    """ Create the partitions of the branches that have none yet. """
+    cur.execute('SELECT branch FROM pv_partitions')
+    known = set(row[0] for row in cur)
+    for branch in branches:
+        if branch in known:
+            continue
+        # Partitions can't be added while their rows are in the default one
+        cur.execute('SELECT 1 FROM pv_packages_default WHERE branch=%s '
+                    'LIMIT 1', (branch,))
+        if cur.fetchone() is not None:
+            logger_db.warning('Packages of branch %s are in the default '
+                              'partitions', branch)
+            continue
+        cur.execute('INSERT INTO pv_partitions (branch) VALUES (%s) '
+                    'RETURNING id', (branch,))
+        part_id = cur.fetchone()[0]
+        for table in PARTITIONED_TABLES:
+            cur.execute('CREATE TABLE %s_%d PARTITION OF %s FOR VALUES IN (%%s)'
+                        % (table, part_id, table), (branch,))
+
+def drop_branch(cur, branch):
+    """ Drop the partitions of branch with all its packages. Returns
+        False if the branch has no partitions.
+    """
+    cur.execute('SELECT id FROM pv_partitions WHERE branch=%s', (branch,))
+    row = cur.fetchone()
+    if row is None:
+        return False
+    part_id = row[0]
+    # Dropping tables does not run the triggers
+    cur.execute('INSERT INTO pv_changed_packages '
+                'SELECT DISTINCT package, repo FROM pv_packages_%d' % part_id)
+    for table in reversed(PARTITIONED_TABLES):
+        cur.execute('ALTER TABLE %s DETACH PARTITION %s_%d'
+                    % (table, table, part_id))
+        cur.execute('DROP TABLE %s_%d' % (table, part_id))
+    cur.execute('DELETE FROM pv_partitions WHERE id=%s', (part_id,))
+    return True
+
+def update_derived(cur):
+    """ Update v_packages_new, v_dpkg_dependencies and v_so_breaks for the
+        packages changed since the last time. Returns how many (package,
+        repo) were changed.
+    """
+    # Readers are not blocked, but another update is
+    cur.execute('LOCK TABLE v_packages_new IN SHARE ROW EXCLUSIVE MODE')
+    cur.execute('CREATE TEMP TABLE t_changed (package TEXT, repo TEXT)')
+    cur.execute('WITH d AS (DELETE FROM pv_changed_packages '
+                'RETURNING package, repo) '
+                'INSERT INTO t_changed SELECT DISTINCT package, repo FROM d')
+    changed = cur.rowcount
+    if not changed:
+        cur.execute('DROP TABLE t_changed')
+        return 0
+    cur.execute('ANALYZE t_changed')
+    cur.execute(SQL_UPDATE_DERIVED)
+    return changed
+
 def init_index(db, refresh=True):
+    """ Create the indices and derived tables, and bring the latter up to
+        date. v_so_breaks_dep is only refreshed if anything changed, or
+        if refresh.
+    """
     cur = db.cursor()
-    cur.execute(SQL_v_dpkg_dependencies)
-    cur.execute(SQL_v_so_breaks)
+    cur.execute('CREATE TABLE IF NOT EXISTS v_dpkg_dependencies AS %s '
+                'WITH NO DATA' % SQL_v_dpkg_dependencies.format(cond='TRUE'))
+    cur.execute('CREATE TABLE IF NOT EXISTS v_so_breaks AS %s WITH NO DATA'
+                % SQL_v_so_breaks.format(cond_sd='TRUE', cond_pi='TRUE'))
     cur.execute(SQL_v_so_breaks_dep)
+    for name, columns in MATERIALIZED_VIEWS.items():
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_%s_pkey ON %s (%s)'
+                    % (name, name, ', '.join(columns)))
     cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_repos_mtime'
                 ' ON pv_repos (mtime)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_packages_mtime'
                 ' ON pv_packages (mtime)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_package_sodep_package'
-                ' ON pv_package_sodep (package, version, repo)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_package_sodep_name'
-                ' ON pv_package_sodep (name, repo) WHERE depends=0')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_package_files_package'
-                ' ON pv_package_files (package, version, repo)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_package_files_path'
-                ' ON pv_package_files (path)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_package_files_name'
-                ' ON pv_package_files (name)')
-    if refresh:
-        cur.execute('REFRESH MATERIALIZED VIEW v_packages_new')
-        cur.execute('REFRESH MATERIALIZED VIEW v_dpkg_dependencies')
-        cur.execute('REFRESH MATERIALIZED VIEW v_so_breaks')
-        cur.execute('REFRESH MATERIALIZED VIEW v_so_breaks_dep')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_packages_scantime'
+                ' ON pv_packages (scantime)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_dpkg_dependencies_pkg_id'
+                ' ON pv_dpkg_dependencies (pkg_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_sodep_pkg_id'
+                ' ON pv_sodep (pkg_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_sodep_name'
+                ' ON pv_sodep (name) WHERE depends=0')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_files_pkg_id'
+                ' ON pv_files (pkg_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_files_path'
+                ' ON pv_files (path_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_pv_files_name'
+                ' ON pv_files (name)')
+    if update_derived(cur) or refresh:
+        refresh_view(cur, 'v_so_breaks_dep')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_v_packages_new_package'
                 ' ON v_packages_new (package, repo, version)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_v_packages_new_mtime'
                 ' ON v_packages_new (mtime)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_v_packages_new_pkg_id'
+                ' ON v_packages_new (pkg_id)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_v_dpkg_dependencies_package'
                 ' ON v_dpkg_dependencies (package, version, repo)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_v_dpkg_dependencies_dep'
@@ -283,9 +704,12 @@ def init_index(db, refresh=True):
     db.commit()
     cur.close()
 
-TABLES_PV = ('pv_package_dependencies', 'pv_package_duplicate',
-    'pv_package_files', 'pv_package_sodep', 'pv_packages', 'pv_repos',
-    'pv_package_issues')
+TABLES_PV = ('pv_dependencies', 'pv_dpkg_dependencies',
+    'pv_package_duplicate', 'pv_files', 'pv_paths', 'pv_owners', 'pv_sodep',
+    'pv_packages',
+    'pv_partitions', 'pv_repos', 'pv_package_issues', 'pv_scan_dirs',
+    'pv_changed_packages',
+    'v_packages_new', 'v_dpkg_dependencies', 'v_so_breaks')
 
 TABLES_PKGS = ('pv_dbsync', 'trees', 'tree_branches', 'packages',
     'package_duplicate', 'package_versions', 'package_spec',
@@ -313,9 +737,15 @@ def analyze_issues(db, full=False):
     if full:
         cur.execute("UPDATE pv_package_issues SET atime='1970-01-01'")
         logger_db.info(cur.statusmessage)
+    cur.execute("SELECT count(*) FROM pv_packages WHERE scantime IS NULL")
+    pending = cur.fetchone()[0]
+    if pending:
+        logger_db.warning('Files of %d packages are not scanned yet, their '
+                          'file and library issues are left for later', pending)
     sqlfile = os.path.join(os.path.dirname(__file__), 'pkgissues.sql')
     with open(sqlfile, 'r', encoding='utf-8') as f:
-        cur.execute(f.read())
+        with internal_stats.timer('analyze'):
+            cur.execute(f.read())
     logger_db.info(cur.statusmessage)
     logger_db.info('Done.')
     db.commit()
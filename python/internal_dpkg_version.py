@@ -1,8 +1,13 @@
 import re
+import functools
+import itertools
 
 _partitions = re.compile(r'^((?P<epoch>[0-9]+):)?(?P<body>[A-Za-z0-9.+~-]+)$')
-_non_digit = re.compile(r'^[A-Za-z.+~-]*')
-_digit = re.compile(r'^[0-9]*')
+_digits = re.compile(r'([0-9]+)')
+# Characters in the order dpkg sorts them, '|' standing for the end
+_non_digit = str.maketrans(
+    '~|ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-.',
+    '0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefgh')
 
 RE_ALL_DIGITS_OR_NOT = re.compile("\d+|\D+")
 RE_DIGITS = re.compile("\d+")
@@ -21,47 +26,26 @@ def _break_down(ver: str):
 
 
 def _comparable_digit(i: str):
-    clean_number = i.lstrip('0')
-    if clean_number == '':
-        clean_number = '0'
-    length = len(clean_number)
-    if not (1 <= length <= 26):
-        raise AssertionError('malformed number string')
-    return chr(ord('0') + (length - 1)) + clean_number
-
-
-def _comparable_non_digit(s: str):
-    # Add '|' to indicate the end of string
-    s = (s + '|').encode('ASCII')
-    table = '~|ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-.'
-
-    def m(n):
-        return ord('0') + table.index(chr(n))
-
-    return bytes(map(m, s)).decode('ASCII')
+    # Numbers of any length, like _comparable_digit() in vercomp.sql
+    clean_number = i.lstrip('0') or '0'
+    return chr(ord('0') + (len(clean_number) - 1)) + clean_number
 
 
 def _comparable_body(body: str):
-    def cut(ver: str, r):
-        result = r.match(ver)
-        if result is not None:
-            return result.group(), ver[len(result.group()):]
-        return '', ver
-
-    output_body = ''
-    while True:
-        sec, body = cut(body, _non_digit)
-        sec = _comparable_non_digit(sec)
-        output_body += sec
-        if body == '':
-            break
-        sec, body = cut(body, _digit)
-        sec = _comparable_digit(sec)
-        output_body += sec
-    return output_body
+    # Non-digit parts, each with '|' at its end, alternate with numbers
+    parts = _digits.split(body)
+    for i in range(0, len(parts), 2):
+        parts[i] = (parts[i] + '|').translate(_non_digit)
+    for i in range(1, len(parts), 2):
+        parts[i] = _comparable_digit(parts[i])
+    return ''.join(parts)
 
 
+@functools.lru_cache(maxsize=65536)
 def comparable_ver(a: str):
+    """ A string sorting like version a, the same as comparable_dpkgver()
+        in vercomp.sql. Results are memoized.
+    """
     epoch_a, uv_a, dr_a = _break_down(a)
     return _comparable_digit(epoch_a) + '!' + _comparable_body(uv_a) + '!' + _comparable_body(dr_a)
 
@@ -77,57 +61,66 @@ def compare_ver(a: str, b: str):
         return -1
 
 
+def version_key(ver: str):
+    """ Sort key of version strings: by comparable_ver(), then as strings,
+        so that only equal strings have equal keys. Malformed versions
+        sort first.
+    """
+    try:
+        return comparable_ver(ver), ver
+    except AssertionError:
+        return '', ver
+
+
+def sort_versions(versions, reverse=False):
+    """ Return a list of versions, from the oldest unless reverse. """
+    return sorted(versions, key=version_key, reverse=reverse)
+
+
+def max_version(versions):
+    """ Return the newest of versions. """
+    return max(versions, key=version_key)
+
+
 cmp = lambda a, b: ((a > b) - (a < b))
 
-def version_compare(a, b):
-    def _order(x):
-        """Return an integer value for character x"""
-        if x == '~':
-            return -1
-        elif RE_DIGITS.match(x):
-            return int(x) + 1
-        elif RE_ALPHA.match(x):
-            return ord(x)
+def _order(x):
+    """Return an integer value for character x"""
+    if x == '~':
+        return -1
+    elif RE_DIGITS.match(x):
+        return int(x) + 1
+    elif RE_ALPHA.match(x):
+        return ord(x)
+    else:
+        return ord(x) + 256
+
+
+def _version_cmp_string(va, vb):
+    for a, b in itertools.zip_longest(map(_order, va), map(_order, vb),
+                                      fillvalue=0):
+        if a != b:
+            return cmp(a, b)
+    return 0
+
+
+def _version_cmp_part(va, vb):
+    for a, b in itertools.zip_longest(RE_ALL_DIGITS_OR_NOT.findall(va),
+                                      RE_ALL_DIGITS_OR_NOT.findall(vb),
+                                      fillvalue="0"):
+        if RE_DIGITS.match(a) and RE_DIGITS.match(b):
+            a = int(a)
+            b = int(b)
+            if a != b:
+                return cmp(a, b)
         else:
-            return ord(x) + 256
-
-    def _version_cmp_string(va, vb):
-        la = [_order(x) for x in va]
-        lb = [_order(x) for x in vb]
-        while la or lb:
-            a = b = 0
-            if la:
-                a = la.pop(0)
-            if lb:
-                b = lb.pop(0)
-            if a < b:
-                return -1
-            elif a > b:
-                return 1
-        return 0
+            res = _version_cmp_string(a, b)
+            if res != 0:
+                return res
+    return 0
 
-    def _version_cmp_part(va, vb):
-        la = RE_ALL_DIGITS_OR_NOT.findall(va)
-        lb = RE_ALL_DIGITS_OR_NOT.findall(vb)
-        while la or lb:
-            a = b = "0"
-            if la:
-                a = la.pop(0)
-            if lb:
-                b = lb.pop(0)
-            if RE_DIGITS.match(a) and RE_DIGITS.match(b):
-                a = int(a)
-                b = int(b)
-                if a < b:
-                    return -1
-                elif a > b:
-                    return 1
-            else:
-                res = _version_cmp_string(a, b)
-                if res != 0:
-                    return res
-        return 0
 
+def version_compare(a, b):
     return _version_cmp_part(a, b) or cmp(a, b)
 
 
@@ -0,0 +1,83 @@
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.inotify_init1.argtypes = (ctypes.c_int,)
+_libc.inotify_add_watch.argtypes = (
+    ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+_libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+
+
+def _check(ret, path=None):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    return ret
+
+
+class Inotify(object):
+    """Minimal inotify(7) binding.
+
+    read() yields (wd, mask, cookie, name) tuples; name is a str, or ''
+    for events on the watched directory itself.
+    """
+
+    def __init__(self):
+        self.fd = _check(_libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK))
+        self.poll = select.poll()
+        self.poll.register(self.fd, select.POLLIN)
+
+    def add_watch(self, path: str, mask: int):
+        return _check(_libc.inotify_add_watch(
+            self.fd, os.fsencode(path), mask), path)
+
+    def rm_watch(self, wd: int):
+        try:
+            _check(_libc.inotify_rm_watch(self.fd, wd))
+        except OSError as ex:
+            # The watch is already gone with its directory
+            if ex.errno != errno.EINVAL:
+                raise
+
+    def read(self, timeout=None):
+        """ Wait up to timeout seconds (forever if None) for events. """
+        if not self.poll.poll(None if timeout is None else timeout * 1000):
+            return []
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(buf[pos:pos+length].rstrip(b'\0'))
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -1,32 +1,213 @@
 import os
-import json
+import queue
+import struct
+import atexit
 import hashlib
 import subprocess
 
 import deb822
+import internal_stats
+
+try:
+    # Built along with pkgscan_cli if the Python headers were found
+    import _pkgscan
+except ImportError:
+    _pkgscan = None
+
+PKGSCAN_CLI = os.path.dirname(__file__) + '/pkgscan_cli'
+
+# See package_to_binary() in pkgscan_cli
+RECORD_LENGTH = struct.Struct('=I')
+RECORD_HEADER = struct.Struct('=i5Iqq32s')
+FILE_ENTRY = struct.Struct('=qqqIIII')
 
 class PkgInfoWrapper(object):
     control = None
     filename = ''
     p = None
+    # False if only control.tar was read: no files or shared objects
+    complete = True
 
-    def __init__(self, p):
+    def __init__(self, p, complete=True):
         self.control = deb822.SortPackages(deb822.Packages(p['control']))
         self.p = p
+        self.complete = complete
+
+
+def _split_strings(buf, pos: int, count: int):
+    """ Read count NUL-terminated strings from buf at pos. """
+    if not count:
+        return [], pos
+    end = pos
+    for _ in range(count):
+        end = buf.index(b'\0', end) + 1
+    strings = buf[pos:end-1].decode('utf-8', 'replace').split('\0')
+    return strings, end
+
+
+def decode_binary(buf):
+    """ Decode a record of `pkgscan_cli --batch --binary`, without the
+        length, into a dict like the JSON output, except that hash_value
+        is bytes and files are
+        (path, size, type, perm, uid, gid, uname, gname) tuples.
+    """
+    (status, control_len, n_owners, n_provides, n_depends, n_files,
+     size, mtime, sha256) = RECORD_HEADER.unpack_from(buf)
+    pos = RECORD_HEADER.size
+    control = buf[pos:pos+control_len].decode('utf-8')
+    pos += control_len
+    owners, pos = _split_strings(buf, pos, n_owners)
+    so_provides, pos = _split_strings(buf, pos, n_provides)
+    so_depends, pos = _split_strings(buf, pos, n_depends)
+    end = pos + n_files * FILE_ENTRY.size
+    # The paths fill the rest of the record
+    paths = buf[end:-1].decode('utf-8', 'replace').split('\0')
+    files = [
+        (path, fsize, ftype, perm, uid, gid, owners[uname], owners[gname])
+        for path, (fsize, uid, gid, ftype, perm, uname, gname) in zip(
+            paths, FILE_ENTRY.iter_unpack(buf[pos:end]))
+    ]
+    return {
+        'size': size,
+        'hash_alg': 'SHA256',
+        'hash_value': sha256,
+        'control': control,
+        'time': mtime,
+        'so_provides': so_provides,
+        'so_depends': so_depends,
+        'files': files,
+    }
+
+
+class ScanWorker(object):
+    """A long-lived `pkgscan_cli --batch --binary` process.
+
+    NUL-terminated paths are written to its stdin and exactly one record
+    is read back per path.
+    """
+
+    def __init__(self, control_only=False):
+        self.cmd = [PKGSCAN_CLI, '--batch', '--binary']
+        if control_only:
+            self.cmd.append('--control-only')
+        self.proc = subprocess.Popen(
+            self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+
+    def _read(self, size: int):
+        buf = self.proc.stdout.read(size)
+        if len(buf) != size:
+            raise EOFError
+        return buf
+
+    def scan(self, path: str):
+        try:
+            self.proc.stdin.write(os.fsencode(path) + b'\0')
+            self.proc.stdin.flush()
+            length, = RECORD_LENGTH.unpack(self._read(RECORD_LENGTH.size))
+            buf = self._read(length)
+        except (BrokenPipeError, EOFError):
+            # The worker died on this package, report it like a failed
+            # one-shot run so callers can tell it from a corrupted archive.
+            raise subprocess.CalledProcessError(
+                self.proc.wait(), self.cmd + [path])
+        status, = struct.unpack_from('=i', buf)
+        if status:
+            raise subprocess.CalledProcessError(status, self.cmd + [path])
+        return buf
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+# A ScanCache from internal_scancache, if scan results are cached
+cache = None
+
+# Idle workers, by control_only. The pool grows to the number of threads
+# scanning at the same time and is kept until close_workers() is called.
+_workers = {False: queue.LifoQueue(), True: queue.LifoQueue()}
+
+
+def close_workers():
+    for workers in _workers.values():
+        while True:
+            try:
+                worker = workers.get_nowait()
+            except queue.Empty:
+                break
+            worker.close()
+
+atexit.register(close_workers)
+
+
+def _forget_workers():
+    # Workers of the parent can't be shared with a forked child
+    global _workers
+    _workers = {False: queue.LifoQueue(), True: queue.LifoQueue()}
+
+os.register_at_fork(after_in_child=_forget_workers)
+
+
+def scan_raw(path: str, control_only=False):
+    if _pkgscan is not None:
+        # In this thread, without the GIL while the package is read
+        buf = _pkgscan.scan(path, control_only)
+        status, = struct.unpack_from('=i', buf)
+        if status:
+            raise subprocess.CalledProcessError(status, [PKGSCAN_CLI, path])
+        return buf
+    workers = _workers[control_only]
+    try:
+        worker = workers.get_nowait()
+    except queue.Empty:
+        worker = ScanWorker(control_only)
+    try:
+        return worker.scan(path)
+    finally:
+        if worker.alive():
+            workers.put(worker)
+        else:
+            worker.close()
+
+
+def scan(path: str, control_only=False):
+    """ Scan path. With control_only, data.tar is not read unless the
+        complete record is cached; check complete of the result.
+    """
+    complete = True
+    with internal_stats.local_timer('extract'):
+        if cache is None:
+            buf = scan_raw(path, control_only)
+            complete = not control_only
+        elif control_only:
+            # Partial records are not cached
+            buf = cache.lookup(path)
+            if buf is None:
+                buf = scan_raw(path, True)
+                complete = False
+        else:
+            buf = cache.scan_raw(path, scan_raw)
+    with internal_stats.local_timer('decode'):
+        return PkgInfoWrapper(decode_binary(buf), complete)
 
 
-def scan(path: str):
-    result = subprocess.check_output(
-        [os.path.dirname(__file__) + '/pkgscan_cli', path],
-        stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return PkgInfoWrapper(json.loads(result.decode('utf-8')))
+HASH_BLOCK_SIZE = 1024 * 1024
 
 
 def size_sha256_fp(f):
     result = hashlib.new('sha256')
     size = 0
     while True:
-        block = f.read(8192)
+        # hashlib releases the GIL while hashing large blocks
+        block = f.read(HASH_BLOCK_SIZE)
         if not block:
             break
         size += len(block)
@@ -36,4 +217,7 @@ def size_sha256_fp(f):
 
 def sha256_file(path: str):
     with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+
+            return hashlib.file_digest(f, 'sha256').hexdigest()
         return size_sha256_fp(f)[1]
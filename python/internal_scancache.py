@@ -0,0 +1,158 @@
+import os
+import time
+import zlib
+import sqlite3
+import binascii
+import threading
+
+import internal_pkgscan
+
+# Bump when the records from pkgscan_cli change meaning
+CACHE_VERSION = 1
+
+
+class ScanCache(object):
+    """Scan results of pkgscan_cli on disk, to survive the database.
+
+    Records are stored zlib-compressed under the sha256 of the deb, and
+    an sqlite index maps (device, inode, size, mtime) to the sha256, so
+    an unchanged file is neither scanned nor read. A file whose entry is
+    stale is hashed and looked up by content, which still saves the scan
+    of a file touched or rewritten with the same content. A file not in
+    the index is scanned right away, as hashing it would read it twice.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.join(path, 'v%d' % CACHE_VERSION)
+        self.lock = threading.Lock()
+        self.db = None
+        self.pid = None
+
+    def _index(self):
+        # Connections can't be used across fork()
+        if self.pid != os.getpid():
+            os.makedirs(self.path, exist_ok=True)
+            self.db = sqlite3.connect(
+                os.path.join(self.path, 'index.sqlite'), timeout=60,
+                isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                "dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, "
+                "sha256 TEXT, PRIMARY KEY (dev, ino))")
+            self.pid = os.getpid()
+        return self.db
+
+    def _object(self, sha256: str):
+        return os.path.join(self.path, sha256[:2], sha256[2:])
+
+    def _load(self, sha256: str):
+        try:
+            with open(self._object(sha256), 'rb') as f:
+                buf = zlib.decompress(f.read())
+        except (FileNotFoundError, zlib.error):
+            return None
+        # A truncated or foreign object is a miss
+        try:
+            record_sha256 = internal_pkgscan.RECORD_HEADER.unpack_from(buf)[-1]
+        except Exception:
+            return None
+        if binascii.b2a_hex(record_sha256).decode('ascii') != sha256:
+            return None
+        return buf
+
+    def _store(self, sha256: str, buf):
+        path = self._object(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(zlib.compress(buf))
+        os.replace(tmp, path)
+
+    def _set_index(self, st, sha256: str):
+        with self.lock:
+            self._index().execute(
+                "INSERT OR REPLACE INTO files VALUES (?,?,?,?,?)",
+                (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, sha256))
+
+    def _lookup(self, path: str, st):
+        with self.lock:
+            row = self._index().execute(
+                "SELECT size, mtime, sha256 FROM files WHERE dev=? AND ino=?",
+                (st.st_dev, st.st_ino)).fetchone()
+        if row is None:
+            return None, None
+        if row[:2] == (st.st_size, st.st_mtime_ns):
+            return self._load(row[2]), row[2]
+        sha256 = internal_pkgscan.sha256_file(path)
+        buf = self._load(sha256)
+        if buf is not None:
+            self._set_index(st, sha256)
+        return buf, sha256
+
+    def lookup(self, path: str):
+        """ Return the record of path, or None if it is not cached. """
+        return self._lookup(path, os.stat(path))[0]
+
+    def scan_raw(self, path: str, scan_raw):
+        """ Return the record of path, calling scan_raw(path) on a miss. """
+        st = os.stat(path)
+        buf, sha256 = self._lookup(path, st)
+        if buf is None:
+            buf = scan_raw(path)
+            sha256 = binascii.b2a_hex(
+                internal_pkgscan.RECORD_HEADER.unpack_from(buf)[-1]
+            ).decode('ascii')
+            self._store(sha256, buf)
+            self._set_index(st, sha256)
+        return buf
+
+    def prune(self, pool_dir: str):
+        """ Remove the entries of files no longer in pool_dir and the records
+            no entry refers to. Return the number of removed records.
+        """
+        started = time.time()
+        live = set()
+        for root, dirs, files in os.walk(pool_dir):
+            for name in files:
+                if not name.endswith('.deb'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                live.add((st.st_dev, st.st_ino))
+        with self.lock:
+            db = self._index()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("CREATE TEMP TABLE IF NOT EXISTS live ("
+                           "dev INTEGER, ino INTEGER, PRIMARY KEY (dev, ino))")
+                db.execute("DELETE FROM live")
+                db.executemany("INSERT OR IGNORE INTO live VALUES (?,?)", live)
+                db.execute("DELETE FROM files WHERE NOT EXISTS (SELECT 1 "
+                           "FROM live l WHERE l.dev=files.dev AND l.ino=files.ino)")
+                db.execute("DELETE FROM live")
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            used = set(sha256 for sha256, in
+                       db.execute("SELECT DISTINCT sha256 FROM files"))
+        removed = 0
+        for prefix in os.listdir(self.path):
+            subdir = os.path.join(self.path, prefix)
+            if len(prefix) != 2 or not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                path = os.path.join(subdir, name)
+                if prefix + name in used:
+                    continue
+                try:
+                    # Records stored since the walk may be of files it missed
+                    if os.stat(path).st_mtime < started:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+# Where to write the report of a run, %ACTION% is replaced by the action
+report_path = None
+textfile_path = None
+
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_local = threading.local()
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+def add_time(name: str, seconds: float, calls=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        timer = _timers.setdefault(key, [0, 0.0])
+        timer[0] += calls
+        timer[1] += seconds
+
+
+def count(name: str, n=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+
+@contextlib.contextmanager
+def timer(name: str, **labels):
+    """ Time the with block as stage name. Stages may nest. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start, **labels)
+
+
+@contextlib.contextmanager
+def local_timer(name: str):
+    """ Like timer(), but only kept for local_take() in this thread.
+        For work in worker threads or processes that does not know its
+        labels, e.g. which component a package belongs to.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        times = getattr(_local, 'times', None)
+        if times is None:
+            times = _local.times = {}
+        times[name] = times.get(name, 0.0) + time.perf_counter() - start
+
+
+def local_take():
+    """ Return and reset the local_timer() times of this thread. """
+    times = getattr(_local, 'times', None) or {}
+    _local.times = {}
+    return times
+
+
+def stage_totals():
+    """ Return {stage: (calls, seconds)} of the timers so far, summed over
+        their labels.
+    """
+    totals = {}
+    with _lock:
+        for (name, labels), (calls, seconds) in _timers.items():
+            total = totals.get(name, (0, 0.0))
+            totals[name] = (total[0] + calls, total[1] + seconds)
+    return totals
+
+
+def reset():
+    """ Forget the times and counts so far, e.g. between runs in a process. """
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def report(action: str, started: float, success: bool):
+    return {
+        'action': action,
+        'start': started,
+        'duration': time.time() - started,
+        'success': success,
+        'timers': [{'stage': name, 'labels': dict(labels), 'calls': calls,
+                    'seconds': seconds}
+                   for (name, labels), (calls, seconds) in sorted(_timers.items())],
+        'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                     for (name, labels), value in sorted(_counters.items())],
+    }
+
+
+def _prom_labels(labels):
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+def prometheus(result: dict):
+    """ Format a report() in the Prometheus text exposition format. """
+    action = (('action', result['action']),)
+    lines = [
+        '# HELP pvector_last_run_timestamp_seconds Start time of the last run.',
+        '# TYPE pvector_last_run_timestamp_seconds gauge',
+        'pvector_last_run_timestamp_seconds%s %f' % (
+            _prom_labels(action), result['start']),
+        '# HELP pvector_last_run_duration_seconds Duration of the last run.',
+        '# TYPE pvector_last_run_duration_seconds gauge',
+        'pvector_last_run_duration_seconds%s %f' % (
+            _prom_labels(action), result['duration']),
+        '# HELP pvector_last_run_success Whether the last run succeeded.',
+        '# TYPE pvector_last_run_success gauge',
+        'pvector_last_run_success%s %d' % (
+            _prom_labels(action), result['success']),
+        '# HELP pvector_stage_seconds Time spent in each stage in the last run.',
+        '# TYPE pvector_stage_seconds gauge',
+    ]
+    for timer in result['timers']:
+        labels = action + (('stage', timer['stage']),) + tuple(
+            sorted(timer['labels'].items()))
+        lines.append('pvector_stage_seconds%s %f' % (
+            _prom_labels(labels), timer['seconds']))
+    lines += [
+        '# HELP pvector_stage_calls Times each stage was entered in the last run.',
+        '# TYPE pvector_stage_calls gauge',
+    ]
+    for timer in result['timers']:
+        labels = action + (('stage', timer['stage']),) + tuple(
+            sorted(timer['labels'].items()))
+        lines.append('pvector_stage_calls%s %d' % (
+            _prom_labels(labels), timer['calls']))
+    lines += [
+        '# HELP pvector_count Counters of the last run.',
+        '# TYPE pvector_count gauge',
+    ]
+    for counter in result['counters']:
+        labels = action + (('name', counter['name']),) + tuple(
+            sorted(counter['labels'].items()))
+        lines.append('pvector_count%s %d' % (
+            _prom_labels(labels), counter['value']))
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomic(path: str, text: str):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def write(action: str, started: float, success: bool):
+    """ Write the report of the run to report_path and textfile_path. """
+    if not report_path and not textfile_path:
+        return
+    result = report(action, started, success)
+    if report_path:
+        _write_atomic(report_path.replace('%ACTION%', action),
+                      json.dumps(result, indent=1))
+    if textfile_path:
+        _write_atomic(textfile_path.replace('%ACTION%', action),
+                      prometheus(result))
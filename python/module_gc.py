@@ -5,6 +5,8 @@ from typing import List
 
 import module_config
 import internal_db
+import internal_pkgscan
+import internal_stats
 
 logger_gc = logging.getLogger('GC')
 
@@ -29,9 +31,20 @@ def purge_from_db(db, branch_component: List[str]):
         and shared object information.
     """
     cur = db.cursor()
+    # Branches removed as a whole are dropped with their partitions, which
+    # is much faster than deleting their packages
+    cur.execute("SELECT DISTINCT branch FROM pv_repos WHERE path = ANY(%s)",
+                (branch_component, ))
+    for branch, in cur.fetchall():
+        cur.execute("SELECT 1 FROM pv_repos WHERE branch = %s "
+                    "AND path != ALL(%s) LIMIT 1", (branch, branch_component))
+        if cur.fetchone() is None:
+            logger_gc.info("DROPPING partitions of branch %s", branch)
+            internal_db.drop_branch(cur, branch)
     for i in branch_component:
         logger_gc.info("REMOVING branch %s from database", i)
         cur.execute("DELETE FROM pv_repos WHERE path = %s", (i, ))
+        cur.execute("DELETE FROM pv_scan_dirs WHERE component = %s", (i, ))
     db.commit()
     if branch_component:
         logger_gc.info("Refreshing indices and materialized views")
@@ -39,6 +52,25 @@ def purge_from_db(db, branch_component: List[str]):
     cur.close()
 
 
+def purge_paths(db):
+    """ Remove the directories and owner names that no file refers to any
+        more from pv_paths and pv_owners. Rows locked by a running scan are
+        left for the next time.
+    """
+    cur = db.cursor()
+    cur.execute("DELETE FROM pv_paths WHERE id IN (SELECT id FROM pv_paths p "
+                "WHERE NOT EXISTS (SELECT 1 FROM pv_files f "
+                "WHERE f.path_id=p.id) FOR UPDATE SKIP LOCKED)")
+    internal_stats.count('paths_removed', cur.rowcount)
+    cur.execute("DELETE FROM pv_owners WHERE id IN (SELECT id FROM pv_owners o "
+                "WHERE NOT EXISTS (SELECT 1 FROM pv_files f WHERE f.uname_id=o.id) "
+                "AND NOT EXISTS (SELECT 1 FROM pv_files f WHERE f.gname_id=o.id) "
+                "FOR UPDATE SKIP LOCKED)")
+    internal_stats.count('owners_removed', cur.rowcount)
+    db.commit()
+    cur.close()
+
+
 def run_gc(db, base_dir: str, dry_run: bool):
     repos = module_config.list_seen_repo(db)
     pool_dir = base_dir + '/pool'
@@ -48,10 +80,16 @@ def run_gc(db, base_dir: str, dry_run: bool):
         path = PosixPath(pool_dir).joinpath(i)
         if not path.is_dir():
             to_delete.append(i)
+            internal_stats.count('components_removed')
             logger_gc.info("Branch %s to be removed from the database", i)
 
     if not dry_run:
         purge_from_db(db, to_delete)
+        purge_paths(db)
+        if internal_pkgscan.cache is not None:
+            logger_gc.info("Pruning the scan cache")
+            internal_stats.count('cache_records_removed',
+                                 internal_pkgscan.cache.prune(pool_dir))
         purge_from_dists(base_dir, to_delete)
     else:
         logger_gc.warning("DRY RUN - database is unmodified")
\ No newline at end of file
@@ -1,19 +1,178 @@
+import os
+import json
 import time
+import bisect
+import atexit
+import shutil
+import logging
+import threading
 
 import zmq
 
+logger_ipc = logging.getLogger('IPC')
+
 ctx = zmq.Context()
 zmq_change = 'ipc:///tmp/p-vector-changes'
+# Endpoint answering replay requests, and the log they are answered from
+zmq_replay = None
+change_log = None
+# Changes kept in change_log. Older ones are dropped when it holds twice
+# as many, 0 keeps all.
+change_log_keep = 100000
 publisher = ctx.socket(zmq.PUB)
+# ZeroMQ sockets must not be used by several threads at once
+publisher_lock = threading.Lock()
+
+# Changes sent in one message
+BATCH_SIZE = 100
+# Changes returned for one replay request
+REPLAY_LIMIT = 1000
+
+# Without a change_log, numbering starts over in every run
+_seq = 0
+_changelog = None
+# Changes waiting for the commit of the thread that made them
+_local = threading.local()
+
+
+class ChangeLog(object):
+    """Append-only log of changes, one JSON document per line.
+
+    An offset is kept for every INDEX_STEP lines, so replaying from a
+    sequence number only reads the lines after it. Once the log holds
+    twice keep lines, it is rewritten with the last keep or so of them.
+    """
+    INDEX_STEP = 1000
+
+    def __init__(self, path: str, keep=0):
+        self.path = path
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.index_seq = []
+        self.index_offset = []
+        self.last_seq = 0
+        offset = 0
+        lineno = 0
+        with open(path, 'ab+') as f:
+            f.seek(0)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Cut short by a crash, never published
+                    f.truncate(offset)
+                    break
+                seq = json.loads(line.decode('utf-8'))['seq']
+                if lineno % self.INDEX_STEP == 0:
+                    self.index_seq.append(seq)
+                    self.index_offset.append(offset)
+                self.last_seq = seq
+                offset += len(line)
+                lineno += 1
+        self.lines = lineno
+        self.f = open(path, 'ab')
+
+    def append(self, changes):
+        with self.lock:
+            offset = self.f.tell()
+            for change in changes:
+                line = (json.dumps(change) + '\n').encode('utf-8')
+                if self.lines % self.INDEX_STEP == 0:
+                    self.index_seq.append(change['seq'])
+                    self.index_offset.append(offset)
+                self.f.write(line)
+                offset += len(line)
+                self.lines += 1
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.last_seq = changes[-1]['seq']
+            if self.keep and self.lines >= 2 * self.keep:
+                self._compact()
+
+    def _compact(self):
+        # Drop whole index steps, so the remaining offsets stay indexed
+        step = (self.lines - self.keep) // self.INDEX_STEP
+        if step <= 0:
+            return
+        start = self.index_offset[step]
+        tmp = self.path + '.tmp'
+        with open(self.path, 'rb') as src, open(tmp, 'wb') as dst:
+            src.seek(start)
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp, self.path)
+        self.f.close()
+        self.f = open(self.path, 'ab')
+        self.index_seq = self.index_seq[step:]
+        self.index_offset = [offset - start
+                             for offset in self.index_offset[step:]]
+        self.lines -= step * self.INDEX_STEP
+
+    def read(self, after: int, limit: int):
+        """ Return up to limit changes with a sequence number after after.
+            Changes dropped from the log are skipped.
+        """
+        changes = []
+        # The file may be rewritten by append() otherwise
+        with self.lock, open(self.path, 'rb') as f:
+            i = bisect.bisect_right(self.index_seq, after + 1) - 1
+            f.seek(self.index_offset[i] if i >= 0 else 0)
+            for line in f:
+                if len(changes) >= limit:
+                    break
+                change = json.loads(line.decode('utf-8'))
+                if change['seq'] > after:
+                    changes.append(change)
+        return changes
+
+
+def _replay(frames):
+    """ Answer the replay request in the frames received from a REQ socket. """
+    if len(frames) != 3 or frames[1]:
+        return {'error': 'bad request: not sent from a REQ socket'}
+    try:
+        request = json.loads(frames[2].decode('utf-8'))
+    except ValueError:
+        return {'error': 'bad request: not JSON'}
+    after = request.get('from', 0) if isinstance(request, dict) else None
+    if not isinstance(after, int) or isinstance(after, bool):
+        return {'error': 'bad request: from is not an integer'}
+    return {'changes': _changelog.read(after, REPLAY_LIMIT),
+            'last': _changelog.last_seq}
+
+
+def _serve_replay(sock):
+    while True:
+        frames = sock.recv_multipart()
+        try:
+            reply = _replay(frames)
+        except Exception:
+            logger_ipc.exception('Failed to answer a replay request')
+            reply = {'error': 'internal error'}
+        sock.send_multipart([frames[0], b'', json.dumps(reply).encode('utf-8')])
 
 
 def init():
+    global _changelog, _seq
+    if change_log:
+        _changelog = ChangeLog(change_log, change_log_keep)
+        _seq = _changelog.last_seq
     publisher.bind(zmq_change)
-    time.sleep(1)
+    if zmq_replay and _changelog is not None:
+        sock = ctx.socket(zmq.ROUTER)
+        sock.bind(zmq_replay)
+        threading.Thread(target=_serve_replay, args=(sock,),
+                         daemon=True).start()
+    else:
+        # Give subscribers a chance to connect, as they can't catch up
+        time.sleep(1)
 
 
 def publish_change(comp: str, pkg: str, arch: str, method: str, from_ver: str, to_ver: str):
-    publisher.send_json({
+    """ Queue a change, to be numbered and sent by the next flush(). """
+    if not hasattr(_local, 'pending'):
+        _local.pending = []
+    _local.pending.append({
+        'time': time.time(),
         'comp': comp,
         'pkg': pkg,
         'arch': arch,
@@ -21,3 +180,30 @@ def publish_change(comp: str, pkg: str, arch: str, method: str, from_ver: str, t
         'from_ver': from_ver,
         'to_ver': to_ver,
     })
+
+
+def flush():
+    """ Log and send the changes queued by this thread. Called once they
+        are committed to the database. Changes are numbered here, so that
+        they are logged and sent in the order of their seq.
+    """
+    global _seq
+    pending = getattr(_local, 'pending', None)
+    if not pending:
+        return
+    _local.pending = []
+    with publisher_lock:
+        for i, change in enumerate(pending):
+            _seq += 1
+            pending[i] = dict(seq=_seq, **change)
+        if _changelog is not None:
+            _changelog.append(pending)
+        for i in range(0, len(pending), BATCH_SIZE):
+            publisher.send_json(pending[i:i+BATCH_SIZE])
+
+
+def discard():
+    """ Drop the changes queued by this thread, as they were rolled back. """
+    _local.pending = []
+
+atexit.register(flush)
@@ -7,14 +7,19 @@ from datetime import datetime, timezone, timedelta
 import subprocess
 from pathlib import PosixPath, PurePath
 
+import psycopg2.extensions
+
 import deb822
 import internal_db
+import internal_stats
 from internal_pkgscan import sha256_file, size_sha256_fp
 from module_config import PVConf, BranchesConf
 
 logger_rel = logging.getLogger('REL')
 date_format = '%a, %d %b %Y %H:%M:%S %z'
 valid_until_line_matcher = re.compile("Valid-Until: (?P<timestamp>.+)")
+# Rows fetched at a time by the cursors of stream_cursor()
+itersize = 5000
 
 
 def get_valid_until_from_release(inrel: PosixPath) -> float:
@@ -57,6 +62,7 @@ def generate(db, base_dir: str, conf_common: PVConf, conf_branches: BranchesConf
             # AND On-disk release won't expire in 1 day
             if not db_mtime or inrel_mtime > db_mtime and inrel_sec_to_expire > expire_renewal_period:
                 shutil.copytree(realbranchdir, os.path.join(dist_dir, branch_name))
+                internal_stats.count('branches_skipped')
                 logger_rel.info('Skip generating Packages and Contents for %s', branch_name)
                 continue
         component_name_list = []
@@ -65,21 +71,34 @@ def generate(db, base_dir: str, conf_common: PVConf, conf_branches: BranchesConf
                 continue
             component_name = j.name
             component_name_list.append(component_name)
+            labels = {'branch': branch_name, 'component': component_name}
             logger_rel.info('Generating Packages for %s-%s', branch_name, component_name)
-            gen_packages(db, dist_dir, branch_name, component_name)
+            with internal_stats.timer('packages', **labels):
+                gen_packages(db, dist_dir, branch_name, component_name)
             logger_rel.info('Generating Contents for %s-%s', branch_name, component_name)
-            gen_contents(db, branch_name, component_name, dist_dir)
+            with internal_stats.timer('contents', **labels):
+                gen_contents(db, branch_name, component_name, dist_dir)
 
         conf = conf_common.copy()
         conf.update(conf_branches[branch_name])
         logger_rel.info('Generating Release for %s', branch_name)
-        gen_release(db, branch_name, component_name_list, dist_dir, conf)
+        with internal_stats.timer('release', branch=branch_name):
+            gen_release(db, branch_name, component_name_list, dist_dir, conf)
     if PosixPath(dist_dir_real).exists():
         os.rename(dist_dir_real, dist_dir_old)
     os.rename(dist_dir, dist_dir_real)
     shutil.rmtree(dist_dir_old, True)
 
 
+def stream_cursor(db, name: str):
+    """ A server-side cursor returning tuples, so that large results are
+        not held in memory at once. It can only execute one query.
+    """
+    cur = db.cursor(name, cursor_factory=psycopg2.extensions.cursor)
+    cur.itersize = itersize
+    return cur
+
+
 def gen_packages(db, dist_dir: str, branch_name: str, component_name: str):
     repopath = branch_name + '/' + component_name
     basedir = PosixPath(dist_dir).joinpath(branch_name).joinpath(component_name)
@@ -88,7 +107,7 @@ def gen_packages(db, dist_dir: str, branch_name: str, component_name: str):
     arch_packages = {'all': open(
         str(d.joinpath('Packages')), 'w', encoding='utf-8')}
 
-    cur = db.cursor()
+    cur = stream_cursor(db, 'packages')
     cur.execute("""
         SELECT p.package, p.version, min(p.architecture) architecture,
           min(p.filename) filename, min(p.size) size, min(p.sha256) sha256,
@@ -96,12 +115,12 @@ def gen_packages(db, dist_dir: str, branch_name: str, component_name: str):
           min(p.maintainer) maintainer, min(p.description) description,
           array_agg(array[pd.relationship, pd.value]) dep
         FROM pv_packages p INNER JOIN pv_repos r ON p.repo=r.name
-        LEFT JOIN pv_package_dependencies pd ON pd.package=p.package
-        AND pd.version=p.version AND pd.repo=p.repo
-        WHERE r.path=%s AND p.debtime IS NOT NULL
-        GROUP BY p.package, p.version, p.repo""", (repopath,))
-    for row in cur:
-        architecture = row['architecture']
+        LEFT JOIN pv_dependencies pd
+        ON pd.pkg_id=p.pkg_id AND pd.branch=p.branch
+        WHERE r.path=%s AND p.branch=%s AND p.debtime IS NOT NULL
+        GROUP BY p.package, p.version, p.repo""", (repopath, branch_name))
+    for (package, version, architecture, filename, size, sha256, section,
+         installed_size, maintainer, description, dep) in cur:
         if architecture not in arch_packages:
             d = basedir.joinpath('binary-' + architecture)
             d.mkdir(0o755, parents=True, exist_ok=True)
@@ -109,22 +128,23 @@ def gen_packages(db, dist_dir: str, branch_name: str, component_name: str):
                 str(d.joinpath('Packages')), 'w', encoding='utf-8')
         f = arch_packages[architecture]
         control = {
-            'Package': row['package'],
-            'Version': row['version'],
+            'Package': package,
+            'Version': version,
             'Architecture': architecture,
-            'Installed-Size': str(row['installed_size']),
-            'Maintainer': row['maintainer'],
-            'Filename': row['filename'],
-            'Size': str(row['size']),
-            'SHA256': row['sha256'],
-            'Description': row['description']
+            'Installed-Size': str(installed_size),
+            'Maintainer': maintainer,
+            'Filename': filename,
+            'Size': str(size),
+            'SHA256': sha256,
+            'Description': description
         }
-        if row['section']:
-            control['Section'] = row['section']
-        for k, v in row['dep']:
+        if section:
+            control['Section'] = section
+        for k, v in dep:
             if k:
                 control[k] = v
         print(deb822.SortPackages(deb822.Packages(control)), file=f)
+    cur.close()
     for f in arch_packages.values():
         file_path = f.name
         f.close()
@@ -139,20 +159,24 @@ def gen_contents(db, branch_name: str, component_name: str, dist_dir: str):
     cur.execute("SELECT architecture FROM pv_repos "
         "WHERE architecture != 'all' AND path=%s", (repopath,))
     allarch = [r[0] for r in cur]
+    cur.close()
     for arch in allarch:
+        cur = stream_cursor(db, 'contents')
         cur.execute("""
-            SELECT df.path || '/' || df.name AS f, string_agg(DISTINCT (
+            SELECT fp.path || '/' || df.name AS f, string_agg(DISTINCT (
               coalesce(dp.section || '/', '') || dp.package), ',') AS p
             FROM pv_packages dp
-            INNER JOIN pv_package_files df USING (package, version, repo)
+            INNER JOIN pv_files df ON df.pkg_id=dp.pkg_id AND df.branch=dp.branch
+            LEFT JOIN pv_paths fp ON fp.id=df.path_id
             INNER JOIN pv_repos pr ON pr.name=dp.repo
-            WHERE pr.path=%s AND df.ftype='reg'
+            WHERE pr.path=%s AND dp.branch=%s AND df.ftype='reg'
             AND pr.architecture IN (%s, 'all') AND dp.debtime IS NOT NULL
-            GROUP BY df.path, df.name""", (repopath, arch))
+            GROUP BY fp.path, df.name""", (repopath, branch_name, arch))
         filename = str(basedir.joinpath('Contents-%s.gz' % arch))
         with gzip.open(filename, 'wb', 9) as f:
             for path, package in cur:
                 f.write((path.ljust(55) + ' ' + package + '\n').encode('utf-8'))
+        cur.close()
 
 
 GPG_MAIN = os.environ.get('GPG', shutil.which('gpg2')) or shutil.which('gpg')
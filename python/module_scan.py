@@ -1,20 +1,31 @@
+import io
 import os
+import re
+import stat
+import time
 from pathlib import PosixPath
 
 import logging
+import bisect
 import binascii
-import functools
 import urllib.parse
+import multiprocessing
 import multiprocessing.dummy
 from subprocess import CalledProcessError
 
 import module_ipc
 import internal_db
+import internal_stats
 import internal_pkgscan
 import internal_dpkg_version
 
 logger_scan = logging.getLogger('SCAN')
 
+# Scanned packages are written and committed in batches of this size
+batch_size = 1000
+# Scan in this many processes instead of threads if not 0
+processes = 0
+
 FILETYPES = {
     0o100000: 'reg',
     0o120000: 'lnk',
@@ -32,18 +43,53 @@ def split_soname(s: str):
     else:
         return spl[0]+'.so', spl[1]
 
+# An alternative of a relationship field: package, architecture, relation
+# and version
+RE_DEPENDENCY = re.compile(
+    r'\s*([a-zA-Z0-9.+-]{2,})(?::([a-zA-Z0-9][a-zA-Z0-9-]*))?'
+    r'(?:\s*\(\s*([>=<]+)\s*([0-9a-zA-Z:+~.-]+)\s*\))?(?:\s*\[[\s!\w-]+\])?'
+    r'\s*(?:<.+>)?\s*', re.ASCII | re.DOTALL)
+
+def parse_depinfo(depinfo: dict):
+    """ Split the relationship fields into (relationship, nr, deppkg,
+        deparch, relop, depver, depvercomp) rows, one per alternative of
+        the nr-th item. Alternatives that don't parse have None fields.
+        depvercomp is None for versions comparable_ver() rejects, SQL
+        compares them with comparable_dpkgver() instead.
+    """
+    rows = []
+    for relationship, value in depinfo.items():
+        for nr, item in enumerate(value.split(',') if value else (), 1):
+            if not item:
+                continue
+            for dep in item.split('|'):
+                m = RE_DEPENDENCY.fullmatch(dep)
+                if m is None:
+                    rows.append((relationship, nr) + (None,) * 5)
+                    continue
+                depvercomp = None
+                if m.group(4) is not None:
+                    try:
+                        depvercomp = internal_dpkg_version.comparable_ver(
+                            m.group(4))
+                    except AssertionError:
+                        pass
+                rows.append((relationship, nr) + m.groups() + (depvercomp,))
+    return rows
+
 def parse_debname(s: str):
     basename = urllib.parse.unquote(os.path.splitext(os.path.basename(s))[0])
     package, other = basename.split('_', 1)
     version, arch = other.rsplit('_', 1)
     return package, version, arch
 
-def scan_deb(args):
+def scan_deb(args, control_only=False):
     # fullpath: str, filename: str, size: int, mtime: int
-    # Scan it.
+    # Scan it. With control_only, files and shared objects are left for
+    # later unless cached, and scantime is None.
     fullpath, filename, size, mtime = args
     try:
-        p = internal_pkgscan.scan(fullpath)
+        p = internal_pkgscan.scan(fullpath, control_only)
     except CalledProcessError as e:
         if e.returncode in (1, 2):
             logger_scan.error('%s is corrupted, status: %d', fullpath, e.returncode)
@@ -51,6 +97,7 @@ def scan_deb(args):
             pkginfo = {
                 'package': package, 'version': version, 'architecture': arch,
                 'filename': filename, 'size': size, 'mtime': mtime,
+                'scantime': int(time.time()),
             }
             try:
                 pkginfo['sha256'] = internal_pkgscan.sha256_file(fullpath)
@@ -66,13 +113,14 @@ def scan_deb(args):
         'architecture': p.control['Architecture'],
         'filename': filename,
         'size': size,
-        'sha256': binascii.b2a_hex(bytes(p.p['hash_value'])).decode('ascii'),
+        'sha256': binascii.b2a_hex(p.p['hash_value']).decode('ascii'),
         'mtime': mtime,
         'debtime': p.p['time'],
         'section': p.control.get('Section'),
         'installed_size': p.control['Installed-Size'],
         'maintainer': p.control['Maintainer'],
         'description': p.control['Description'],
+        'scantime': int(time.time()) if p.complete else None,
     }
     depinfo = {k:p.control[k] for k in ('Depends', 'Pre-Depends', 'Recommends',
         'Suggests', 'Enhances', 'Breaks', 'Conflicts', 'Provides', 'Replaces')
@@ -83,162 +131,807 @@ def scan_deb(args):
     for row in p.p['so_depends']:
         sodeps.append((1,) + split_soname(row))
     files = []
-    for row in p.p['files']:
-        path, name = os.path.split(os.path.normpath(
-            os.path.join('/', row['path'])))
+    for fpath, fsize, ftype, perm, uid, gid, uname, gname in p.p['files']:
+        path, name = os.path.split(os.path.normpath(os.path.join('/', fpath)))
         files.append((
-            path.lstrip('/'), name, row['size'],
-            FILETYPES.get(row['type'], str(row['type'])),
-            row['perm'], row['uid'], row['gid'], row['uname'], row['gname']
+            path.lstrip('/'), name, fsize, FILETYPES.get(ftype, str(ftype)),
+            perm, uid, gid, uname, gname
         ))
     return pkginfo, depinfo, sodeps, files
 
-dpkg_vercomp_key = functools.cmp_to_key(
-    internal_dpkg_version.dpkg_version_compare)
+def encode_rows(rows):
+    """ Encode rows in the text format of COPY. """
+    return ''.join('\t'.join(map(internal_db.escape_val, row)) + '\n'
+                   for row in rows)
 
-def scan_dir(db, base_dir: str, branch: str, component: str, branch_idx: int):
-    pool_path = PosixPath(base_dir).joinpath('pool')
-    search_path = pool_path.joinpath(branch).joinpath(component)
-    compname = '%s-%s' % (branch, component)
-    comppath = '%s/%s' % (branch, component)
-    cur = db.cursor()
-    cur.execute("""SELECT p.package, p.version, p.repo, p.architecture,
-          p.filename, p.size, p.mtime, p.sha256
-        FROM pv_packages p
-        INNER JOIN pv_repos r ON p.repo=r.name WHERE r.path=%s
-        UNION ALL
-        SELECT p.package, p.version, p.repo, p.architecture,
-          p.filename, p.size, p.mtime, p.sha256
-        FROM pv_package_duplicate p
-        INNER JOIN pv_repos r ON p.repo=r.name WHERE r.path=%s""",
-        (comppath, comppath))
-    dup_pkgs = set()
-    ignore_files = set()
-    modified_repo = set()
-    del_list = []
-    # For each package/version/architecture we already know in the DB:
-    for package, version, repopath, architecture, filename, size, mtime, sha256 in cur:
-        fullpath = PosixPath(base_dir).joinpath(filename)
-        if fullpath.is_file():
-            # If a package with the same name exists:
-            stat = fullpath.stat()
-            sfullpath = str(fullpath)
-            if size == stat.st_size and (mtime == int(stat.st_mtime) or
-                # Ignore if the file isn't changed
-                internal_pkgscan.sha256_file(sfullpath) == sha256):
-                ignore_files.add(sfullpath)
-            else:
-                # Consider the new file to be a duplicate and replace the old one
-                dup_pkgs.add(filename)
-                del_list.append((filename, package, version, repopath))
+def scan_deb_encoded(args, control_only=False):
+    # Run in worker processes: encoding here keeps the result small to
+    # pickle and leaves little work to the process writing to the database.
+    pkginfo, depinfo, sodeps, files = scan_deb(args, control_only)
+    return (pkginfo, (encode_rows(depinfo.items()),
+                      encode_rows(parse_depinfo(depinfo))),
+            encode_rows(sodeps), encode_rows(files))
+
+def _hash_file(path: str):
+    try:
+        return path, internal_pkgscan.sha256_file(path)
+    except OSError:
+        logger_scan.exception('cannot access %s', path)
+        return path, None
+
+def hash_files(paths):
+    """ Return {path: sha256} of the files, hashed in parallel. """
+    digests = {}
+    if not paths:
+        return digests
+    logger_scan.info('Verifying %d files with a new mtime', len(paths))
+    last_report = time.monotonic()
+    with multiprocessing.dummy.Pool(os.cpu_count()) as pool:
+        for path, digest in pool.imap_unordered(_hash_file, paths):
+            digests[path] = digest
+            if time.monotonic() - last_report >= 10:
+                last_report = time.monotonic()
+                logger_scan.info('Verified %d/%d files',
+                                 len(digests), len(paths))
+    return digests
+
+def scan_pool():
+    """ Create the pool packages are scanned in: processes if configured,
+        otherwise threads.
+    """
+    if processes:
+        # Workers inherit the configuration, such as internal_pkgscan.cache,
+        # which other start methods would leave unset
+        return multiprocessing.get_context('fork').Pool(processes)
+    return multiprocessing.dummy.Pool(max(1, os.cpu_count() - 1))
+
+def scan_task(args):
+    # Packages are skipped once the deadline has passed, so a pool shared
+    # with other components never needs to be stopped.
+    deadline, control_only, row = args
+    if deadline is not None and time.time() >= deadline:
+        return None
+    internal_stats.local_take()
+    with internal_stats.local_timer('scan'):
+        if processes:
+            result = scan_deb_encoded(row, control_only)
         else:
-            # If the package has been deleted
-            del_list.append((filename, package, version, repopath))
-            logger_scan.info('CLEAN  %s', filename)
-            module_ipc.publish_change(
-                compname, package, architecture, 'delete', version, '')
-    # For each package/version/arch/repo to be deleted:
-    for row in del_list:
-        cur.execute("DELETE FROM pv_packages WHERE filename=%s", (row[0],))
-        modified_repo.add(row[1:][-1])
-    # Check if there are any new files added. Recursively scan the pool dir and take notes of
-    # what we haven't seen yet.
-    check_list = []
-    for fullpath in search_path.rglob('*.deb'):
-        if not fullpath.is_file():
+            result = scan_deb(row, control_only)
+    # Stage times are returned, as this may run in another process
+    return internal_stats.local_take(), result
+
+class VersionIndex(object):
+    """Sorted (version, filename) lists of each (package, repo).
+
+    Loaded once per component and updated as packages are staged, so
+    classifying a scanned package needs neither a query nor a full sort.
+    Versions are ordered by internal_dpkg_version.version_key(), as
+    _vercomp orders them in the database.
+    """
+
+    def __init__(self):
+        self.index = {}
+
+    def add(self, package: str, repo: str, version: str, filename: str):
+        keys, entries = self.index.setdefault((package, repo), ([], []))
+        key = internal_dpkg_version.version_key(version)
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            entries[i] = (version, filename)
+        else:
+            keys.insert(i, key)
+            entries.insert(i, (version, filename))
+
+    def classify(self, package: str, repo: str, version: str):
+        """Return one of 'new', 'newer', 'old' and 'dup', and the entry
+        compared against: the newest one, or the one with this version."""
+        keys, entries = self.index.get((package, repo), ((), ()))
+        if not keys:
+            return 'new', None
+        key = internal_dpkg_version.version_key(version)
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return 'dup', entries[i]
+        elif i == len(keys):
+            return 'newer', entries[-1]
+        return 'old', entries[-1]
+
+# Files of the staged packages in {packages}. Directories and owner names
+# already in pv_paths and pv_owners are locked first, so that gc does not
+# remove them before the files refer to them. Those missing are added in
+# order, so that concurrent scans wait on each other instead of
+# deadlocking.
+SQL_INSERT_FILES = '''
+SELECT count(*) FROM (
+  SELECT 1 FROM pv_paths WHERE path IN (SELECT path FROM t_scan_files)
+  FOR KEY SHARE) l;
+SELECT count(*) FROM (
+  SELECT 1 FROM pv_owners WHERE name IN (
+    SELECT uname FROM t_scan_files UNION SELECT gname FROM t_scan_files)
+  FOR KEY SHARE) l;
+INSERT INTO pv_paths (path)
+SELECT DISTINCT t.path FROM t_scan_files t
+LEFT JOIN pv_paths p USING (path)
+WHERE p.id IS NULL AND t.path IS NOT NULL ORDER BY t.path
+ON CONFLICT DO NOTHING;
+INSERT INTO pv_owners (name)
+SELECT DISTINCT q.name FROM (
+  SELECT uname name FROM t_scan_files UNION SELECT gname FROM t_scan_files
+) q
+LEFT JOIN pv_owners o USING (name)
+WHERE o.id IS NULL AND q.name IS NOT NULL ORDER BY q.name
+ON CONFLICT DO NOTHING;
+INSERT INTO pv_files
+SELECT w.pkg_id, p.id, t.name, t.size, t.ftype,
+  t.perm, t.uid, t.gid, u.id, g.id, w.branch
+FROM t_scan_files t INNER JOIN {packages} w USING (seq)
+LEFT JOIN pv_paths p ON p.path=t.path
+LEFT JOIN pv_owners u ON u.name=t.uname
+LEFT JOIN pv_owners g ON g.name=t.gname;'''
+
+# The winners get their pkg_id here, so that the rows of the other tables
+# can refer to it.
+SQL_MERGE_STAGING = '''
+CREATE TEMP TABLE t_scan_winners AS
+SELECT nextval('pv_packages_pkg_id_seq') pkg_id, w.* FROM (
+  SELECT DISTINCT ON (package, version, repo) * FROM t_scan_packages
+  ORDER BY package, version, repo, seq DESC
+) w;
+CREATE TEMP TABLE t_scan_replaced AS
+SELECT p.pkg_id, p.branch, w.pkg_id new_pkg_id FROM pv_packages p
+INNER JOIN t_scan_winners w USING (package, version, repo, branch);
+CREATE TEMP TABLE t_scan_displaced AS
+SELECT {pcols}, w.pkg_id FROM pv_packages p
+INNER JOIN t_scan_winners w USING (package, version, repo, branch)
+UNION ALL
+SELECT {scols}, w.pkg_id FROM t_scan_packages s
+INNER JOIN t_scan_winners w USING (package, version, repo, branch)
+WHERE s.seq!=w.seq;
+DELETE FROM pv_dependencies t USING t_scan_replaced r
+WHERE t.pkg_id=r.pkg_id AND t.branch=r.branch;
+DELETE FROM pv_dpkg_dependencies t USING t_scan_replaced r
+WHERE t.pkg_id=r.pkg_id AND t.branch=r.branch;
+DELETE FROM pv_sodep t USING t_scan_replaced r
+WHERE t.pkg_id=r.pkg_id AND t.branch=r.branch;
+DELETE FROM pv_files t USING t_scan_replaced r
+WHERE t.pkg_id=r.pkg_id AND t.branch=r.branch;
+DELETE FROM pv_package_duplicate t USING t_scan_packages s
+WHERE t.filename=s.filename AND t.branch=s.branch;
+UPDATE pv_package_duplicate t SET pkg_id=r.new_pkg_id FROM t_scan_replaced r
+WHERE t.pkg_id=r.pkg_id AND t.branch=r.branch;
+DELETE FROM pv_packages t USING t_scan_replaced r
+WHERE t.pkg_id=r.pkg_id AND t.branch=r.branch;
+INSERT INTO pv_packages (pkg_id, {cols})
+SELECT pkg_id, {cols} FROM t_scan_winners;
+INSERT INTO pv_package_duplicate (pkg_id, {cols})
+SELECT pkg_id, {cols} FROM t_scan_displaced;
+INSERT INTO pv_dependencies
+SELECT w.pkg_id, t.relationship, t.value, w.branch
+FROM t_scan_dependencies t INNER JOIN t_scan_winners w USING (seq);
+INSERT INTO pv_dpkg_dependencies
+SELECT w.pkg_id, t.relationship, t.nr, t.deppkg, t.deparch, t.relop, t.depver,
+  coalesce(t.depvercomp, comparable_dpkgver(t.depver)), w.branch
+FROM t_scan_dpkg_dependencies t INNER JOIN t_scan_winners w USING (seq);
+INSERT INTO pv_sodep
+SELECT w.pkg_id, t.depends, t.name, t.ver, w.branch
+FROM t_scan_sodep t INNER JOIN t_scan_winners w USING (seq);
+{insert_files}
+DROP TABLE t_scan_winners, t_scan_replaced, t_scan_displaced;
+TRUNCATE t_scan_packages, t_scan_dependencies, t_scan_dpkg_dependencies,
+  t_scan_sodep, t_scan_files;
+'''.format(
+    cols=', '.join(internal_db.PACKAGE_COLUMNS),
+    pcols=', '.join('p.' + k for k in internal_db.PACKAGE_COLUMNS),
+    scols=', '.join('s.' + k for k in internal_db.PACKAGE_COLUMNS),
+    insert_files=SQL_INSERT_FILES.format(packages='t_scan_winners'))
+
+# Adds the files and shared objects of packages from a metadata-only
+# scan. Packages whose file changed since are left alone.
+SQL_MERGE_COMPLETE = '''
+CREATE TEMP TABLE t_scan_complete AS
+SELECT p.pkg_id, s.* FROM t_scan_packages s
+INNER JOIN pv_packages p USING (package, version, repo, branch)
+WHERE p.sha256=s.sha256 AND p.scantime IS NULL;
+DELETE FROM pv_sodep t USING t_scan_complete w
+WHERE t.pkg_id=w.pkg_id AND t.branch=w.branch;
+DELETE FROM pv_files t USING t_scan_complete w
+WHERE t.pkg_id=w.pkg_id AND t.branch=w.branch;
+INSERT INTO pv_sodep
+SELECT w.pkg_id, t.depends, t.name, t.ver, w.branch
+FROM t_scan_sodep t INNER JOIN t_scan_complete w USING (seq);
+{insert_files}
+UPDATE pv_packages p SET scantime=w.scantime, debtime=w.debtime
+FROM t_scan_complete w
+WHERE p.pkg_id=w.pkg_id AND p.branch=w.branch;
+DROP TABLE t_scan_complete;
+TRUNCATE t_scan_packages, t_scan_dependencies, t_scan_dpkg_dependencies,
+  t_scan_sodep, t_scan_files;
+'''.format(insert_files=SQL_INSERT_FILES.format(packages='t_scan_complete'))
+
+class ScanStaging(object):
+    """Rows of scanned packages, streamed into temporary tables with COPY.
+
+    Packages are numbered in the order they are added. merge() then applies
+    them to the pv_* tables with a fixed number of statements: when several
+    files share (package, version, repo), the last one added is kept and
+    the rest, including an existing row, go to pv_package_duplicate
+    alongside the earlier duplicates.
+    """
+    TABLES = (
+        ('t_scan_packages', ('seq',) + internal_db.PACKAGE_COLUMNS),
+        ('t_scan_dependencies', ('seq', 'relationship', 'value')),
+        ('t_scan_dpkg_dependencies', ('seq', 'relationship', 'nr', 'deppkg',
+                                      'deparch', 'relop', 'depver',
+                                      'depvercomp')),
+        ('t_scan_sodep', ('seq', 'depends', 'name', 'ver')),
+        ('t_scan_files', ('seq', 'path', 'name', 'size', 'ftype', 'perm',
+                          'uid', 'gid', 'uname', 'gname')),
+    )
+    BUFFER_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.seq = 0
+        self.buffers = {}
+        for table, columns in self.TABLES:
+            source = table.replace('t_scan_', 'pv_package_')
+            if table in ('t_scan_packages', 't_scan_dpkg_dependencies'):
+                source = table.replace('t_scan_', 'pv_')
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS %s "
+                "ON COMMIT DELETE ROWS AS SELECT 0 %s FROM %s WITH NO DATA"
+                % (table, ', '.join(columns), source))
+            self.buffers[table] = io.StringIO()
+
+    def _write(self, table, row):
+        buf = self.buffers[table]
+        buf.write('\t'.join(map(internal_db.escape_val, row)))
+        buf.write('\n')
+        if buf.tell() > self.BUFFER_SIZE:
+            self._copy(table)
+
+    def _write_encoded(self, table, text):
+        # Prepend seq to each line from encode_rows()
+        if not text:
+            return
+        prefix = '%d\t' % self.seq
+        buf = self.buffers[table]
+        buf.write(prefix)
+        buf.write(text[:-1].replace('\n', '\n' + prefix))
+        buf.write('\n')
+        if buf.tell() > self.BUFFER_SIZE:
+            self._copy(table)
+
+    def _copy(self, table):
+        buf = self.buffers[table]
+        if not buf.tell():
+            return
+        buf.seek(0)
+        self.cur.copy_from(buf, table, columns=dict(self.TABLES)[table])
+        self.buffers[table] = io.StringIO()
+
+    def add(self, pkginfo, depinfo, sodeps, files):
+        self.seq += 1
+        self._write('t_scan_packages', (self.seq,) + tuple(
+            pkginfo.get(k) for k in internal_db.PACKAGE_COLUMNS))
+        for row in depinfo.items():
+            self._write('t_scan_dependencies', (self.seq,) + row)
+        for row in parse_depinfo(depinfo):
+            self._write('t_scan_dpkg_dependencies', (self.seq,) + row)
+        for row in sodeps:
+            self._write('t_scan_sodep', (self.seq,) + row)
+        for row in files:
+            self._write('t_scan_files', (self.seq,) + row)
+
+    def add_encoded(self, pkginfo, depinfo, sodeps, files):
+        """ Like add(), with the other rows from encode_rows(), and
+            depinfo the rows of both dependency tables.
+        """
+        self.seq += 1
+        self._write('t_scan_packages', (self.seq,) + tuple(
+            pkginfo.get(k) for k in internal_db.PACKAGE_COLUMNS))
+        self._write_encoded('t_scan_dependencies', depinfo[0])
+        self._write_encoded('t_scan_dpkg_dependencies', depinfo[1])
+        self._write_encoded('t_scan_sodep', sodeps)
+        self._write_encoded('t_scan_files', files)
+
+    def merge(self, sql=SQL_MERGE_STAGING):
+        if not self.seq:
+            return
+        for table, columns in self.TABLES:
+            self._copy(table)
+        self.cur.execute(sql)
+        self.seq = 0
+
+def walk_pool(base_dir: str, top: str, known: dict, full_walk=False):
+    """ Find .deb files under top, a directory relative to base_dir.
+        Directories whose mtime matches the one in known are not listed
+        again: their known subdirectories are visited instead. Returns
+        (filename, stat) of each .deb found, the set of unchanged
+        directories and the current mtime of each directory.
+    """
+    children = {}
+    for path in known:
+        children.setdefault(os.path.dirname(path), []).append(path)
+    files = []
+    unchanged = set()
+    mtimes = {}
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        try:
+            st = os.stat(os.path.join(base_dir, path))
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
             continue
-        stat = fullpath.stat()
-        sfullpath = str(fullpath)
-        if sfullpath in ignore_files:
+        mtimes[path] = st.st_mtime_ns
+        if not full_walk and known.get(path) == st.st_mtime_ns:
+            unchanged.add(path)
+            stack.extend(children.get(path, ()))
             continue
-        check_list.append((sfullpath, str(fullpath.relative_to(base_dir)),
-                           stat.st_size, int(stat.st_mtime)))
-    del ignore_files
-    with multiprocessing.dummy.Pool(max(1, os.cpu_count() - 1)) as mpool:
-        for pkginfo, depinfo, sodeps, files in mpool.imap_unordered(scan_deb, check_list, 5):
+        with os.scandir(os.path.join(base_dir, path)) as it:
+            for entry in it:
+                name = os.path.join(path, entry.name)
+                if entry.is_dir():
+                    stack.append(name)
+                elif entry.name.endswith('.deb') and entry.is_file():
+                    files.append((name, entry.stat()))
+    return files, unchanged, mtimes
+
+SQL_KNOWN_PACKAGES = """
+SELECT p.package, p.version, p.repo, p.architecture,
+  p.filename, p.size, p.mtime, p.sha256, FALSE
+FROM pv_packages p
+INNER JOIN pv_repos r ON p.repo=r.name
+WHERE r.path=%(comppath)s AND p.branch=%(branch)s {cond}
+UNION ALL
+SELECT p.package, p.version, p.repo, p.architecture,
+  p.filename, p.size, p.mtime, p.sha256, TRUE
+FROM pv_package_duplicate p
+INNER JOIN pv_repos r ON p.repo=r.name
+WHERE r.path=%(comppath)s AND p.branch=%(branch)s {cond}
+"""
+
+SQL_PACKAGE_VERSIONS = """
+SELECT p.version, p.repo, p.filename
+FROM pv_packages p
+INNER JOIN pv_repos r ON p.repo=r.name
+WHERE r.path=%s AND p.branch=%s AND p.package=%s
+"""
+
+SQL_PENDING_PACKAGES = """
+SELECT p.package, p.version, p.repo, p.filename, p.size, p.mtime
+FROM pv_packages p
+INNER JOIN pv_repos r ON p.repo=r.name
+WHERE r.path=%s AND p.branch=%s AND p.scantime IS NULL
+ORDER BY p.filename
+"""
+
+class ComponentScan(object):
+    """State of scanning one branch/component.
+
+    check() compares the packages known in the database with the files on
+    disk, update() scans new and changed files, and commit() writes the
+    results. With metadata_only, update() reads only control.tar, and
+    complete() later scans the files of such packages. If only some files
+    are checked, loaded is set to the packages whose versions are known,
+    and the others are looked up as they are scanned.
+    """
+
+    def __init__(self, cur, base_dir: str, branch: str, component: str,
+                 branch_idx: int, metadata_only=False):
+        self.cur = cur
+        self.base_dir = base_dir
+        self.branch = branch
+        self.component = component
+        self.branch_idx = branch_idx
+        self.compname = '%s-%s' % (branch, component)
+        self.comppath = '%s/%s' % (branch, component)
+        self.versions = VersionIndex()
+        self.loaded = None
+        self.dup_pkgs = set()
+        self.orphans = set()
+        self.modified_repo = set()
+        self.staging = ScanStaging(cur)
+        self.labels = {'branch': branch, 'component': component}
+        self.metadata_only = metadata_only
+
+    def check(self, rows, skip=lambda filename: False):
+        """ Check the rows from SQL_KNOWN_PACKAGES against the disk.
+            Files for which skip() returns true are assumed unchanged.
+            Returns the set of filenames that are known and unchanged.
+            The duplicates of deleted packages are deleted along with them
+            and added to orphans, to be scanned again.
+        """
+        ignore_files = set()
+        del_list = []
+        verify_list = []
+        # For each package/version/architecture we already know in the DB:
+        for (package, version, repopath, architecture, filename, size, mtime,
+             sha256, duplicate) in rows:
+            if skip(filename):
+                if not duplicate:
+                    self.versions.add(package, repopath, version, filename)
+                continue
+            fullpath = PosixPath(self.base_dir).joinpath(filename)
+            if fullpath.is_file():
+                # If a package with the same name exists:
+                st = fullpath.stat()
+                if size == st.st_size and mtime == int(st.st_mtime):
+                    # Ignore if the file isn't changed
+                    ignore_files.add(filename)
+                    if not duplicate:
+                        self.versions.add(package, repopath, version, filename)
+                elif size == st.st_size:
+                    # Only the mtime changed, compare the contents below
+                    verify_list.append((str(fullpath), filename,
+                        int(st.st_mtime), sha256, package, version, repopath,
+                        duplicate))
+                else:
+                    # Consider the new file to be a duplicate and replace the old one
+                    self.dup_pkgs.add(filename)
+                    del_list.append((filename, package, version, repopath))
+            else:
+                # If the package has been deleted
+                del_list.append((filename, package, version, repopath))
+                internal_stats.count('packages_deleted', **self.labels)
+                logger_scan.info('CLEAN  %s', filename)
+                module_ipc.publish_change(
+                    self.compname, package, architecture, 'delete', version, '')
+        digests = {}
+        if verify_list:
+            with internal_stats.timer('verify', **self.labels):
+                digests = hash_files([row[0] for row in verify_list])
+            internal_stats.count('packages_verified', len(verify_list),
+                                 **self.labels)
+        touched = []
+        for (fullpath, filename, st_mtime, sha256, package, version, repopath,
+             duplicate) in verify_list:
+            if digests[fullpath] == sha256:
+                ignore_files.add(filename)
+                touched.append((filename, st_mtime))
+                if not duplicate:
+                    self.versions.add(package, repopath, version, filename)
+            else:
+                self.dup_pkgs.add(filename)
+                del_list.append((filename, package, version, repopath))
+        # Remember the new mtime of unchanged files, not to hash them again
+        if touched:
+            for table in ('pv_packages', 'pv_package_duplicate'):
+                self.cur.execute("UPDATE %s p SET mtime=v.mtime FROM "
+                    "unnest(%%s::text[], %%s::integer[]) v(filename, mtime) "
+                    "WHERE p.filename=v.filename AND p.branch=%%s" % table,
+                    ([row[0] for row in touched], [row[1] for row in touched],
+                     self.branch))
+        # Delete the packages that are gone or changed on disk
+        if del_list:
+            filenames = [row[0] for row in del_list]
+            self.cur.execute("DELETE FROM pv_package_duplicate "
+                             "WHERE filename = ANY(%s) AND branch=%s",
+                             (filenames, self.branch))
+            # Their other files are scanned again to take their place. The
+            # directories are listed again if that is interrupted.
+            self.cur.execute("DELETE FROM pv_package_duplicate d "
+                             "USING pv_packages p WHERE p.filename = ANY(%s) "
+                             "AND p.branch=%s AND d.pkg_id=p.pkg_id "
+                             "AND d.branch=p.branch RETURNING d.filename",
+                             (filenames, self.branch))
+            orphans = set(row[0] for row in self.cur)
+            if orphans:
+                self.cur.execute("UPDATE pv_scan_dirs SET mtime=0 "
+                                 "WHERE path = ANY(%s)", (list(set(
+                                     os.path.dirname(f) for f in orphans)),))
+                self.orphans |= orphans
+                ignore_files -= orphans
+            self.cur.execute("DELETE FROM pv_packages "
+                             "WHERE filename = ANY(%s) AND branch=%s",
+                             (filenames, self.branch))
+        for row in del_list:
+            self.modified_repo.add(row[1:][-1])
+        return ignore_files
+
+    def update(self, check_list, checkpoint=None, deadline=None, mpool=None):
+        """ Scan the (fullpath, filename, size, mtime) in check_list, in
+            mpool from scan_pool() or a new one. Results are committed
+            every batch_size packages, after which checkpoint() is called
+            with the filenames committed. Stops after deadline (a
+            time.time() value) and returns the number of packages left
+            unscanned.
+        """
+        cur = self.cur
+        done = []
+        scanned = 0
+        add_func = self.staging.add_encoded if processes else self.staging.add
+        for pkginfo, depinfo, sodeps, files in self.scan_results(
+                check_list, self.metadata_only, deadline, mpool):
+            internal_stats.count('packages_scanned', **self.labels)
+            internal_stats.count('bytes_scanned', pkginfo['size'],
+                                 **self.labels)
             realname = pkginfo['architecture']
             validdeb = ('debtime' in pkginfo)
             if realname == 'all':
                 realname = 'noarch'
-            if component != 'main':
-                realname = component + '-' + realname
-            repo = '%s/%s' % (realname, branch)
-            cur.execute("INSERT INTO pv_repos VALUES (%s,%s,%s,%s,%s,%s,%s,now()) "
-                "ON CONFLICT DO NOTHING",
-                (repo, realname, comppath, branch_idx,
-                branch, component, pkginfo['architecture']))
-            modified_repo.add(repo)
+            if self.component != 'main':
+                realname = self.component + '-' + realname
+            repo = '%s/%s' % (realname, self.branch)
+            if repo not in self.modified_repo:
+                cur.execute("INSERT INTO pv_repos VALUES (%s,%s,%s,%s,%s,%s,%s,now()) "
+                    "ON CONFLICT DO NOTHING",
+                    (repo, realname, self.comppath, self.branch_idx,
+                    self.branch, self.component, pkginfo['architecture']))
+                self.modified_repo.add(repo)
             pkginfo['repo'] = repo
-            dbkey = (pkginfo['package'], pkginfo['version'], repo)
-            if pkginfo['filename'] in dup_pkgs:
+            pkginfo['branch'] = self.branch
+            if not validdeb:
+                internal_stats.count('packages_corrupted', **self.labels)
+            elif pkginfo['scantime'] is None:
+                internal_stats.count('packages_pending', **self.labels)
+            if pkginfo['filename'] in self.dup_pkgs:
                 if validdeb:
+                    internal_stats.count('packages_overwritten',
+                                         **self.labels)
                     logger_scan.info('UPDATE %s', pkginfo['filename'])
                     module_ipc.publish_change(
-                        compname, pkginfo['package'], pkginfo['architecture'],
-                        'overwrite', pkginfo['version'], pkginfo['version']
+                        self.compname, pkginfo['package'],
+                        pkginfo['architecture'], 'overwrite',
+                        pkginfo['version'], pkginfo['version']
                     )
             else:
-                cur.execute("SELECT version, filename FROM pv_packages "
-                    "WHERE package=%s AND repo=%s", (pkginfo['package'], repo))
-                results = cur.fetchall()
-                if results:
-                    oldver = max(results, key=lambda x: dpkg_vercomp_key(x[0]))
-                    vercomp = internal_dpkg_version.dpkg_version_compare(
-                        oldver[0], pkginfo['version'])
-                    if vercomp == -1:
-                        if validdeb:
-                            logger_scan.info('NEWER  %s %s %s >> %s',
-                                pkginfo['architecture'], pkginfo['package'],
-                                pkginfo['version'], oldver[0])
-                            module_ipc.publish_change(
-                                compname, pkginfo['package'],
-                                pkginfo['architecture'], 'upgrade',
-                                oldver[0], pkginfo['version']
-                            )
-                    elif vercomp:
-                        logger_scan.warning('OLD    %s %s %s',
+                if (self.loaded is not None and
+                        pkginfo['package'] not in self.loaded):
+                    self.load_versions(pkginfo['package'])
+                status, oldver = self.versions.classify(
+                    pkginfo['package'], repo, pkginfo['version'])
+                if validdeb or status in ('old', 'dup'):
+                    internal_stats.count('packages_' + status,
+                                         **self.labels)
+                if status == 'newer':
+                    if validdeb:
+                        logger_scan.info('NEWER  %s %s %s >> %s',
                             pkginfo['architecture'], pkginfo['package'],
-                            pkginfo['version'])
-                    else:
-                        cur.execute("DELETE FROM pv_package_sodep "
-                            "WHERE package=%s AND version=%s AND repo=%s", dbkey)
-                        cur.execute("DELETE FROM pv_package_files "
-                            "WHERE package=%s AND version=%s AND repo=%s", dbkey)
-                        cur.execute("DELETE FROM pv_package_dependencies "
-                            "WHERE package=%s AND version=%s AND repo=%s", dbkey)
-                        cur.execute("DELETE FROM pv_package_duplicate "
-                            "WHERE package=%s AND version=%s AND repo=%s", dbkey)
-                        cur.execute("INSERT INTO pv_package_duplicate "
-                            "SELECT * FROM pv_packages WHERE filename=%s",
-                            (oldver[1],))
-                        cur.execute("DELETE FROM pv_packages "
-                            "WHERE package=%s AND version=%s AND repo=%s", dbkey)
-                        logger_scan.error('DUP    %s == %s',
-                            oldver[1], pkginfo['filename'])
+                            pkginfo['version'], oldver[0])
+                        module_ipc.publish_change(
+                            self.compname, pkginfo['package'],
+                            pkginfo['architecture'], 'upgrade',
+                            oldver[0], pkginfo['version']
+                        )
+                elif status == 'old':
+                    logger_scan.warning('OLD    %s %s %s',
+                        pkginfo['architecture'], pkginfo['package'],
+                        pkginfo['version'])
+                elif status == 'dup':
+                    logger_scan.error('DUP    %s == %s',
+                        oldver[1], pkginfo['filename'])
                 elif validdeb:
                     logger_scan.info('NEW    %s %s %s', pkginfo['architecture'],
                         pkginfo['package'], pkginfo['version'])
                     module_ipc.publish_change(
-                        compname, pkginfo['package'], pkginfo['architecture'],
-                        'new', '', pkginfo['version']
+                        self.compname, pkginfo['package'],
+                        pkginfo['architecture'], 'new', '', pkginfo['version']
                     )
-            keys, qms, vals = internal_db.make_insert(pkginfo)
-            cur.execute("INSERT INTO pv_packages (%s) VALUES (%s)" %
-                (keys, qms), vals)
-            for row in depinfo.items():
-                cur.execute("INSERT INTO pv_package_dependencies "
-                    "VALUES (%s,%s,%s,%s,%s) "
-                    "ON CONFLICT ON CONSTRAINT pv_package_dependencies_pkey "
-                    "DO UPDATE SET value = %s",
-                    dbkey + row + (row[1],))
-            for row in sodeps:
-                cur.execute("INSERT INTO pv_package_sodep VALUES "
-                    "(%s,%s,%s,%s,%s,%s)", dbkey + row)
-            for row in files:
-                cur.execute("INSERT INTO pv_package_files VALUES "
-                    "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", dbkey + row)
-    for repo in modified_repo:
-        cur.execute("UPDATE pv_repos SET mtime=now() WHERE name=%s", (repo,))
+            self.versions.add(pkginfo['package'], repo,
+                              pkginfo['version'], pkginfo['filename'])
+            add_func(pkginfo, depinfo, sodeps, files)
+            done.append(pkginfo['filename'])
+            if len(done) >= batch_size:
+                self.commit(done, checkpoint)
+                scanned += len(done)
+                done = []
+        self.commit(done, checkpoint)
+        return len(check_list) - scanned - len(done)
+
+    def load_versions(self, package: str):
+        """ Add the versions of package in the database to versions. """
+        self.loaded.add(package)
+        self.cur.execute(SQL_PACKAGE_VERSIONS,
+                         (self.comppath, self.branch, package))
+        for version, repo, filename in self.cur.fetchall():
+            self.versions.add(package, repo, version, filename)
+
+    def scan_results(self, check_list, control_only=False, deadline=None,
+                     mpool=None):
+        """ Scan the rows of check_list in mpool or a new scan_pool(),
+            yield the results of scan_deb() until deadline.
+        """
+        own_pool = mpool is None
+        if own_pool:
+            mpool = scan_pool()
+        tasks = ((deadline, control_only, row) for row in check_list)
+        try:
+            for result in mpool.imap_unordered(scan_task, tasks, 5):
+                if result is None:
+                    continue
+                times, info = result
+                for stage, seconds in times.items():
+                    internal_stats.add_time(stage, seconds, **self.labels)
+                yield info
+        finally:
+            if own_pool:
+                mpool.terminate()
+
+    def complete(self, deadline=None, mpool=None):
+        """ Scan the files and shared objects of the packages added by a
+            metadata-only scan. Returns the number of packages left.
+        """
+        self.cur.execute(SQL_PENDING_PACKAGES, (self.comppath, self.branch))
+        pending = {}
+        check_list = []
+        for package, version, repo, filename, size, mtime in self.cur:
+            pending[filename] = (package, version, repo)
+            check_list.append((os.path.join(self.base_dir, filename),
+                               filename, size, mtime))
+        if not check_list:
+            return 0
+        logger_scan.info('Scanning files of %d packages', len(check_list))
+        done = []
+        scanned = 0
+        add_func = self.staging.add_encoded if processes else self.staging.add
+        for pkginfo, depinfo, sodeps, files in self.scan_results(
+                check_list, False, deadline, mpool):
+            internal_stats.count('packages_completed', **self.labels)
+            internal_stats.count('bytes_scanned', pkginfo['size'],
+                                 **self.labels)
+            # The row is known, even if the package turns out corrupted
+            pkginfo['package'], pkginfo['version'], pkginfo['repo'] = (
+                pending[pkginfo['filename']])
+            pkginfo['branch'] = self.branch
+            self.modified_repo.add(pkginfo['repo'])
+            add_func(pkginfo, depinfo, sodeps, files)
+            done.append(pkginfo['filename'])
+            if len(done) >= batch_size:
+                self.commit(done, sql=SQL_MERGE_COMPLETE)
+                scanned += len(done)
+                done = []
+        self.commit(done, sql=SQL_MERGE_COMPLETE)
+        return len(check_list) - scanned - len(done)
+
+    def commit(self, filenames, checkpoint=None, sql=SQL_MERGE_STAGING):
+        with internal_stats.timer('write', **self.labels):
+            self.staging.merge(sql)
+            for repo in self.modified_repo:
+                self.cur.execute("UPDATE pv_repos SET mtime=now() WHERE name=%s",
+                                 (repo,))
+            if checkpoint is not None:
+                checkpoint(filenames)
+            self.cur.connection.commit()
+        module_ipc.flush()
+
+class ScanCheckpoint(object):
+    """Records the mtimes of pool directories in pv_scan_dirs.
+
+    A directory is recorded only after all its packages have been
+    committed, so an interrupted scan lists the rest again next time.
+    Subdirectories not known yet are recorded with mtime 0 along with
+    their parent, as walk_pool does not list unchanged directories.
+    """
+
+    def __init__(self, cur, comppath: str, known: dict, mtimes: dict,
+                 filenames):
+        self.cur = cur
+        self.comppath = comppath
+        self.known = known
+        self.mtimes = mtimes
+        self.subdirs = {}
+        for path in mtimes:
+            self.subdirs.setdefault(os.path.dirname(path), []).append(path)
+        self.pending = {}
+        for filename in filenames:
+            dirname = os.path.dirname(filename)
+            self.pending[dirname] = self.pending.get(dirname, 0) + 1
+        cur.execute("DELETE FROM pv_scan_dirs WHERE component=%s "
+                    "AND NOT (path = ANY(%s))", (comppath, list(mtimes)))
+        self.record(path for path in mtimes if path not in self.pending)
+
+    def __call__(self, filenames):
+        complete = []
+        for filename in filenames:
+            dirname = os.path.dirname(filename)
+            self.pending[dirname] -= 1
+            if not self.pending[dirname]:
+                complete.append(dirname)
+        self.record(complete)
+
+    def record(self, paths):
+        rows = {}
+        for path in paths:
+            if self.known.get(path) != self.mtimes[path]:
+                rows[path] = self.mtimes[path]
+                self.known[path] = self.mtimes[path]
+            for subdir in self.subdirs.get(path, ()):
+                if subdir not in self.known:
+                    rows[subdir] = self.known[subdir] = 0
+        if not rows:
+            return
+        self.cur.execute("INSERT INTO pv_scan_dirs (path, component, mtime) "
+                         "SELECT unnest(%s::text[]), %s, unnest(%s::bigint[]) "
+                         "ON CONFLICT (path) DO UPDATE SET "
+                         "component=excluded.component, mtime=excluded.mtime",
+                         (list(rows), self.comppath, list(rows.values())))
+
+def scan_dir(db, base_dir: str, branch: str, component: str, branch_idx: int,
+             full_walk=False, deadline=None, mpool=None, metadata_only=False):
+    """ Scan a branch/component. Returns the number of packages left
+        unscanned because the deadline was reached. Unless metadata_only,
+        packages left by earlier metadata-only scans are completed.
+    """
+    search_path = os.path.join('pool', branch, component)
+    cur = db.cursor()
+    cscan = ComponentScan(cur, base_dir, branch, component, branch_idx,
+                          metadata_only)
+    cur.execute("SELECT path, mtime FROM pv_scan_dirs WHERE component=%s",
+                (cscan.comppath,))
+    known_dirs = dict(cur)
+    with internal_stats.timer('walk', **cscan.labels):
+        found_files, unchanged_dirs, dir_mtimes = walk_pool(
+            base_dir, search_path, known_dirs, full_walk)
+    with internal_stats.timer('check', **cscan.labels):
+        cur.execute(SQL_KNOWN_PACKAGES.format(cond=''),
+                    {'comppath': cscan.comppath, 'branch': branch})
+        # No file was added, removed or renamed in unchanged directories
+        # since the last scan
+        ignore_files = cscan.check(
+            cur.fetchall(), lambda f: os.path.dirname(f) in unchanged_dirs)
+    # Check if there are any new files added in the directories we walked,
+    # and take notes of what we haven't seen yet.
+    check_list = []
+    for filename, st in found_files:
+        if filename in ignore_files:
+            continue
+        check_list.append((os.path.join(base_dir, filename), filename,
+                           st.st_size, int(st.st_mtime)))
+    # And the orphaned duplicates, which unchanged directories may hold.
+    # check() reset the mtime of their directories.
+    listed = set(row[1] for row in check_list)
+    for filename in cscan.orphans:
+        dirname = os.path.dirname(filename)
+        if dirname in known_dirs:
+            known_dirs[dirname] = 0
+        if filename in listed or dirname not in dir_mtimes:
+            continue
+        try:
+            st = os.stat(os.path.join(base_dir, filename))
+        except FileNotFoundError:
+            continue
+        check_list.append((os.path.join(base_dir, filename), filename,
+                           st.st_size, int(st.st_mtime)))
+    del ignore_files, found_files
+    # Directory by directory, so that they are completed early
+    check_list.sort(key=lambda row: row[1])
+    checkpoint = ScanCheckpoint(cur, cscan.comppath, known_dirs, dir_mtimes,
+                                (row[1] for row in check_list))
+    left = cscan.update(check_list, checkpoint, deadline, mpool)
+    if metadata_only or left:
+        return left
+    return cscan.complete(deadline, mpool)
+
+def scan_files(db, base_dir: str, branch: str, component: str,
+               branch_idx: int, filenames):
+    """ Scan only the given .deb files of a component, given relative to
+        base_dir. Files that no longer exist are removed from the database.
+    """
+    cur = db.cursor()
+    cscan = ComponentScan(cur, base_dir, branch, component, branch_idx)
+    # Other versions of the packages are loaded for classification once
+    # their names are known from the control files
+    cscan.loaded = set()
+    filenames = set(filenames)
+    cur.execute(SQL_KNOWN_PACKAGES.format(
+        cond='AND p.filename = ANY(%(filenames)s)'),
+        {'comppath': cscan.comppath, 'branch': branch,
+         'filenames': list(filenames)})
+    ignore_files = cscan.check(cur.fetchall())
+    check_list = []
+    for filename in sorted((filenames | cscan.orphans) - ignore_files):
+        fullpath = os.path.join(base_dir, filename)
+        try:
+            st = os.stat(fullpath)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            check_list.append((fullpath, filename,
+                               st.st_size, int(st.st_mtime)))
+    cscan.update(check_list)
+    cur.close()
 
 def table_mtime(db):
     cur = db.cursor()
@@ -247,10 +940,18 @@ def table_mtime(db):
     cur.close()
     return result
 
-def scan(db, base_dir: str, branch_list: list):
+def scan(db, base_dir: str, branch_list: list, full_walk=False,
+         deadline=None, dbpool=None, metadata_only=False):
+    """ Scan the configured branches. If dbpool, a psycopg2 connection
+        pool, is given, up to dbpool.maxconn components are scanned at the
+        same time, each on its own connection. Packages of all components
+        are scanned in the same scan_pool(). With metadata_only, only the
+        control files of new packages are read, see ComponentScan.
+    """
     pool_dir = base_dir + '/pool'
     internal_db.init_db(db)
     lastmtime = table_mtime(db)
+    components = []
     for i in PosixPath(pool_dir).iterdir():
         if not i.is_dir():
             continue
@@ -265,14 +966,53 @@ def scan(db, base_dir: str, branch_list: list):
         for j in PosixPath(pool_dir).joinpath(branch_name).iterdir():
             if not j.is_dir():
                 continue
-            component_name = j.name
-            logger_scan.info('==== %s-%s ====', branch_name, component_name)
-            try:
-                scan_dir(db, base_dir, branch_name, component_name, branch_idx)
-            finally:
-                db.commit()
+            components.append((branch_name, j.name, branch_idx))
+    cur = db.cursor()
+    internal_db.init_branches(cur, set(args[0] for args in components))
+    db.commit()
+
+    def scan_component(args):
+        branch_name, component_name, branch_idx = args
+        if deadline is not None and time.time() >= deadline:
+            logger_scan.warning('Deadline reached, skipping %s-%s',
+                                branch_name, component_name)
+            return
+        logger_scan.info('==== %s-%s ====', branch_name, component_name)
+        conn = db if dbpool is None else dbpool.getconn()
+        try:
+            left = scan_dir(conn, base_dir, branch_name, component_name,
+                            branch_idx, full_walk, deadline, mpool,
+                            metadata_only)
+            conn.commit()
+            module_ipc.flush()
+        except BaseException:
+            # Changes are only sent for what is in the database
+            conn.rollback()
+            module_ipc.discard()
+            raise
+        finally:
+            if dbpool is not None:
+                dbpool.putconn(conn)
+        if left:
+            logger_scan.warning('Deadline reached, %d packages in '
+                                '%s-%s left for the next scan',
+                                left, branch_name, component_name)
+
+    mpool = scan_pool()
+    try:
+        if dbpool is None:
+            for args in components:
+                scan_component(args)
+        else:
+            with multiprocessing.dummy.Pool(dbpool.maxconn) as cpool:
+                for _ in cpool.imap_unordered(scan_component, components):
+                    pass
+    finally:
+        mpool.terminate()
+        internal_pkgscan.close_workers()
     if branch_list:
         logger_scan.warning("Branches skipped as they are missing on disk: %s", " ".join(branch_list))
     refresh = (table_mtime(db) > lastmtime)
-    internal_db.init_index(db, refresh)
+    with internal_stats.timer('index'):
+        internal_db.init_index(db, refresh)
     #db.execute('ANALYZE')
@@ -1,13 +1,15 @@
 import os
 import sqlite3
 import logging
-import binascii
 import tempfile
 import threading
 
 import zlib
 import requests
 
+import internal_db
+import internal_stats
+
 URLBASE = 'https://packages.aosc.io/data/'
 
 TABLES = (
@@ -46,17 +48,6 @@ def download_db(url, filename, etag=None):
     r.close()
     return newetag
 
-def escape_val(x):
-    if isinstance(x, str):
-        return x.replace('\\', '\\\\').replace('\r', '\\r').replace(
-            '\n', '\\n').replace('\t', '\\t')
-    elif isinstance(x, bytes):
-        return '\\x' + binascii.b2a_hex(x).decode('ascii')
-    elif x is None:
-        return '\\N'
-    else:
-        return str(x)
-
 def make_copy(dbname, table, fd, idxcol=None):
     try:
         db = sqlite3.connect(dbname)
@@ -67,8 +58,8 @@ def make_copy(dbname, table, fd, idxcol=None):
     with open(fd, 'w', encoding='utf-8') as f:
         for row in cur:
             if idxcol is not None:
-                f.write(escape_val(idxcol) + '\t')
-            f.write('\t'.join(map(escape_val, row)))
+                f.write(internal_db.escape_val(idxcol) + '\t')
+            f.write('\t'.join(map(internal_db.escape_val, row)))
             f.write('\n')
     db.close()
 
@@ -81,9 +72,11 @@ def sync_table(cur, dbname, table, idxcol=None, prefix=None):
     pr, pw = os.pipe()
     thr = threading.Thread(target=make_copy, args=(dbname, table, pw, idxcol))
     thr.start()
-    with open(pr, 'rb') as f:
-        cur.copy_from(f, pgtable)
-    thr.join()
+    with internal_stats.timer('copy', table=pgtable):
+        with open(pr, 'rb') as f:
+            cur.copy_from(f, pgtable)
+        thr.join()
+    internal_stats.count('rows', cur.rowcount, table=pgtable)
 
 def sync_db(db):
     cur = db.cursor()
@@ -101,9 +94,11 @@ def sync_db(db):
     with tempfile.TemporaryDirectory() as tmpdir:
         for dbname, tables in TABLES:
             filename = os.path.join(tmpdir, dbname)
-            newetag = download_db(
-                URLBASE + dbname + '.gz', filename, etags.get(dbname))
+            with internal_stats.timer('download', db=dbname):
+                newetag = download_db(
+                    URLBASE + dbname + '.gz', filename, etags.get(dbname))
             if newetag == etags.get(dbname):
+                internal_stats.count('databases_skipped')
                 logger_sync.info('Skip %s', dbname)
                 continue
             logger_sync.info('Syncing %s', dbname)
@@ -122,9 +117,11 @@ def sync_db(db):
             dbname = srcrepo + MARKS_DB_SFX
             tid = treeids[srcrepo]
             filename = os.path.join(tmpdir, dbname)
-            newetag = download_db(
-                URLBASE + dbname + '.gz', filename, etags.get(dbname))
+            with internal_stats.timer('download', db=dbname):
+                newetag = download_db(
+                    URLBASE + dbname + '.gz', filename, etags.get(dbname))
             if newetag == etags.get(dbname):
+                internal_stats.count('databases_skipped')
                 logger_sync.info('Skip %s', dbname)
                 continue
             cur.execute("DELETE FROM pv_dbsync WHERE name=%s", (dbname,))
@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import signal
+import logging
+
+import internal_db
+import internal_inotify
+import internal_pkgscan
+import module_ipc
+import module_scan
+
+logger_watch = logging.getLogger('WATCH')
+
+# Seconds without events before a batch is scanned, and the longest a
+# change may wait while events keep arriving.
+quiet_time = 2
+max_delay = 30
+
+DIR_EVENTS = (internal_inotify.IN_CREATE | internal_inotify.IN_MOVED_TO |
+              internal_inotify.IN_MOVED_FROM | internal_inotify.IN_DELETE)
+WATCH_MASK = (DIR_EVENTS | internal_inotify.IN_CLOSE_WRITE |
+              internal_inotify.IN_ONLYDIR)
+
+
+class PoolWatcher(object):
+    """Watches pool/ of the configured branches.
+
+    Changed .deb files are collected per (branch, component) in pending;
+    components in rescan need a full scan_dir, e.g. because a directory
+    was moved out of the pool or the event queue overflowed.
+    """
+
+    def __init__(self, base_dir: str, branch_list: list):
+        self.base_dir = base_dir
+        self.branch_list = branch_list
+        self.inotify = internal_inotify.Inotify()
+        self.watches = {}
+        self.pending = {}
+        self.rescan = set()
+
+    def components(self):
+        for branch in self.branch_list:
+            try:
+                it = os.scandir(os.path.join(self.base_dir, 'pool', branch))
+            except FileNotFoundError:
+                continue
+            with it:
+                for entry in it:
+                    if entry.is_dir():
+                        yield branch, entry.name
+
+    def add_watch(self, path: str):
+        try:
+            wd = self.inotify.add_watch(
+                os.path.join(self.base_dir, path), WATCH_MASK)
+        except FileNotFoundError:
+            return
+        self.watches[wd] = path
+
+    def add_tree(self, top: str):
+        """ Watch top and its subdirectories, return the .deb files in them. """
+        files = []
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            try:
+                wd = self.inotify.add_watch(
+                    os.path.join(self.base_dir, path), WATCH_MASK)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            self.watches[wd] = path
+            try:
+                it = os.scandir(os.path.join(self.base_dir, path))
+            except FileNotFoundError:
+                continue
+            with it:
+                for entry in it:
+                    name = os.path.join(path, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(name)
+                    elif entry.name.endswith('.deb'):
+                        files.append(name)
+        return files
+
+    def start(self):
+        self.add_watch('pool')
+        for branch in self.branch_list:
+            self.add_watch(os.path.join('pool', branch))
+        for branch, component in self.components():
+            self.add_tree(os.path.join('pool', branch, component))
+
+    def handle(self, wd: int, mask: int, name: str):
+        if mask & internal_inotify.IN_Q_OVERFLOW:
+            logger_watch.warning('Event queue overflowed, rescanning')
+            self.rescan.update(self.components())
+            return
+        if mask & internal_inotify.IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        parent = self.watches.get(wd)
+        if parent is None:
+            return
+        path = os.path.join(parent, name)
+        parts = path.split('/')
+        if mask & internal_inotify.IN_ISDIR:
+            if len(parts) == 2:
+                # pool/<branch>
+                if (parts[1] in self.branch_list and
+                        mask & DIR_EVENTS & ~internal_inotify.IN_MOVED_FROM &
+                        ~internal_inotify.IN_DELETE):
+                    self.add_watch(path)
+                    for branch, component in self.components():
+                        if branch == parts[1]:
+                            self.add_tree(os.path.join(path, component))
+                            self.rescan.add((branch, component))
+                return
+            comp = (parts[1], parts[2])
+            if mask & (internal_inotify.IN_CREATE |
+                       internal_inotify.IN_MOVED_TO):
+                if len(parts) == 3:
+                    self.add_tree(path)
+                    self.rescan.add(comp)
+                else:
+                    self.pending.setdefault(comp, set()).update(
+                        self.add_tree(path))
+            elif mask & internal_inotify.IN_MOVED_FROM:
+                # The files inside left the pool without events of their own
+                self.rescan.add(comp)
+            # Files of deleted directories are reported one by one
+        elif len(parts) > 3 and name.endswith('.deb'):
+            comp = (parts[1], parts[2])
+            self.pending.setdefault(comp, set()).add(path)
+
+    def flush(self, db):
+        lastmtime = module_scan.table_mtime(db)
+        # Branches may have been created, or dropped by gc, since the scan
+        cur = db.cursor()
+        internal_db.init_branches(cur, set(
+            comp[0] for comp in self.rescan.union(self.pending)))
+        db.commit()
+        cur.close()
+        for branch, component in sorted(self.rescan):
+            comppath = os.path.join('pool', branch, component)
+            if not os.path.isdir(os.path.join(self.base_dir, comppath)):
+                # Removed components are left to gc
+                continue
+            logger_watch.info('==== %s-%s ====', branch, component)
+            try:
+                module_scan.scan_dir(db, self.base_dir, branch, component,
+                                     self.branch_list.index(branch))
+                db.commit()
+                module_ipc.flush()
+            except BaseException:
+                db.rollback()
+                module_ipc.discard()
+                raise
+        for (branch, component), files in sorted(self.pending.items()):
+            if (branch, component) in self.rescan:
+                continue
+            logger_watch.info('==== %s-%s: %d files ====',
+                              branch, component, len(files))
+            try:
+                module_scan.scan_files(db, self.base_dir, branch, component,
+                                       self.branch_list.index(branch), files)
+                db.commit()
+                module_ipc.flush()
+            except BaseException:
+                db.rollback()
+                module_ipc.discard()
+                raise
+        self.pending.clear()
+        self.rescan.clear()
+        if module_scan.table_mtime(db) > lastmtime:
+            internal_db.init_index(db, True)
+
+    def run(self, db):
+        first_event = last_event = None
+        while True:
+            timeout = None
+            if first_event is not None:
+                now = time.monotonic()
+                timeout = max(0, min(last_event + quiet_time,
+                                     first_event + max_delay) - now)
+            events = self.inotify.read(timeout)
+            for wd, mask, cookie, name in events:
+                self.handle(wd, mask, name)
+            now = time.monotonic()
+            if self.pending or self.rescan:
+                if first_event is None:
+                    first_event = now
+                if events:
+                    last_event = now
+                if (now >= last_event + quiet_time or
+                        now >= first_event + max_delay):
+                    self.flush(db)
+                    first_event = last_event = None
+
+
+def watch(db, base_dir: str, branch_list: list):
+    internal_db.init_db(db)
+    # SIGTERM should stop the scanners as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    watcher = PoolWatcher(base_dir, branch_list)
+    try:
+        # Watch first so that nothing is missed between the scan and the loop
+        watcher.start()
+        logger_watch.info('Watching %d directories', len(watcher.watches))
+        module_scan.scan(db, base_dir, list(branch_list))
+        watcher.run(db)
+    finally:
+        internal_pkgscan.close_workers()
+        watcher.inotify.close()
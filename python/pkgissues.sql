@@ -19,10 +19,21 @@ CREATE TEMP VIEW tv_updated AS
 SELECT coalesce(extract(epoch from max(atime)), 0)::integer t
 FROM pv_package_issues;
 
+-- Packages changed, or whose files were scanned, since the last run
 CREATE TEMP VIEW tv_pv_packages AS
-SELECT * FROM pv_packages WHERE mtime >= (SELECT t FROM tv_updated);
+SELECT * FROM pv_packages WHERE mtime >= (SELECT t FROM tv_updated)
+OR scantime >= (SELECT t FROM tv_updated);
 CREATE TEMP VIEW tv_packages_new AS
-SELECT * FROM v_packages_new WHERE mtime >= (SELECT t FROM tv_updated);
+SELECT n.* FROM v_packages_new n
+INNER JOIN tv_pv_packages USING (pkg_id);
+CREATE TEMP VIEW tv_package_files AS
+SELECT n.package, n.version, n.repo, p.path, f.name, f.size, f.ftype,
+  f.perm, f.uid, f.gid, u.name uname, g.name gname
+FROM pv_files f
+INNER JOIN tv_packages_new n USING (pkg_id)
+LEFT JOIN pv_paths p ON p.id=f.path_id
+LEFT JOIN pv_owners u ON u.id=f.uname_id
+LEFT JOIN pv_owners g ON g.id=f.gname_id;
 
 CREATE TEMP TABLE t_package_issues AS
 ----- 101 -----
@@ -160,8 +171,7 @@ SELECT f.package, f.version, f.repo, 321::int errno, 0::smallint "level",
   (CASE WHEN path='' THEN '' ELSE '/' || path END) || '/' || f.name filename,
   jsonb_build_object('size', f.size, 'perm', f.perm, 'uid', f.uid, 'gid', f.gid,
     'uname', f.uname, 'gname', f.gname, 'ftype', f.ftype) detail
-FROM pv_package_files f
-INNER JOIN tv_packages_new USING (package, version, repo)
+FROM tv_package_files f
 WHERE package!='aosc-aaa' AND ftype='reg' AND (path='usr/local' OR
   path !~ '^(bin|boot|etc|lib|opt|run|sbin|srv|usr|var)/?.*')
 UNION ALL ----- 322 -----
@@ -170,8 +180,7 @@ SELECT f.package, f.version, f.repo, 322::int errno,
   (CASE WHEN path='' THEN '' ELSE '/' || path END) || '/' || f.name filename,
   jsonb_build_object('size', f.size, 'perm', f.perm, 'uid', f.uid, 'gid', f.gid,
     'uname', f.uname, 'gname', f.gname, 'ftype', f.ftype) detail
-FROM pv_package_files f
-INNER JOIN tv_packages_new USING (package, version, repo)
+FROM tv_package_files f
 WHERE f.size=0 AND ftype='reg' AND perm & 1=1
 AND name NOT IN ('NEWS', 'ChangeLog', 'INSTALL', 'TODO', 'COPYING', 'AUTHORS',
   'README', 'README.md', 'README.txt', 'empty', 'placeholder', 'placeholder.txt')
@@ -183,16 +192,14 @@ SELECT f.package, f.version, f.repo, 323::int errno,
   (CASE WHEN path='' THEN '' ELSE '/' || path END) || '/' || name filename,
   jsonb_build_object('size', f.size, 'perm', f.perm, 'uid', f.uid, 'gid', f.gid,
     'uname', f.uname, 'gname', f.gname, 'ftype', f.ftype) detail
-FROM pv_package_files f
-INNER JOIN tv_packages_new USING (package, version, repo)
+FROM tv_package_files f
 WHERE uid>999 OR gid>999
 UNION ALL ----- 324 -----
 SELECT f.package, f.version, f.repo, 324::int errno, 0::smallint "level",
   (CASE WHEN path='' THEN '' ELSE '/' || path END) || '/' || name filename,
   jsonb_build_object('size', f.size, 'perm', f.perm, 'uid', f.uid, 'gid', f.gid,
     'uname', f.uname, 'gname', f.gname, 'ftype', f.ftype) detail
-FROM pv_package_files f
-INNER JOIN tv_packages_new USING (package, version, repo)
+FROM tv_package_files f
 WHERE (path IN ('bin', 'sbin', 'usr/bin') AND perm&1=0 AND ftype='reg')
 OR (ftype='dir' AND perm&64=0)
 UNION ALL ----- 401 -----
@@ -267,35 +274,34 @@ SELECT
   package, version, repo, errno, "level", filename, detail
 FROM (
   SELECT DISTINCT ON (package, version, repo, filename)
-    f1.package, f1.version, f1.repo, 421::int errno, 0::smallint "level",
-    (CASE WHEN f1.path='' THEN '' ELSE '/' || f1.path END) ||
+    v1.package, v1.version, v1.repo, 421::int errno, 0::smallint "level",
+    (CASE WHEN p1.path='' THEN '' ELSE '/' || p1.path END) ||
       '/' || f1.name filename,
     jsonb_object('{repo, package, version}',
-      ARRAY[f2.repo, f2.package, f2.version]) detail
-  FROM pv_package_files f1
-  INNER JOIN v_packages_new v1
-  ON v1.package=f1.package AND v1.version=f1.version AND v1.repo=f1.repo
+      ARRAY[v2.repo, v2.package, v2.version]) detail
+  FROM pv_files f1
+  INNER JOIN pv_paths p1 ON p1.id=f1.path_id
+  INNER JOIN v_packages_new v1 ON v1.pkg_id=f1.pkg_id
   INNER JOIN pv_repos r1 ON r1.name=v1.repo
   INNER JOIN pv_repos r2 ON r2.architecture IN (r1.architecture, 'all')
   AND r2.testing<=r1.testing AND r2.component=r1.component
   INNER JOIN v_packages_new v2
   ON v2.repo=r2.name AND v2.package!=v1.package
-  INNER JOIN pv_package_files f2
-  ON v2.package=f2.package AND v2.version=f2.version AND v2.repo=f2.repo
-  AND f2.path=f1.path AND f2.name=f1.name
+  INNER JOIN pv_files f2 ON f2.pkg_id=v2.pkg_id
+  AND f2.path_id=f1.path_id AND f2.name=f1.name
   LEFT JOIN v_dpkg_dependencies d1
-  ON d1.package=f1.package AND d1.version=f1.version AND d1.repo=f1.repo
+  ON d1.package=v1.package AND d1.version=v1.version AND d1.repo=v1.repo
   AND d1.relationship IN ('Breaks', 'Replaces', 'Conflicts')
   AND d1.deppkg=v2.package AND (d1.deparch IS NULL OR d1.deparch=r2.architecture)
   AND compare_dpkgrel(v2._vercomp, d1.relop, d1.depvercomp)
   LEFT JOIN v_dpkg_dependencies d2
   ON d2.package=v2.package AND d2.version=v2.version AND d2.repo=v2.repo
   AND d2.relationship IN ('Breaks', 'Replaces', 'Conflicts')
-  AND d2.deppkg=f1.package AND (d2.deparch IS NULL OR d2.deparch=r1.architecture)
+  AND d2.deppkg=v1.package AND (d2.deparch IS NULL OR d2.deparch=r1.architecture)
   AND compare_dpkgrel(v1._vercomp, d2.relop, d2.depvercomp)
   WHERE f1.ftype='reg' AND d1.package IS NULL AND d2.package IS NULL
-  AND (v1.mtime >= (SELECT t FROM tv_updated)
-    OR v2.mtime >= (SELECT t FROM tv_updated))
+  AND (v1.pkg_id IN (SELECT pkg_id FROM tv_pv_packages)
+    OR v2.pkg_id IN (SELECT pkg_id FROM tv_pv_packages))
   ORDER BY package, version, repo, filename, r2.testing DESC
 ) q2
 UNION ALL ----- 431 -----
@@ -309,24 +315,22 @@ FROM (
       ARRAY[repo_lib, package_lib, version_lib, ver_provide]) END detail
   FROM (
     SELECT
-      sd.package, sd.version, sd.repo, sd.name, rp.name repo_lib,
-      sp.package package_lib, sp.version version_lib, sd.ver, sp.ver ver_provide,
-      count(sp2.package) OVER w matchcnt
-    FROM pv_package_sodep sd
-    INNER JOIN v_packages_new vp USING (package, version, repo)
-    INNER JOIN pv_repos rd ON rd.name=sd.repo
+      vd.package, vd.version, vd.repo, sd.name, rp.name repo_lib,
+      pp.package package_lib, pp.version version_lib, sd.ver, sp.ver ver_provide,
+      count(sp2.pkg_id) OVER w matchcnt
+    FROM pv_sodep sd
+    INNER JOIN v_packages_new vd USING (pkg_id)
+    INNER JOIN pv_repos rd ON rd.name=vd.repo
     INNER JOIN pv_repos rp ON rd.architecture IN (rp.architecture, 'all')
     AND rp.testing<=rd.testing AND rp.component IN (rd.component, 'main')
-    LEFT JOIN pv_package_sodep sp ON sp.repo=rp.name
-    AND sp.depends=0 AND sd.name=sp.name
-    LEFT JOIN v_packages_new vp2
-    ON vp2.package=sp.package AND vp2.version=sp.version AND vp2.repo=sp.repo
-    LEFT JOIN pv_package_sodep sp2
-    ON sp2.repo=sp.repo AND sp2.package=sp.package AND sp2.version=sp.version
+    LEFT JOIN (pv_sodep sp INNER JOIN pv_packages pp USING (pkg_id, branch))
+    ON pp.repo=rp.name AND sp.depends=0 AND sd.name=sp.name
+    LEFT JOIN v_packages_new vp2 ON vp2.pkg_id=sp.pkg_id
+    LEFT JOIN pv_sodep sp2 ON sp2.pkg_id=sp.pkg_id
     AND sp.name=sp2.name AND sp.ver=sp2.ver AND sp2.depends=0
     AND (sp2.ver=sd.ver OR sp2.ver LIKE sd.ver || '.%')
-    WHERE sd.depends=1 AND (sp.package IS NULL OR vp2.package IS NOT NULL)
-    WINDOW w AS (PARTITION BY sd.package, sd.version, sd.repo, sd.name, sd.ver)
+    WHERE sd.depends=1 AND (sp.pkg_id IS NULL OR vp2.pkg_id IS NOT NULL)
+    WINDOW w AS (PARTITION BY vd.package, vd.version, vd.repo, sd.name, sd.ver)
   ) q3
   LEFT JOIN (
     SELECT sd.name, sd.package, count(dep.package) cnt
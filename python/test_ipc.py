@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import zmq
+
+import module_ipc
+
+
+class TestReplay(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp(prefix='pv-test-')
+        module_ipc.zmq_change = 'ipc://' + os.path.join(cls.tmpdir, 'changes')
+        module_ipc.zmq_replay = 'ipc://' + os.path.join(cls.tmpdir, 'replay')
+        module_ipc.change_log = os.path.join(cls.tmpdir, 'changes.log')
+        module_ipc.init()
+        for version in ('1', '2', '3'):
+            module_ipc.publish_change('stable-main', 'foo', 'amd64',
+                                      'upgrade', '0', version)
+        module_ipc.flush()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
+    def request(self, frames, socket_type=zmq.REQ):
+        sock = module_ipc.ctx.socket(socket_type)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt(zmq.RCVTIMEO, 5000)
+        sock.connect(module_ipc.zmq_replay)
+        try:
+            sock.send_multipart(frames)
+            return json.loads(sock.recv_multipart()[-1].decode('utf-8'))
+        finally:
+            sock.close()
+
+    def test_bad_requests(self):
+        # A DEALER sends no empty delimiter frame
+        self.assertIn('error', self.request([b'{"from": 0}'], zmq.DEALER))
+        for msg in (b'', b'\xff', b'[1]', b'{"from": "1"}', b'{"from": 1e400}'):
+            self.assertIn('error', self.request([msg]), msg)
+        # The replay thread is still serving
+        reply = self.request([b'{"from": 1}'])
+        self.assertEqual([change['seq'] for change in reply['changes']],
+                         [2, 3])
+        self.assertEqual(reply['changes'][0]['to_ver'], '2')
+        self.assertEqual(reply['last'], 3)
+
+
+class SmallChangeLog(module_ipc.ChangeLog):
+    INDEX_STEP = 2
+
+
+class TestChangeLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pv-test-')
+        self.path = os.path.join(self.tmpdir, 'changes.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_keep(self):
+        log = SmallChangeLog(self.path, keep=4)
+        for seq in range(1, 12):
+            log.append([{'seq': seq}])
+        # Rewritten with 4 lines at 8 lines
+        with open(self.path, 'rb') as f:
+            self.assertEqual([json.loads(line)['seq'] for line in f],
+                             list(range(5, 12)))
+        self.assertEqual([c['seq'] for c in log.read(0, 10)],
+                         list(range(5, 12)))
+        self.assertEqual([c['seq'] for c in log.read(6, 2)], [7, 8])
+        log.append([{'seq': 12}])
+        # Reopened, it continues from the last line
+        log = SmallChangeLog(self.path, keep=4)
+        self.assertEqual(log.last_seq, 12)
+        self.assertEqual([c['seq'] for c in log.read(0, 10)],
+                         [9, 10, 11, 12])
+        log.append([{'seq': 13}])
+        self.assertEqual([c['seq'] for c in log.read(10, 10)], [11, 12, 13])
+
+if __name__ == '__main__':
+    unittest.main()
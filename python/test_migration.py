@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import psycopg2
+
+import internal_db
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The tables and views init_db() created before package data were
+# partitioned and keyed by pkg_id
+SQL_BASELINE = '''
+CREATE TABLE pv_repos (name TEXT PRIMARY KEY, realname TEXT, path TEXT,
+  testing INTEGER, branch TEXT, component TEXT, architecture TEXT,
+  mtime TIMESTAMP WITH TIME ZONE);
+CREATE TABLE pv_packages (package TEXT, version TEXT, repo TEXT,
+  architecture TEXT, filename TEXT, size BIGINT, sha256 TEXT, mtime INTEGER,
+  debtime INTEGER, section TEXT, installed_size BIGINT, maintainer TEXT,
+  description TEXT, _vercomp TEXT, PRIMARY KEY (package, version, repo),
+  CONSTRAINT fkey_repo FOREIGN KEY (repo)
+  REFERENCES pv_repos (name) ON DELETE CASCADE INITIALLY DEFERRED);
+CREATE TABLE pv_package_duplicate (package TEXT, version TEXT, repo TEXT,
+  architecture TEXT, filename TEXT, size BIGINT, sha256 TEXT, mtime INTEGER,
+  debtime INTEGER, section TEXT, installed_size BIGINT, maintainer TEXT,
+  description TEXT, _vercomp TEXT, PRIMARY KEY (filename),
+  CONSTRAINT fkey_package FOREIGN KEY (package, version, repo)
+  REFERENCES pv_packages (package, version, repo)
+  ON DELETE CASCADE INITIALLY DEFERRED);
+CREATE TABLE pv_package_dependencies (package TEXT, version TEXT, repo TEXT,
+  relationship TEXT, value TEXT,
+  PRIMARY KEY (package, version, repo, relationship),
+  CONSTRAINT fkey_package FOREIGN KEY (package, version, repo)
+  REFERENCES pv_packages (package, version, repo)
+  ON DELETE CASCADE INITIALLY DEFERRED);
+CREATE TABLE pv_package_sodep (package TEXT, version TEXT, repo TEXT,
+  depends INTEGER, name TEXT, ver TEXT,
+  CONSTRAINT fkey_package FOREIGN KEY (package, version, repo)
+  REFERENCES pv_packages (package, version, repo)
+  ON DELETE CASCADE INITIALLY DEFERRED);
+CREATE TABLE pv_package_files (package TEXT, version TEXT, repo TEXT,
+  path TEXT, name TEXT, size BIGINT, ftype TEXT, perm INTEGER, uid BIGINT,
+  gid BIGINT, uname TEXT, gname TEXT,
+  CONSTRAINT fkey_package FOREIGN KEY (package, version, repo)
+  REFERENCES pv_packages (package, version, repo)
+  ON DELETE CASCADE INITIALLY DEFERRED);
+CREATE MATERIALIZED VIEW v_packages_new AS
+SELECT DISTINCT ON (repo, package) package, version, repo,
+  architecture, filename, size, sha256, mtime, debtime,
+  section, installed_size, maintainer, description, _vercomp
+FROM pv_packages WHERE debtime IS NOT NULL
+ORDER BY repo, package, _vercomp DESC;
+CREATE MATERIALIZED VIEW v_dpkg_dependencies AS
+SELECT d.package, d.version, d.repo, d.relationship, d.value
+FROM pv_package_dependencies d
+INNER JOIN v_packages_new n USING (package, version, repo);
+CREATE MATERIALIZED VIEW v_so_breaks AS
+SELECT sp.package, sp.repo, sp.name soname, sp.ver sover
+FROM pv_package_sodep sp
+INNER JOIN v_packages_new vp USING (package, version, repo);
+CREATE MATERIALIZED VIEW v_so_breaks_dep AS
+SELECT DISTINCT package FROM v_so_breaks;
+
+INSERT INTO pv_repos VALUES
+('amd64/stable', 'amd64', 'stable/main', 0, 'stable', 'main', 'amd64', NULL);
+INSERT INTO pv_packages VALUES
+('foo', '1.0', 'amd64/stable', 'amd64', 'pool/foo_1.0_amd64.deb', 1, 'a',
+ 1, 1, 'utils', 1, 'T', 'foo', comparable_dpkgver('1.0')),
+('foo', '1.1', 'amd64/stable', 'amd64', 'pool/foo_1.1_amd64.deb', 1, 'b',
+ 1, 1, 'utils', 1, 'T', 'foo', comparable_dpkgver('1.1'));
+INSERT INTO pv_package_duplicate
+SELECT package, version, repo, architecture, 'pool/x/foo_1.1_amd64.deb',
+  size, 'c', mtime, debtime, section, installed_size, maintainer,
+  description, _vercomp
+FROM pv_packages WHERE version='1.1';
+INSERT INTO pv_package_dependencies VALUES
+('foo', '1.1', 'amd64/stable', 'Depends', 'libc6 (>= 2.17), bar | baz');
+INSERT INTO pv_package_sodep VALUES
+('foo', '1.1', 'amd64/stable', 1, 'libc.so', '.6');
+INSERT INTO pv_package_files VALUES
+('foo', '1.1', 'amd64/stable', 'usr/bin', 'foo', 1, 'reg', 493, 0, 0,
+ 'root', 'root');
+REFRESH MATERIALIZED VIEW v_packages_new;
+'''
+
+class TestMigration(unittest.TestCase):
+    dbname = 'pv_test_migration'
+
+    def setUp(self):
+        admin = psycopg2.connect('dbname=postgres')
+        admin.autocommit = True
+        with admin.cursor() as cur:
+            cur.execute('DROP DATABASE IF EXISTS %s' % self.dbname)
+            cur.execute('CREATE DATABASE %s' % self.dbname)
+        admin.close()
+        self.db = psycopg2.connect('dbname=%s' % self.dbname)
+        cur = self.db.cursor()
+        for name in ('abbsdb.sql', 'vercomp.sql'):
+            with open(os.path.join(HERE, name), 'r', encoding='utf-8') as f:
+                cur.execute(f.read())
+        cur.execute(SQL_BASELINE)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        admin = psycopg2.connect('dbname=postgres')
+        admin.autocommit = True
+        with admin.cursor() as cur:
+            cur.execute('DROP DATABASE IF EXISTS %s' % self.dbname)
+        admin.close()
+
+    def test_baseline(self):
+        internal_db.init_db(self.db)
+        internal_db.init_index(self.db)
+        cur = self.db.cursor()
+        cur.execute("SELECT relname FROM pg_class WHERE relname LIKE '%_old'")
+        self.assertEqual(cur.fetchall(), [])
+        cur.execute('SELECT package, version, branch FROM pv_packages '
+                    'ORDER BY version')
+        self.assertEqual(cur.fetchall(), [('foo', '1.0', 'stable'),
+                                          ('foo', '1.1', 'stable')])
+        cur.execute('SELECT p.version, d.filename FROM pv_package_duplicate d '
+                    'INNER JOIN pv_packages p USING (pkg_id, branch)')
+        self.assertEqual(cur.fetchall(),
+                         [('1.1', 'pool/x/foo_1.1_amd64.deb')])
+        cur.execute('SELECT version, value FROM pv_package_dependencies')
+        self.assertEqual(cur.fetchall(),
+                         [('1.1', 'libc6 (>= 2.17), bar | baz')])
+        cur.execute('SELECT version, name, ver FROM pv_package_sodep')
+        self.assertEqual(cur.fetchall(), [('1.1', 'libc.so', '.6')])
+        cur.execute('SELECT version, path, name, uname FROM pv_package_files')
+        self.assertEqual(cur.fetchall(), [('1.1', 'usr/bin', 'foo', 'root')])
+        cur.execute('SELECT package, version FROM v_packages_new')
+        self.assertEqual(cur.fetchall(), [('foo', '1.1')])
+        cur.execute('SELECT version, nr, deppkg, relop, depver, depvercomp '
+                    'FROM v_dpkg_dependencies ORDER BY nr, deppkg')
+        self.assertEqual(cur.fetchall(), [
+            ('1.1', 1, 'libc6', '>=', '2.17', '00!102h11171!1'),
+            ('1.1', 2, 'bar', None, None, None),
+            ('1.1', 2, 'baz', None, None, None)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import bench_scan
+import internal_pkgscan
+
+HAVE_CLI = os.access(internal_pkgscan.PKGSCAN_CLI, os.X_OK)
+HAVE_SCANNER = internal_pkgscan._pkgscan is not None or HAVE_CLI
+
+
+@unittest.skipUnless(HAVE_SCANNER, 'neither pkgscan_cli nor _pkgscan is built')
+class TestDecodeBinary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pv-test-')
+        self.path = os.path.join(self.tmpdir, 'foo_1.0-1_amd64.deb')
+        bench_scan.make_deb(self.path, 'foo', ['libc'], [
+            ('./', None, 0o755), ('./usr/', None, 0o755),
+            ('./usr/lib/', None, 0o755),
+            ('./usr/lib/libfoo.so.1',
+             bench_scan.elf_so('libfoo.so.1', ['libc.so.6', 'libm.so.6']),
+             0o755),
+            ('./usr/share/été', b'summer', 0o644)], 'xz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_decode(self):
+        result = internal_pkgscan.decode_binary(
+            internal_pkgscan.scan_raw(self.path))
+        self.assertEqual(result['size'], os.path.getsize(self.path))
+        self.assertEqual(result['hash_value'].hex(),
+                         internal_pkgscan.sha256_file(self.path))
+        self.assertEqual(result['time'], 1700000000)
+        self.assertIn('Package: foo\n', result['control'])
+        self.assertEqual(result['so_provides'], ['libfoo.so.1'])
+        self.assertEqual(sorted(result['so_depends']),
+                         ['libc.so.6', 'libm.so.6'])
+        files = {f[0]: f[1:] for f in result['files']}
+        self.assertEqual(sorted(files), [
+            './', './usr/', './usr/lib/', './usr/lib/libfoo.so.1',
+            './usr/share/été'])
+        self.assertEqual(files['./usr/share/été'],
+                         (6, 0o100000, 0o644, 0, 0, 'root', 'root'))
+        self.assertEqual(files['./usr/'][1:3], (0o040000, 0o755))
+
+    @unittest.skipUnless(HAVE_CLI, 'pkgscan_cli is not built')
+    def test_same_as_json(self):
+        doc = json.loads(subprocess.run(
+            [internal_pkgscan.PKGSCAN_CLI, self.path],
+            stdout=subprocess.PIPE, check=True).stdout)
+        doc['hash_value'] = bytes(doc['hash_value'])
+        doc['files'] = [(f['path'], f['size'], f['type'], f['perm'], f['uid'],
+                         f['gid'], f['uname'], f['gname'])
+                        for f in doc['files']]
+        worker = internal_pkgscan.ScanWorker()
+        try:
+            buf = worker.scan(self.path)
+            # The worker is reused
+            self.assertEqual(worker.scan(self.path), buf)
+        finally:
+            worker.close()
+        self.assertEqual(internal_pkgscan.decode_binary(buf), doc)
+        if internal_pkgscan._pkgscan is not None:
+            self.assertEqual(internal_pkgscan._pkgscan.scan(self.path, False),
+                             buf)
+
+    def test_control_only(self):
+        result = internal_pkgscan.decode_binary(
+            internal_pkgscan.scan_raw(self.path, True))
+        self.assertIn('Package: foo\n', result['control'])
+        self.assertEqual(result['files'], [])
+        self.assertEqual(result['so_provides'], [])
+
+    def test_errors(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            internal_pkgscan.scan_raw(os.path.join(self.tmpdir, 'missing.deb'))
+        self.assertEqual(cm.exception.returncode, 1)
+        corrupted = os.path.join(self.tmpdir, 'bar_1.0-1_amd64.deb')
+        with open(self.path, 'rb') as f, open(corrupted, 'wb') as out:
+            out.write(f.read()[:300])
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            internal_pkgscan.scan_raw(corrupted)
+        self.assertEqual(cm.exception.returncode, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import multiprocessing.dummy
+
+import psycopg2
+import psycopg2.extras
+
+import bench_scan
+import internal_db
+import internal_pkgscan
+import module_gc
+import module_ipc
+import module_scan
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HAVE_SCANNER = (internal_pkgscan._pkgscan is not None or
+                os.access(internal_pkgscan.PKGSCAN_CLI, os.X_OK))
+
+
+class TestVersionIndex(unittest.TestCase):
+
+    def test_classify(self):
+        index = module_scan.VersionIndex()
+        self.assertEqual(index.classify('foo', 'amd64/stable', '1.0'),
+                         ('new', None))
+        index.add('foo', 'amd64/stable', '1.0', 'foo_1.0.deb')
+        index.add('foo', 'amd64/stable', '1.0~rc1', 'foo_1.0~rc1.deb')
+        self.assertEqual(index.classify('foo', 'amd64/stable', '1.0+b1'),
+                         ('newer', ('1.0', 'foo_1.0.deb')))
+        self.assertEqual(index.classify('foo', 'amd64/stable', '1.0~beta'),
+                         ('old', ('1.0', 'foo_1.0.deb')))
+        self.assertEqual(index.classify('foo', 'amd64/stable', '1.0~rc1'),
+                         ('dup', ('1.0~rc1', 'foo_1.0~rc1.deb')))
+        self.assertEqual(index.classify('foo', 'noarch/stable', '1.0'),
+                         ('new', None))
+        # The last file added with a version takes its place
+        index.add('foo', 'amd64/stable', '1.0', 'bar/foo_1.0.deb')
+        self.assertEqual(index.classify('foo', 'amd64/stable', '1.0'),
+                         ('dup', ('1.0', 'bar/foo_1.0.deb')))
+        # Versions equal to dpkg but spelled differently are kept apart
+        self.assertNotEqual(index.classify('foo', 'amd64/stable', '0:1.0')[0],
+                            'dup')
+
+
+class TestWalkPool(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp(prefix='pv-test-')
+        for path in ('pool/a/x/foo.deb', 'pool/a/y/bar.deb', 'pool/b/baz.deb',
+                     'pool/b/README'):
+            path = os.path.join(self.base_dir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb'):
+                pass
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def walk(self, known, full_walk=False):
+        files, unchanged, mtimes = module_scan.walk_pool(
+            self.base_dir, 'pool', known, full_walk)
+        return sorted(f for f, st in files), unchanged, mtimes
+
+    def test_walk(self):
+        files, unchanged, mtimes = self.walk({})
+        self.assertEqual(files, ['pool/a/x/foo.deb', 'pool/a/y/bar.deb',
+                                 'pool/b/baz.deb'])
+        self.assertEqual(unchanged, set())
+        self.assertEqual(sorted(mtimes), ['pool', 'pool/a', 'pool/a/x',
+                                          'pool/a/y', 'pool/b'])
+        # Unchanged directories are not listed, their known ones are visited
+        known = dict(mtimes)
+        del known['pool/a/y']
+        known['pool/b'] = 0
+        files, unchanged, mtimes2 = self.walk(known)
+        self.assertEqual(files, ['pool/b/baz.deb'])
+        self.assertEqual(unchanged, {'pool', 'pool/a', 'pool/a/x'})
+        # ScanCheckpoint records every subdirectory, unknown ones are skipped
+        self.assertEqual(sorted(mtimes2), ['pool', 'pool/a', 'pool/a/x',
+                                           'pool/b'])
+        files, unchanged, _ = self.walk(known, full_walk=True)
+        self.assertEqual(len(files), 3)
+        self.assertEqual(unchanged, set())
+        # Gone directories are left out
+        shutil.rmtree(os.path.join(self.base_dir, 'pool/a/x'))
+        files, unchanged, mtimes = self.walk(known)
+        self.assertEqual(files, ['pool/a/y/bar.deb', 'pool/b/baz.deb'])
+        self.assertNotIn('pool/a/x', mtimes)
+
+
+@unittest.skipUnless(HAVE_SCANNER, 'neither pkgscan_cli nor _pkgscan is built')
+class TestScan(unittest.TestCase):
+    dbname = 'pv_test_scan'
+
+    def setUp(self):
+        admin = psycopg2.connect('dbname=postgres')
+        admin.autocommit = True
+        with admin.cursor() as cur:
+            cur.execute('DROP DATABASE IF EXISTS %s' % self.dbname)
+            cur.execute('CREATE DATABASE %s' % self.dbname)
+        admin.close()
+        self.db = psycopg2.connect('dbname=%s' % self.dbname,
+                                   cursor_factory=psycopg2.extras.DictCursor)
+        with open(os.path.join(HERE, 'abbsdb.sql'), 'r',
+                  encoding='utf-8') as f:
+            self.db.cursor().execute(f.read())
+        self.db.commit()
+        self.base_dir = tempfile.mkdtemp(prefix='pv-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+        self.db.close()
+        admin = psycopg2.connect('dbname=postgres')
+        admin.autocommit = True
+        with admin.cursor() as cur:
+            cur.execute('DROP DATABASE IF EXISTS %s' % self.dbname)
+        admin.close()
+
+    def write_deb(self, filename, package, content, version='1.0-1',
+                  depends=()):
+        """ Write pool/stable/main/filename, shipping content in a file. """
+        path = os.path.join(self.base_dir, 'pool', 'stable', 'main', filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        bench_scan.make_deb(path, package, depends, [
+            ('./', None, 0o755), ('./usr/', None, 0o755),
+            ('./usr/share/', None, 0o755),
+            ('./usr/share/' + package, content, 0o644)], 'gz', version)
+        return path
+
+    def scan(self, full_walk=False):
+        module_scan.scan(self.db, self.base_dir, ['stable'], full_walk)
+
+    def query(self, sql):
+        cur = self.db.cursor()
+        cur.execute(sql)
+        return [tuple(row) for row in cur]
+
+    def test_merge_staging(self):
+        self.write_deb('f/foo_1.0-1_amd64.deb', 'foo', b'foo', '1.0-1',
+                       ['bar (>= 2.0) | baz', 'libc'])
+        self.scan()
+        self.assertEqual(
+            self.query('SELECT package, version, repo, relationship, value '
+                       'FROM pv_package_dependencies'),
+            [('foo', '1.0-1', 'amd64/stable', 'Depends',
+              'bar (>= 2.0) | baz, libc')])
+        self.assertEqual(
+            self.query('SELECT nr, deppkg, relop, depver '
+                       'FROM pv_dpkg_dependencies ORDER BY nr, deppkg'),
+            [(1, 'bar', '>=', '2.0'), (1, 'baz', None, None),
+             (2, 'libc', None, None)])
+        # Overwritten in place: the rows of the old file are replaced
+        self.write_deb('f/foo_1.0-1_amd64.deb', 'foo', b'foo, again',
+                       '1.0-1', ['qux'])
+        self.scan(full_walk=True)
+        self.assertEqual(
+            self.query('SELECT package, filename, sha256 FROM pv_packages'),
+            [('foo', 'pool/stable/main/f/foo_1.0-1_amd64.deb',
+              internal_pkgscan.sha256_file(os.path.join(
+                  self.base_dir, 'pool/stable/main/f/foo_1.0-1_amd64.deb')))])
+        self.assertEqual(
+            self.query('SELECT relationship, value '
+                       'FROM pv_package_dependencies'),
+            [('Depends', 'qux')])
+        self.assertEqual(
+            self.query('SELECT deppkg FROM pv_dpkg_dependencies'), [('qux',)])
+        self.assertEqual(
+            self.query("SELECT name, size FROM pv_package_files "
+                       "WHERE ftype='reg'"), [('foo', 10)])
+        self.assertEqual(
+            self.query('SELECT filename FROM pv_package_duplicate'), [])
+
+    def test_duplicates_in_one_scan(self):
+        self.write_deb('a/foo_1.0-1_amd64.deb', 'foo', b'a')
+        self.write_deb('b/foo_1.0-1_amd64.deb', 'foo', b'b')
+        self.write_deb('c/foo_0.9-1_amd64.deb', 'foo', b'c', '0.9-1')
+        with self.assertLogs('SCAN', 'WARNING') as logs:
+            self.scan()
+        self.assertEqual(
+            [line.split(':', 2)[2] for line in logs.output
+             if line.startswith(('ERROR', 'WARNING:SCAN:OLD'))],
+            ['DUP    pool/stable/main/a/foo_1.0-1_amd64.deb == '
+             'pool/stable/main/b/foo_1.0-1_amd64.deb',
+             'OLD    amd64 foo 0.9-1'])
+        # Files are scanned in order, the last one of a version wins
+        self.assertEqual(
+            self.query('SELECT version, filename FROM pv_packages '
+                       'ORDER BY version'),
+            [('0.9-1', 'pool/stable/main/c/foo_0.9-1_amd64.deb'),
+             ('1.0-1', 'pool/stable/main/b/foo_1.0-1_amd64.deb')])
+        self.assertEqual(
+            self.query('SELECT filename FROM pv_package_duplicate'),
+            [('pool/stable/main/a/foo_1.0-1_amd64.deb',)])
+        self.scan(full_walk=True)
+        self.assertEqual(
+            self.query('SELECT filename FROM pv_package_duplicate'),
+            [('pool/stable/main/a/foo_1.0-1_amd64.deb',)])
+
+    def test_incremental_walk(self):
+        self.write_deb('a/foo_1.0-1_amd64.deb', 'foo', b'foo')
+        self.scan()
+        comp = os.path.join(self.base_dir, 'pool', 'stable', 'main')
+        self.assertEqual(
+            self.query('SELECT path, mtime FROM pv_scan_dirs ORDER BY path'),
+            [(path, os.stat(os.path.join(self.base_dir, path)).st_mtime_ns)
+             for path in ('pool/stable/main', 'pool/stable/main/a')])
+        # Hidden from scans that trust the directory mtime
+        st = os.stat(os.path.join(comp, 'a'))
+        self.write_deb('a/bar_1.0-1_amd64.deb', 'bar', b'bar')
+        os.utime(os.path.join(comp, 'a'), ns=(st.st_atime_ns, st.st_mtime_ns))
+        # In a new directory, found through its parent
+        self.write_deb('b/c/baz_1.0-1_amd64.deb', 'baz', b'baz')
+        self.scan()
+        self.assertEqual(
+            self.query('SELECT package FROM pv_packages ORDER BY package'),
+            [('baz',), ('foo',)])
+        self.scan(full_walk=True)
+        self.assertEqual(
+            self.query('SELECT package FROM pv_packages ORDER BY package'),
+            [('bar',), ('baz',), ('foo',)])
+        self.assertEqual(
+            self.query('SELECT path FROM pv_scan_dirs ORDER BY path'),
+            [('pool/stable/main',), ('pool/stable/main/a',),
+             ('pool/stable/main/b',), ('pool/stable/main/b/c',)])
+
+    def test_resume(self):
+        self.write_deb('a/foo_1.0-1_amd64.deb', 'foo', b'foo')
+        self.write_deb('b/bar_1.0-1_amd64.deb', 'bar', b'bar')
+        internal_db.init_db(self.db)
+        internal_db.init_branches(self.db.cursor(), {'stable'})
+        self.db.commit()
+        left = module_scan.scan_dir(self.db, self.base_dir, 'stable', 'main',
+                                    0, deadline=time.time() - 1)
+        self.db.commit()
+        self.assertEqual(left, 2)
+        self.assertEqual(self.query('SELECT package FROM pv_packages'), [])
+        # Listed again next time
+        self.assertEqual(
+            self.query('SELECT path, mtime FROM pv_scan_dirs '
+                       "WHERE path != 'pool/stable/main' ORDER BY path"),
+            [('pool/stable/main/a', 0), ('pool/stable/main/b', 0)])
+
+        def interrupted(compname, package, *args):
+            if package == 'bar':
+                raise RuntimeError('interrupted')
+
+        # Interrupted at bar, after foo was committed on its own
+        with multiprocessing.dummy.Pool(1) as mpool, \
+                mock.patch.object(module_scan, 'batch_size', 1), \
+                mock.patch.object(module_ipc, 'publish_change', interrupted):
+            with self.assertRaises(RuntimeError):
+                module_scan.scan_dir(self.db, self.base_dir, 'stable', 'main',
+                                     0, mpool=mpool)
+        self.db.rollback()
+        self.assertEqual(self.query('SELECT package FROM pv_packages'),
+                         [('foo',)])
+        self.assertEqual(
+            self.query('SELECT path, mtime != 0 FROM pv_scan_dirs '
+                       "WHERE path != 'pool/stable/main' ORDER BY path"),
+            [('pool/stable/main/a', True), ('pool/stable/main/b', False)])
+        with mock.patch.object(module_scan, 'scan_deb',
+                               mock.Mock(wraps=module_scan.scan_deb)) as counted:
+            self.scan()
+        scanned = [call[0][0][1] for call in counted.call_args_list]
+        self.assertEqual(scanned, ['pool/stable/main/b/bar_1.0-1_amd64.deb'])
+        self.assertEqual(
+            self.query('SELECT package FROM pv_packages ORDER BY package'),
+            [('bar',), ('foo',)])
+
+    def test_delete_winner_keeps_duplicate(self):
+        kept = self.write_deb('a/foo_1.0-1_amd64.deb', 'foo', b'a')
+        self.scan()
+        path = self.write_deb('b/foo_1.0-1_amd64.deb', 'foo', b'b')
+        self.scan()
+        self.assertEqual(self.query('SELECT filename FROM pv_packages'),
+                         [('pool/stable/main/b/foo_1.0-1_amd64.deb',)])
+        self.assertEqual(
+            self.query('SELECT filename FROM pv_package_duplicate'),
+            [('pool/stable/main/a/foo_1.0-1_amd64.deb',)])
+        # Directory a is unchanged, its file takes the place of b's
+        os.remove(path)
+        for _ in range(2):
+            self.scan()
+            self.assertEqual(
+                self.query('SELECT filename, sha256 FROM pv_packages'),
+                [('pool/stable/main/a/foo_1.0-1_amd64.deb',
+                  internal_pkgscan.sha256_file(kept))])
+            self.assertEqual(
+                self.query('SELECT filename FROM pv_package_duplicate'), [])
+
+    def test_purge_paths(self):
+        path = self.write_deb('f/foo_1.0-1_amd64.deb', 'foo', b'foo')
+        self.scan()
+        self.assertEqual(
+            self.query('SELECT path, name, uname, gname FROM pv_package_files '
+                       "WHERE ftype='reg'"),
+            [('usr/share', 'foo', 'root', 'root')])
+        with self.assertRaises(psycopg2.IntegrityError):
+            self.query("DELETE FROM pv_paths WHERE path='usr/share'")
+        self.db.rollback()
+        os.remove(path)
+        self.scan()
+        # Locked by a scan that is adding files in it
+        other = psycopg2.connect('dbname=%s' % self.dbname)
+        other.cursor().execute("SELECT 1 FROM pv_paths "
+                               "WHERE path='usr/share' FOR KEY SHARE")
+        module_gc.purge_paths(self.db)
+        self.assertEqual(self.query('SELECT path FROM pv_paths'),
+                         [('usr/share',)])
+        self.assertEqual(self.query('SELECT name FROM pv_owners'), [])
+        other.rollback()
+        other.close()
+        module_gc.purge_paths(self.db)
+        self.assertEqual(self.query('SELECT path FROM pv_paths'), [])
+
+    def test_shared_paths(self):
+        self.write_deb('f/foo_1.0-1_amd64.deb', 'foo', b'foo')
+        bar = self.write_deb('b/bar_1.0-1_amd64.deb', 'bar', b'bar')
+        self.scan()
+        self.assertEqual(
+            self.query('SELECT path FROM pv_paths ORDER BY path'),
+            [('',), ('usr',), ('usr/share',)])
+        self.assertEqual(self.query('SELECT name FROM pv_owners'),
+                         [('root',)])
+        self.assertEqual(
+            self.query("SELECT package, path, name FROM pv_package_files "
+                       "WHERE ftype='reg' ORDER BY package"),
+            [('bar', 'usr/share', 'bar'), ('foo', 'usr/share', 'foo')])
+        # Still used by foo
+        os.remove(bar)
+        self.scan()
+        module_gc.purge_paths(self.db)
+        self.assertEqual(
+            self.query('SELECT count(*) FROM pv_paths'), [(3,)])
+        self.assertEqual(
+            self.query("SELECT package, path, name FROM pv_package_files "
+                       "WHERE ftype='reg'"), [('foo', 'usr/share', 'foo')])
+
+    def test_pkg_id(self):
+        self.write_deb('a/foo_1.0-1_amd64.deb', 'foo', b'a', '1.0-1', ['bar'])
+        self.write_deb('b/foo_1.0-1_amd64.deb', 'foo', b'b', '1.0-1', ['bar'])
+        self.scan()
+        (old_id,), = self.query('SELECT pkg_id FROM pv_packages')
+        self.assertEqual(
+            self.query('SELECT pkg_id, filename FROM pv_package_duplicate'),
+            [(old_id, 'pool/stable/main/a/foo_1.0-1_amd64.deb')])
+        # The new winner has a new pkg_id, which the duplicates follow
+        self.write_deb('c/foo_1.0-1_amd64.deb', 'foo', b'c', '1.0-1', ['baz'])
+        self.scan()
+        (new_id, filename), = self.query(
+            'SELECT pkg_id, filename FROM pv_packages')
+        self.assertNotEqual(new_id, old_id)
+        self.assertEqual(filename, 'pool/stable/main/c/foo_1.0-1_amd64.deb')
+        self.assertEqual(
+            self.query('SELECT pkg_id, filename FROM pv_package_duplicate '
+                       'ORDER BY filename'),
+            [(new_id, 'pool/stable/main/a/foo_1.0-1_amd64.deb'),
+             (new_id, 'pool/stable/main/b/foo_1.0-1_amd64.deb')])
+        for table in ('pv_dependencies', 'pv_dpkg_dependencies', 'pv_files'):
+            self.assertEqual(
+                self.query('SELECT DISTINCT pkg_id FROM %s' % table),
+                [(new_id,)], table)
+        self.assertEqual(self.query('SELECT value FROM pv_dependencies'),
+                         [('baz',)])
+        self.assertEqual(
+            self.query("SELECT name FROM pv_files WHERE ftype='reg'"),
+            [('foo',)])
+
+    def test_scan_files_classifies_by_control(self):
+        self.write_deb('f/foo_1.0-1_amd64.deb', 'foo', b'foo')
+        self.scan()
+        # Named unlike the package they hold
+        self.write_deb('z/zz_1.0_amd64.deb', 'foo', b'dup')
+        self.write_deb('z/zz_2.0_amd64.deb', 'foo', b'new', '2.0')
+        with mock.patch.object(module_ipc, 'publish_change') as publish:
+            module_scan.scan_files(
+                self.db, self.base_dir, 'stable', 'main', 0,
+                ['pool/stable/main/z/zz_1.0_amd64.deb',
+                 'pool/stable/main/z/zz_2.0_amd64.deb'])
+        self.db.commit()
+        self.assertEqual(publish.call_args_list, [mock.call(
+            'stable-main', 'foo', 'amd64', 'upgrade', '1.0-1', '2.0')])
+        self.assertEqual(
+            self.query('SELECT version, filename FROM pv_packages '
+                       'ORDER BY version'),
+            [('1.0-1', 'pool/stable/main/z/zz_1.0_amd64.deb'),
+             ('2.0', 'pool/stable/main/z/zz_2.0_amd64.deb')])
+        self.assertEqual(
+            self.query('SELECT filename FROM pv_package_duplicate'),
+            [('pool/stable/main/f/foo_1.0-1_amd64.deb',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
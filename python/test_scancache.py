@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import bench_scan
+import internal_pkgscan
+import internal_scancache
+
+HAVE_SCANNER = (internal_pkgscan._pkgscan is not None or
+                os.access(internal_pkgscan.PKGSCAN_CLI, os.X_OK))
+
+
+@unittest.skipUnless(HAVE_SCANNER, 'neither pkgscan_cli nor _pkgscan is built')
+class TestScanCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pv-test-')
+        self.pool_dir = os.path.join(self.tmpdir, 'pool')
+        self.cache = internal_scancache.ScanCache(
+            os.path.join(self.tmpdir, 'cache'))
+        self.scanned = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def write_deb(self, name, content):
+        path = os.path.join(self.pool_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        bench_scan.make_deb(path, 'foo', [], [
+            ('./', None, 0o755), ('./foo', content, 0o644)], 'gz')
+        return path
+
+    def scan_raw(self, path):
+        self.scanned.append(path)
+        return internal_pkgscan.scan_raw(path)
+
+    def objects(self):
+        return sorted(prefix + name for prefix in os.listdir(self.cache.path)
+                      if len(prefix) == 2
+                      for name in os.listdir(os.path.join(self.cache.path,
+                                                          prefix)))
+
+    def test_lookup(self):
+        path = self.write_deb('a/foo.deb', b'a')
+        self.assertIsNone(self.cache.lookup(path))
+        buf = self.cache.scan_raw(path, self.scan_raw)
+        self.assertEqual(self.cache.scan_raw(path, self.scan_raw), buf)
+        self.assertEqual(self.scanned, [path])
+        # Touched: found by content, then by the updated entry
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(self.cache.lookup(path), buf)
+        self.assertEqual(self.cache.scan_raw(path, self.scan_raw), buf)
+        # A copy is scanned, but stores no new record
+        copy = os.path.join(self.pool_dir, 'b', 'foo.deb')
+        os.makedirs(os.path.dirname(copy))
+        shutil.copy(path, copy)
+        self.assertEqual(self.cache.scan_raw(copy, self.scan_raw), buf)
+        self.assertEqual(self.scanned, [path, copy])
+        self.assertEqual(len(self.objects()), 1)
+
+    def test_prune(self):
+        kept = self.write_deb('a/foo.deb', b'a')
+        removed = self.write_deb('b/foo.deb', b'b')
+        self.cache.scan_raw(kept, self.scan_raw)
+        self.cache.scan_raw(removed, self.scan_raw)
+        # Overwritten with other content, under a new inode
+        os.remove(removed)
+        replaced = self.write_deb('b/foo.deb', b'c')
+        self.cache.scan_raw(replaced, self.scan_raw)
+        self.assertEqual(len(self.objects()), 3)
+        self.assertEqual(self.cache.prune(self.pool_dir), 1)
+        self.assertEqual(self.objects(),
+                         sorted([internal_pkgscan.sha256_file(kept),
+                                 internal_pkgscan.sha256_file(replaced)]))
+        self.assertEqual(self.cache._index().execute(
+            "SELECT count(*) FROM files").fetchone()[0], 2)
+        self.scanned = []
+        self.cache.scan_raw(kept, self.scan_raw)
+        self.cache.scan_raw(replaced, self.scan_raw)
+        self.assertEqual(self.scanned, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
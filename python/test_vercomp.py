@@ -3,6 +3,7 @@
 
 import internal_dpkg_version
 import string
+import functools
 import unittest
 import hypothesis
 from hypothesis.strategies import text
@@ -12,6 +13,19 @@ import psycopg2
 class TestVercomp(unittest.TestCase):
     cmpmap = {'<': -1, '==': 0, '>': 1}
 
+    versions = ['1:1.0-0.1', '20060611-0.0', '1:5000', '1.0final-5', 
+        '4.2.0a+stable-2sarge1', '0.52.2-5.1', '1.8RC4b', '1.0-0.1', '1.5', 
+        '1.5~dev0', '1.1.0+cvs20060620-1+1.0', 
+        '0.9.2+cvs.1.0.dev.2004.07.28-1.5', '1.5~rc2', '10.11.1.3-2', 
+        '11:5000', '0.2.0-1+b1', '1.1.0+cvs20060620-1+2.6.15-8', '100:500', 
+        '1.0pre7-2', '1.5~rc1', '0.9.2-5', '1:1.0', 'a', '7.0-035+1', '1.5+b1', 
+        '1.0a7-2', '1:1.8.8-070403-1~priv1', '1.1', '0', '1.0final-5sarge1', 
+        '1.0.4-2', '7.1.ds-1', '4.3.90.1svn-r21976-1', '0.9~rc1-1', '1.2', 
+        '4.0.1.3.dfsg.1-2', '1:1.0-0', '1.0-1', '1:1.4.1-1', '1:500', 
+        '1.2.10+cvs20060429-1', '1.5+E-14', '1.0', '2:1.0.4~rc2-1', 
+        '2:1.0.4+svn26-1ubuntu1', '0.4.23debian1', '1.11',
+        '1.123456789012345678901234567890-1']
+
     def setUp(self):
         self.db = psycopg2.connect('dbname=texp')
 
@@ -56,23 +70,23 @@ class TestVercomp(unittest.TestCase):
         internal_dpkg_version.comparable_ver(x)
 
     def test_comparable_ver_sql(self):
-        versions = ['1:1.0-0.1', '20060611-0.0', '1:5000', '1.0final-5', 
-            '4.2.0a+stable-2sarge1', '0.52.2-5.1', '1.8RC4b', '1.0-0.1', '1.5', 
-            '1.5~dev0', '1.1.0+cvs20060620-1+1.0', 
-            '0.9.2+cvs.1.0.dev.2004.07.28-1.5', '1.5~rc2', '10.11.1.3-2', 
-            '11:5000', '0.2.0-1+b1', '1.1.0+cvs20060620-1+2.6.15-8', '100:500', 
-            '1.0pre7-2', '1.5~rc1', '0.9.2-5', '1:1.0', 'a', '7.0-035+1', '1.5+b1', 
-            '1.0a7-2', '1:1.8.8-070403-1~priv1', '1.1', '0', '1.0final-5sarge1', 
-            '1.0.4-2', '7.1.ds-1', '4.3.90.1svn-r21976-1', '0.9~rc1-1', '1.2', 
-            '4.0.1.3.dfsg.1-2', '1:1.0-0', '1.0-1', '1:1.4.1-1', '1:500', 
-            '1.2.10+cvs20060429-1', '1.5+E-14', '1.0', '2:1.0.4~rc2-1', 
-            '2:1.0.4+svn26-1ubuntu1', '0.4.23debian1', '1.11']
         cur = self.db.cursor()
         cur.execute("SELECT 'comparable_dpkgver'::regproc")
-        for version in versions:
+        for version in self.versions:
             cur.execute("SELECT comparable_dpkgver(%s)", (version,))
             self.assertEqual(cur.fetchone()[0],
                 internal_dpkg_version.comparable_ver(version), version)
 
+    def test_sort_versions(self):
+        by_cmp = sorted(self.versions, key=functools.cmp_to_key(
+            internal_dpkg_version.dpkg_version_compare))
+        self.assertEqual(internal_dpkg_version.sort_versions(self.versions),
+                         by_cmp)
+        self.assertEqual(
+            internal_dpkg_version.sort_versions(self.versions, reverse=True),
+            by_cmp[::-1])
+        self.assertEqual(internal_dpkg_version.max_version(self.versions),
+                         by_cmp[-1])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import internal_db
+import module_scan
+import module_watch
+
+
+class Flushed(Exception):
+    pass
+
+
+class TestPoolWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp(prefix='pv-test-')
+        os.makedirs(os.path.join(self.base_dir, 'pool/stable/main/f'))
+        self.watcher = module_watch.PoolWatcher(self.base_dir, ['stable'])
+        self.watcher.start()
+        self.flushed = []
+
+    def tearDown(self):
+        self.watcher.inotify.close()
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def write(self, path, data=b'deb'):
+        path = os.path.join(self.base_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def handle_events(self):
+        for wd, mask, cookie, name in self.watcher.inotify.read(1):
+            self.watcher.handle(wd, mask, name)
+
+    def flush(self, db):
+        self.flushed.append((time.monotonic(), {
+            comp: set(files) for comp, files in self.watcher.pending.items()},
+            set(self.watcher.rescan)))
+        raise Flushed
+
+    def test_handle(self):
+        self.write('pool/stable/main/f/foo.deb')
+        self.write('pool/stable/main/f/foo.deb', b'again')
+        self.write('pool/stable/main/f/README')
+        self.handle_events()
+        self.assertEqual(self.watcher.pending, {
+            ('stable', 'main'): {'pool/stable/main/f/foo.deb'}})
+        self.assertEqual(self.watcher.rescan, set())
+        # A directory moved in brings its files, and is watched
+        self.write('incoming/g/bar.deb')
+        os.rename(os.path.join(self.base_dir, 'incoming/g'),
+                  os.path.join(self.base_dir, 'pool/stable/main/g'))
+        self.handle_events()
+        self.assertEqual(self.watcher.pending, {
+            ('stable', 'main'): {'pool/stable/main/f/foo.deb',
+                                 'pool/stable/main/g/bar.deb'}})
+        self.write('pool/stable/main/g/baz.deb')
+        self.handle_events()
+        self.assertIn('pool/stable/main/g/baz.deb',
+                      self.watcher.pending[('stable', 'main')])
+        # Files moved out with their directory have no events of their own
+        os.rename(os.path.join(self.base_dir, 'pool/stable/main/g'),
+                  os.path.join(self.base_dir, 'incoming/g'))
+        # New components are scanned as a whole
+        self.write('pool/stable/contrib/h/qux.deb')
+        self.handle_events()
+        self.assertEqual(self.watcher.rescan,
+                         {('stable', 'main'), ('stable', 'contrib')})
+
+    def test_quiet_time(self):
+        self.write('pool/stable/main/f/foo.deb')
+        self.write('pool/stable/main/f/bar.deb')
+        self.write('pool/stable/main/f/foo.deb', b'again')
+        with mock.patch.object(module_watch, 'quiet_time', 0.2), \
+                mock.patch.object(self.watcher, 'flush', self.flush):
+            started = time.monotonic()
+            with self.assertRaises(Flushed):
+                self.watcher.run(None)
+        self.assertEqual(len(self.flushed), 1)
+        flushed_at, pending, rescan = self.flushed[0]
+        self.assertGreaterEqual(flushed_at - started, 0.2)
+        self.assertEqual(pending, {('stable', 'main'): {
+            'pool/stable/main/f/foo.deb', 'pool/stable/main/f/bar.deb'}})
+
+    def test_max_delay(self):
+        stop = threading.Event()
+
+        def upload():
+            for i in range(50):
+                if stop.wait(0.05):
+                    break
+                self.write('pool/stable/main/f/foo_%d.deb' % i)
+
+        thread = threading.Thread(target=upload)
+        with mock.patch.object(module_watch, 'quiet_time', 0.5), \
+                mock.patch.object(module_watch, 'max_delay', 0.5), \
+                mock.patch.object(self.watcher, 'flush', self.flush):
+            thread.start()
+            started = time.monotonic()
+            try:
+                with self.assertRaises(Flushed):
+                    self.watcher.run(None)
+            finally:
+                stop.set()
+                thread.join()
+        # Flushed while uploads were still arriving
+        flushed_at, pending, rescan = self.flushed[0]
+        self.assertLess(flushed_at - started, 2)
+        self.assertLess(len(pending[('stable', 'main')]), 50)
+
+    def test_flush(self):
+        self.write('pool/stable/contrib/h/qux.deb')
+        self.watcher.pending = {
+            ('stable', 'main'): {'pool/stable/main/f/foo.deb'},
+            ('stable', 'contrib'): {'pool/stable/contrib/h/qux.deb'}}
+        self.watcher.rescan = {('stable', 'contrib'), ('stable', 'gone')}
+        db = mock.Mock()
+        with mock.patch.object(module_scan, 'table_mtime', return_value=0), \
+                mock.patch.object(internal_db, 'init_branches'), \
+                mock.patch.object(internal_db, 'init_index') as init_index, \
+                mock.patch.object(module_scan, 'scan_dir') as scan_dir, \
+                mock.patch.object(module_scan, 'scan_files') as scan_files:
+            self.watcher.flush(db)
+        scan_dir.assert_called_once_with(db, self.base_dir, 'stable',
+                                         'contrib', 0)
+        scan_files.assert_called_once_with(
+            db, self.base_dir, 'stable', 'main', 0,
+            {'pool/stable/main/f/foo.deb'})
+        init_index.assert_not_called()
+        self.assertEqual(self.watcher.pending, {})
+        self.assertEqual(self.watcher.rescan, set())
+
+
+if __name__ == '__main__':
+    unittest.main()